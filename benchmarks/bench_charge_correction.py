@@ -0,0 +1,68 @@
+"""
+Benchmark - correcting a whole run for multiply charged particles with one matrix product
+
+For every export in data/, builds the ChargeCorrection for the run's dp grid, flows and gas
+conditions, checks that the corrected scans reproduce the measured ones when the multiply
+charged particles are put back (solving the upper triangular system of each scan), then times
+building the correction, correcting the run with ChargeCorrection.apply, and solving each
+scan on its own.
+
+Run from the top of the repo:
+    python -m benchmarks.bench_charge_correction
+"""
+import glob
+import sys
+import timeit
+import warnings
+
+import numpy as np
+import scipy.linalg
+
+from htdma_code.model.files.read_file_utils import read_run_file
+from htdma_code.model.setupmods.setup import Setup
+from htdma_code.model.charge_correction import ChargeCorrection, get_run_charge_correction, _get_charge_correction
+
+NUM_REPEATS = 20
+
+# The corrected scans, with the multiply charged particles put back, match the measured ones to this
+RTOL = 1e-9
+
+
+def solve_each(measured_per_true: np.ndarray, conc: np.ndarray) -> np.ndarray:
+    """
+    Correct the scans one at a time, with a triangular solve each
+    """
+    return np.array([scipy.linalg.solve_triangular(measured_per_true, row) for row in conc])
+
+
+if __name__ == '__main__':
+    warnings.simplefilter("ignore")
+    num_failed = 0
+    print("{:<45} {:>6} {:>5} {:>10} {:>10} {:>10} {:>8}".format(
+        "file", "scans", "dp", "build (ms)", "each (ms)", "apply (ms)", "speedup"))
+    for filename in sorted(glob.glob("data/*.txt")):
+        run_data = read_run_file(filename)
+        setup = Setup()
+        setup.read_run_data(run_data)
+        conc = np.nan_to_num(run_data.conc)
+
+        def _build():
+            _get_charge_correction.cache_clear()
+            return get_run_charge_correction(setup, run_data.dp)
+        t_build = min(timeit.repeat(_build, number=1, repeat=3))
+        correction: ChargeCorrection = _build()
+
+        measured_per_true = np.linalg.inv(correction.matrix.T)
+        corrected = correction.apply(conc)
+        if not np.allclose(corrected @ measured_per_true.T, conc, rtol=RTOL, atol=RTOL * np.abs(conc).max()) or \
+                not np.allclose(solve_each(measured_per_true, conc), corrected, rtol=RTOL,
+                                atol=RTOL * np.abs(conc).max()):
+            print("MISMATCH {}".format(filename))
+            num_failed += 1
+
+        t_each = min(timeit.repeat(lambda: solve_each(measured_per_true, conc), number=1, repeat=NUM_REPEATS))
+        t_apply = min(timeit.repeat(lambda: correction.apply(conc), number=1, repeat=NUM_REPEATS))
+        print("{:<45} {:>6} {:>5} {:>10.1f} {:>10.3f} {:>10.3f} {:>7.1f}x".format(
+            filename[-45:], conc.shape[0], conc.shape[1], t_build * 1e3, t_each * 1e3, t_apply * 1e3,
+            t_each / t_apply))
+    sys.exit(1 if num_failed else 0)
@@ -0,0 +1,91 @@
+"""
+Benchmark - the N gaussian fit model
+
+Compares fitting with the old hand written _1gaussian ... _5gaussian sums and finite
+difference Jacobians, against the single broadcast _ngaussian model with its closed form
+Jacobian. Reports the number of model evaluations and the wall time per fit.
+
+Run from the top of the repo:
+    python -m benchmarks.bench_gaussian_fit
+"""
+import time
+
+import numpy as np
+import scipy.optimize
+
+from htdma_code.model.scan import _1gaussian, _ngaussian, _ngaussian_jac
+
+NUM_DP_VALUES = 104
+NUM_FITS = 20
+MAX_FEV = 5000
+MAX_PEAKS = 6
+
+
+def old_gaussians(x, *params):
+    """
+    The same sum the old _1gaussian ... _5gaussian functions computed, one peak at a time
+    """
+    y = 0
+    for i in range(len(params) // 3):
+        y = y + _1gaussian(x, *params[i*3:(i+1)*3])
+    return y
+
+
+class Counter:
+    """
+    Wrap a function and count how many times it is called
+    """
+    def __init__(self, func):
+        self.func = func
+        self.num_calls = 0
+
+    def __call__(self, *args):
+        self.num_calls += 1
+        return self.func(*args)
+
+
+def make_problem(rng, num_peaks, num_dp_values=NUM_DP_VALUES):
+    x = np.log(np.geomspace(8.2, 333.8, num_dp_values))
+    width = x.max() - x.min()
+    mu = np.sort(rng.uniform(x[10], x[-10], num_peaks))
+    true_params = np.column_stack((rng.uniform(1e3, 1e5, num_peaks), mu,
+                                   rng.uniform(0.03, 0.1, num_peaks) * width)).ravel()
+    y = _ngaussian(x, *true_params)
+    y = y + rng.normal(0, y.max() * 0.02, y.shape)
+
+    # Start from a perturbed guess, with the same sort of bounds Scan.fit uses
+    p0 = np.reshape(true_params, (-1, 3)) * rng.uniform(0.9, 1.1, (num_peaks, 3))
+    lower = np.column_stack((p0[:, 0] * 0.1, p0[:, 1] - width * 0.05, np.full(num_peaks, width * 0.01)))
+    upper = np.column_stack((p0[:, 0] * 1.5, p0[:, 1] + width * 0.05, np.full(num_peaks, width * 0.20)))
+    p0 = np.clip(p0, lower, upper)
+    return x, y, p0.ravel(), (lower.ravel(), upper.ravel())
+
+
+def run(num_peaks, use_jac):
+    rng = np.random.default_rng(num_peaks)
+    num_evals = 0
+    num_failed = 0
+    t_total = 0
+    for _ in range(NUM_FITS):
+        x, y, p0, bounds = make_problem(rng, num_peaks)
+        model = Counter(_ngaussian if use_jac else old_gaussians)
+        jac = Counter(_ngaussian_jac) if use_jac else "2-point"
+        t_start = time.perf_counter()
+        try:
+            scipy.optimize.curve_fit(model, x, y, p0=p0, bounds=bounds, jac=jac, maxfev=MAX_FEV)
+        except RuntimeError:
+            num_failed += 1
+        t_total += time.perf_counter() - t_start
+        num_evals += model.num_calls + (jac.num_calls if use_jac else 0)
+    return num_evals / NUM_FITS, t_total / NUM_FITS, num_failed
+
+
+if __name__ == '__main__':
+    print("Per fit, averaged over {} fits. Failed = fits that hit {} evaluations".format(NUM_FITS, MAX_FEV))
+    print("{:>5} {:>10} {:>10} {:>10} {:>10} {:>8} {:>11} {:>11}".format(
+        "peaks", "old evals", "new evals", "old (ms)", "new (ms)", "speedup", "old failed", "new failed"))
+    for num_peaks in range(1, MAX_PEAKS + 1):
+        old_evals, t_old, old_failed = run(num_peaks, use_jac=False)
+        new_evals, t_new, new_failed = run(num_peaks, use_jac=True)
+        print("{:>5} {:>10.1f} {:>10.1f} {:>10.2f} {:>10.2f} {:>7.1f}x {:>11} {:>11}".format(
+            num_peaks, old_evals, new_evals, t_old * 1e3, t_new * 1e3, t_old / t_new, old_failed, new_failed))
@@ -0,0 +1,104 @@
+"""
+Benchmark - the numpy N gaussian model vs. the numba kernels of gaussian_kernels
+
+For scans of 100 - 200 channels and 1 - 4 peaks, checks that the numba model and Jacobian
+match the numpy ones, then times one model evaluation, one Jacobian evaluation and a
+whole bounded curve_fit with each. The numba kernels are compiled (or loaded from numba's
+cache) before timing.
+
+Without numba installed, only the numpy times are reported.
+
+Run from the top of the repo:
+    python -m benchmarks.bench_gaussian_kernels
+"""
+import sys
+import timeit
+
+import numpy as np
+import scipy.optimize
+
+import htdma_code.model.gaussian_kernels as gaussian_kernels
+from htdma_code.model.scan import _ngaussian, _ngaussian_jac
+
+from benchmarks.bench_gaussian_fit import make_problem
+
+NUM_DP_VALUES = (100, 150, 200)
+NUM_PEAKS = (1, 2, 4)
+NUM_EVAL_REPEATS = 2000
+NUM_FITS = 20
+
+# The numba kernels add up the same terms as numpy, in a different order
+RTOL = 1e-12
+
+BACKENDS = {
+    gaussian_kernels.BACKEND_NUMPY: (_ngaussian, _ngaussian_jac),
+    gaussian_kernels.BACKEND_NUMBA: (gaussian_kernels.ngaussian, gaussian_kernels.ngaussian_jac),
+}
+
+
+def make_problems(num_dp: int, num_peaks: int) -> list:
+    """
+    NUM_FITS noisy fit problems of num_dp channels, the same for every backend
+    """
+    rng = np.random.default_rng(num_dp * 100 + num_peaks)
+    return [make_problem(rng, num_peaks, num_dp) for _ in range(NUM_FITS)]
+
+
+def time_backend(backend: str, problems: list) -> tuple:
+    """
+    :return: (model time, Jacobian time, fit time) in seconds, each per call
+    """
+    (model, jac) = BACKENDS[backend]
+    (x, _, p0, _) = problems[0]
+    t_model = min(timeit.repeat(lambda: model(x, *p0), number=NUM_EVAL_REPEATS, repeat=3)) / NUM_EVAL_REPEATS
+    t_jac = min(timeit.repeat(lambda: jac(x, *p0), number=NUM_EVAL_REPEATS, repeat=3)) / NUM_EVAL_REPEATS
+
+    def fit_all():
+        for (x, y, p0, bounds) in problems:
+            try:
+                scipy.optimize.curve_fit(model, x, y, p0=p0, bounds=bounds, jac=jac)
+            except RuntimeError:
+                pass
+    t_fit = min(timeit.repeat(fit_all, number=1, repeat=3)) / len(problems)
+    return t_model, t_jac, t_fit
+
+
+def check(problems: list) -> bool:
+    """
+    :return: True if the numba model and Jacobian match the numpy ones for every problem
+    """
+    for (x, _, p0, _) in problems:
+        if not np.allclose(gaussian_kernels.ngaussian(x, *p0), _ngaussian(x, *p0), rtol=RTOL, atol=0) or \
+                not np.allclose(gaussian_kernels.ngaussian_jac(x, *p0), _ngaussian_jac(x, *p0), rtol=RTOL,
+                                atol=RTOL * np.abs(_ngaussian_jac(x, *p0)).max()):
+            return False
+    return True
+
+
+if __name__ == '__main__':
+    has_numba = gaussian_kernels.is_numba_available()
+    backends = list(BACKENDS) if has_numba else [gaussian_kernels.BACKEND_NUMPY]
+    if not has_numba:
+        print("numba is not installed - only timing the numpy model")
+    else:
+        # Compile before timing anything
+        check(make_problems(NUM_DP_VALUES[0], 1))
+
+    num_failed = 0
+    print("Times in microseconds. model / jac are one evaluation, fit is one whole curve_fit")
+    print("{:>5} {:>5} {:>8} {:>10} {:>10} {:>10}".format("dp", "peaks", "backend", "model", "jac", "fit"))
+    for num_dp in NUM_DP_VALUES:
+        for num_peaks in NUM_PEAKS:
+            problems = make_problems(num_dp, num_peaks)
+            if has_numba and not check(problems):
+                print("MISMATCH {} dp values, {} peaks".format(num_dp, num_peaks))
+                num_failed += 1
+            times = {backend: time_backend(backend, problems) for backend in backends}
+            for backend in backends:
+                (t_model, t_jac, t_fit) = times[backend]
+                print("{:>5} {:>5} {:>8} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+                    num_dp, num_peaks, backend, t_model * 1e6, t_jac * 1e6, t_fit * 1e6))
+            if has_numba:
+                speedups = np.divide(times[gaussian_kernels.BACKEND_NUMPY], times[gaussian_kernels.BACKEND_NUMBA])
+                print("{:>5} {:>5} {:>8} {:>9.1f}x {:>9.1f}x {:>9.1f}x".format("", "", "speedup", *speedups))
+    sys.exit(1 if num_failed else 0)
@@ -0,0 +1,90 @@
+"""
+Benchmark - import time of the model layer
+
+Imports each module in a fresh interpreter with python -X importtime, and reports the
+cumulative import time (best of a few runs). It also checks that none of the GUI-only
+packages (PySide2, matplotlib) or statsmodels got pulled in along the way, and that the model
+itself only needs numpy and scipy (no pandas) to import.
+
+Exits with status 1 if a forbidden package was imported, or if --max-ms is given and a module
+took longer than that to import, so it can be run as a CI check.
+
+Run from the top of the repo:
+    python -m benchmarks.bench_import_time [--max-ms 1500]
+"""
+import argparse
+import subprocess
+import sys
+
+# Modules that must import without any GUI packages
+MODULES = ["htdma_code.model.scan",
+           "htdma_code.model.scans",
+           "htdma_code.model.setupmods.setup",
+           "htdma_code.model.dma1",
+           "htdma_code.model.model",
+           "htdma_code.batch"]
+
+FORBIDDEN_PACKAGES = ["PySide2", "matplotlib", "statsmodels"]
+
+# Packages only some of the MODULES may import: package -> the modules allowed to. The batch
+# command writes its results with pandas, the model only builds DataFrames when asked for one
+ALLOWED_PACKAGES = {"pandas": ["htdma_code.batch"]}
+
+NUM_REPEATS = 5
+
+
+def import_time(module: str):
+    """
+    Import a module in a fresh interpreter
+
+    :return: (cumulative import time in ms, set of the top level packages imported)
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            capture_output=True, text=True, check=True)
+    cumulative_ms = None
+    packages = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        name = fields[2].strip()
+        if not fields[1].strip().isdigit():
+            continue
+        packages.add(name.split(".")[0])
+        if name == module:
+            cumulative_ms = int(fields[1]) / 1000
+    return cumulative_ms, packages
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Report the import time of the model layer")
+    parser.add_argument("--max-ms", type=float, default=None,
+                        help="fail if a module takes longer than this to import")
+    args = parser.parse_args(argv)
+
+    is_ok = True
+    for module in MODULES:
+        times = []
+        packages = set()
+        for _ in range(NUM_REPEATS):
+            (cumulative_ms, packages) = import_time(module)
+            times.append(cumulative_ms)
+        best_ms = min(times)
+
+        forbidden = sorted(packages & set(FORBIDDEN_PACKAGES))
+        forbidden += sorted(package for (package, allowed_modules) in ALLOWED_PACKAGES.items()
+                            if package in packages and module not in allowed_modules)
+        s = "{:36s} {:8.1f} ms".format(module, best_ms)
+        if forbidden:
+            s += "  FORBIDDEN: {}".format(", ".join(forbidden))
+            is_ok = False
+        if args.max_ms is not None and best_ms > args.max_ms:
+            s += "  TOO SLOW (> {:.0f} ms)".format(args.max_ms)
+            is_ok = False
+        print(s)
+
+    return 0 if is_ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
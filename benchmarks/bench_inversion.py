@@ -0,0 +1,118 @@
+"""
+Benchmark - inverting whole runs to growth factor distributions against one cached kernel
+
+For every export in data/, sets DMA 1 to a dry dp in the middle of the scan's range and builds
+the run's InversionKernel. It checks that growth factor distributions with two modes, put
+through the kernel with 3% noise, come back with the same total concentration and mean growth
+factor with both methods, and that a batch inverts to the same distributions as one scan at a
+time. Then it times building the kernel, inverting NUM_SCANS scans of the run one at a time
+(Scan.invert), in one batch (Scans.invert_all), and with nnls.
+
+Run from the top of the repo:
+    python -m benchmarks.bench_inversion
+"""
+import glob
+import sys
+import timeit
+import warnings
+
+import numpy as np
+
+from htdma_code.model.files.read_file_utils import read_run_file
+from htdma_code.model.setupmods.setup import Setup
+from htdma_code.model.dma1 import DMA_1
+from htdma_code.model.scans import Scans
+from htdma_code.model.mobility import get_mobility_table
+from htdma_code.model.transfer_function import voltage_for_mobility
+from htdma_code.model.inversion import InversionKernel, INVERSION_METHODS, get_run_inversion_kernel, \
+    _get_inversion_kernel
+
+# The runs are repeated up to this many scans for the timings
+NUM_SCANS = 1000
+NUM_REPEATS = 3
+
+# The distributions come back with the total concentration and mean growth factor within these
+TOTAL_RTOL = 0.03
+MEAN_GF_RTOL = 0.01
+
+# Relative noise on the synthetic scans
+NOISE = 0.03
+
+
+def set_dry_dp(dma1: DMA_1, dp_nm: float):
+    """
+    Set DMA 1 to the voltage where its centroid is dp_nm
+    """
+    zp = get_mobility_table(dma1.mean_free_path_nm, dma1.mu_gas_viscosity_poise, 1).Dp_to_Zp(np.array(dp_nm))
+    geometry = (dma1.setup.dma_1_params.length_cm, dma1.setup.dma_1_params.radius_in_cm,
+                dma1.setup.dma_1_params.radius_out_cm)
+    dma1.update_voltage(float(voltage_for_mobility(zp, dma1.q_sh_lpm, dma1.q_excess_lpm, *geometry)))
+
+
+def synthetic_distributions(kernel: InversionKernel) -> np.ndarray:
+    """
+    :return: two growth factor distributions (number per bin), with a less and a more hygroscopic mode
+    """
+    log_gf = np.log(kernel.gf)
+
+    def _mode(gf, sigma_g, conc):
+        values = np.exp(-0.5 * ((log_gf - np.log(gf)) / np.log(sigma_g)) ** 2)
+        return conc * values / values.sum()
+
+    return np.array([_mode(1.1, 1.03, 300) + _mode(1.6, 1.05, 800),
+                     _mode(1.3, 1.08, 1000) + _mode(1.9, 1.04, 200)])
+
+
+if __name__ == '__main__':
+    warnings.simplefilter("ignore")
+    num_failed = 0
+    rng = np.random.default_rng(0)
+    print("{:<45} {:>5} {:>10} {:>10} {:>10} {:>10} {:>8}".format(
+        "file", "nnz", "build (ms)", "each (ms)", "batch (ms)", "nnls (ms)", "speedup"))
+    for filename in sorted(glob.glob("data/*.txt")):
+        run_data = read_run_file(filename)
+        setup = Setup()
+        setup.read_run_data(run_data)
+        dma1 = DMA_1(setup)
+        set_dry_dp(dma1, float(np.sqrt(run_data.dp[0] * run_data.dp[-1])))
+
+        def _build():
+            _get_inversion_kernel.cache_clear()
+            return get_run_inversion_kernel(setup, dma1, run_data.dp)
+        t_build = min(timeit.repeat(_build, number=1, repeat=NUM_REPEATS))
+        kernel = _build()
+
+        true_conc = synthetic_distributions(kernel)
+        scans_synthetic = (kernel.matrix @ true_conc.T).T
+        scans_synthetic *= 1 + NOISE * rng.standard_normal(scans_synthetic.shape)
+        true_total = true_conc.sum(axis=1)
+        true_mean_gf = true_conc @ kernel.gf / true_total
+        for method in INVERSION_METHODS:
+            result = kernel.invert(scans_synthetic, method)
+            if not np.allclose(result.total_conc, true_total, rtol=TOTAL_RTOL) or \
+                    not np.allclose(result.mean_gf, true_mean_gf, rtol=MEAN_GF_RTOL):
+                print("MISMATCH {} {}: total {} (expected {}), mean gf {} (expected {})".format(
+                    filename, method, result.total_conc, true_total, result.mean_gf, true_mean_gf))
+                num_failed += 1
+
+        # The real scans of the run, repeated
+        repeats = -(-NUM_SCANS // run_data.get_num_scans())
+        run_data.conc = np.tile(run_data.conc, (repeats, 1))[:NUM_SCANS]
+        scans = Scans()
+        scans.read_run_data(run_data)
+
+        def _each():
+            return [scans.get_scan(i).invert(kernel) for i in range(scans.get_num_scans())]
+        batch = scans.invert_all(kernel)
+        each = np.concatenate([result.conc for result in _each()])
+        if not np.allclose(batch.conc, each, rtol=1e-9, atol=1e-9 * max(np.abs(each).max(), 1.0)):
+            print("MISMATCH {}: the batch is not the same as one scan at a time".format(filename))
+            num_failed += 1
+
+        t_each = min(timeit.repeat(_each, number=1, repeat=1))
+        t_batch = min(timeit.repeat(lambda: scans.invert_all(kernel), number=1, repeat=NUM_REPEATS))
+        t_nnls = min(timeit.repeat(lambda: scans.invert_all(kernel, "nnls"), number=1, repeat=1))
+        print("{:<45} {:>5} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>7.1f}x".format(
+            filename[-45:], kernel.matrix.nnz, t_build * 1e3, t_each * 1e3, t_batch * 1e3, t_nnls * 1e3,
+            t_each / t_batch))
+    sys.exit(1 if num_failed else 0)
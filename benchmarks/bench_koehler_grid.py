@@ -0,0 +1,66 @@
+"""
+Benchmark - KoehlerGrid lookups vs. solving kappa-Koehler theory with growth_factor_from_kappa
+
+Builds a grid in a temporary directory, checks that loading it again memory maps the same
+values, then for random kappas, dry diameters and RHs inside the grid checks that the looked
+up growth factors are within the grid's max_error of the exact ones, and times both.
+
+Run from the top of the repo:
+    python -m benchmarks.bench_koehler_grid
+"""
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+
+from htdma_code.model.hygroscopicity import growth_factor_from_kappa
+from htdma_code.model.koehler_grid import KoehlerGrid, load_koehler_grid, save_koehler_grid, \
+    GRID_DP_DRY_MIN_NM, GRID_DP_DRY_MAX_NM, GRID_KAPPA_MAX, GRID_RH_MIN, GRID_RH_MAX
+
+TEMP_K = 296.15
+NUM_QUERIES = (1000, 100000, 1000000)
+NUM_REPEATS = 3
+
+
+def make_queries(num_queries: int) -> tuple:
+    """
+    :return: (kappa, dry diameter, rh) arrays, spread over the whole grid
+    """
+    rng = np.random.default_rng(num_queries)
+    kappa = rng.uniform(0, GRID_KAPPA_MAX, num_queries)
+    dp_dry_nm = np.exp(rng.uniform(np.log(GRID_DP_DRY_MIN_NM), np.log(GRID_DP_DRY_MAX_NM), num_queries))
+    rh = rng.uniform(GRID_RH_MIN, GRID_RH_MAX, num_queries)
+    return kappa, dp_dry_nm, rh
+
+
+if __name__ == '__main__':
+    num_failed = 0
+    t_build = min(timeit.repeat(lambda: KoehlerGrid(TEMP_K), number=1, repeat=NUM_REPEATS))
+    grid = KoehlerGrid(TEMP_K)
+    print(grid)
+    with tempfile.TemporaryDirectory() as grid_dir:
+        save_koehler_grid(grid, grid_dir)
+        t_load = min(timeit.repeat(lambda: load_koehler_grid(grid.temp_k, grid.surface_tension_n_per_m, grid_dir),
+                                   number=1, repeat=NUM_REPEATS))
+        loaded = load_koehler_grid(grid.temp_k, grid.surface_tension_n_per_m, grid_dir)
+        if loaded is None or not isinstance(loaded.gf3, np.memmap) or not np.array_equal(loaded.gf3, grid.gf3):
+            print("MISMATCH the loaded grid is not a memory map of the saved one")
+            num_failed += 1
+        del loaded
+    print("build {:.1f} ms, load {:.2f} ms\n".format(t_build * 1e3, t_load * 1e3))
+
+    print("{:>8} {:>12} {:>12} {:>8} {:>10}".format("queries", "exact (ms)", "grid (ms)", "speedup", "max error"))
+    for num_queries in NUM_QUERIES:
+        queries = make_queries(num_queries)
+        exact = growth_factor_from_kappa(*queries, TEMP_K)
+        error = float(np.max(np.abs(grid.growth_factor(*queries) - exact)))
+        if error > grid.max_error * 1.01:
+            print("MISMATCH {} queries: error {:.2e} is over the grid's bound {:.2e}".format(
+                num_queries, error, grid.max_error))
+            num_failed += 1
+        t_exact = min(timeit.repeat(lambda: growth_factor_from_kappa(*queries, TEMP_K), number=1, repeat=NUM_REPEATS))
+        t_grid = min(timeit.repeat(lambda: grid.growth_factor(*queries), number=1, repeat=NUM_REPEATS))
+        print("{:>8} {:>12.2f} {:>12.2f} {:>7.1f}x {:>10.2e}".format(num_queries, t_exact * 1e3, t_grid * 1e3,
+                                                                     t_exact / t_grid, error))
+    sys.exit(1 if num_failed else 0)
@@ -0,0 +1,54 @@
+"""
+Benchmark - predict_peaks one scan at a time vs. predict_peaks_batch over the whole run
+
+For every export in data/, checks that predict_peaks_batch finds the same peaks, in the
+same order, as smoothing each scan and calling predict_peaks on it (for the scans, and for
+the negated scans as a stand in for residuals), then times both.
+
+Run from the top of the repo:
+    python -m benchmarks.bench_predict_peaks
+"""
+import glob
+import sys
+import timeit
+import warnings
+
+from htdma_code.model.files.read_file_utils import read_run_file
+from htdma_code.model.scan import filter_bad_values, calc_moving_ave, predict_peaks, predict_peaks_batch
+
+NUM_REPEATS = 20
+
+
+def predict_peaks_each(matrix, is_scan: bool) -> list:
+    """
+    The peaks of every row, found one row at a time the way Scan.fit does
+    """
+    return [predict_peaks(calc_moving_ave(row, 3), is_scan=is_scan) for row in matrix]
+
+
+def count_mismatches(matrix, is_scan: bool) -> int:
+    """
+    :return: the number of rows where predict_peaks_batch disagrees with predict_peaks
+    """
+    expected = predict_peaks_each(matrix, is_scan)
+    (indptr, indices) = predict_peaks_batch(matrix, is_scan=is_scan)
+    return sum(list(indices[indptr[i]:indptr[i + 1]]) != list(peaks) for (i, peaks) in enumerate(expected))
+
+
+if __name__ == '__main__':
+    warnings.simplefilter("ignore")
+    num_failed = 0
+    print("{:<55} {:>7} {:>10} {:>10} {:>8}".format("file", "scans", "each (ms)", "batch (ms)", "speedup"))
+    for filename in sorted(glob.glob("data/*.txt")):
+        (y_filtered, _) = filter_bad_values(read_run_file(filename).conc)
+        for is_scan in (True, False):
+            num_mismatches = count_mismatches(y_filtered, is_scan)
+            if num_mismatches:
+                print("MISMATCH {} (is_scan={}): {} scans differ".format(filename, is_scan, num_mismatches))
+            num_failed += num_mismatches
+
+        t_each = min(timeit.repeat(lambda: predict_peaks_each(y_filtered, True), number=1, repeat=NUM_REPEATS))
+        t_batch = min(timeit.repeat(lambda: predict_peaks_batch(y_filtered), number=1, repeat=NUM_REPEATS))
+        print("{:<55} {:>7} {:>10.2f} {:>10.2f} {:>7.1f}x".format(filename[-55:], y_filtered.shape[0],
+                                                                  t_each * 1e3, t_batch * 1e3, t_each / t_batch))
+    sys.exit(1 if num_failed else 0)
@@ -0,0 +1,41 @@
+"""
+Benchmark - reading a run file
+
+Compares the old ingest path used by Model.process_new_file (read_setup followed by
+read_scans_into_dataframe, once for the Setup and once again for the Scans) against
+the single pass read_run_file.
+
+Run from the top of the repo:
+    python -m benchmarks.bench_read_file
+"""
+import glob
+import timeit
+import warnings
+
+import htdma_code.model.files.read_file_utils as read_file_utils
+
+NUM_REPEATS = 20
+
+
+def old_ingest(filename):
+    for _ in range(2):
+        reader = read_file_utils.RunFileReader(filename)
+        reader.read_setup()
+        reader.read_scans_into_dataframe()
+
+
+def new_ingest(filename):
+    read_file_utils.read_run_file(filename).to_dataframe()
+
+
+if __name__ == '__main__':
+    warnings.simplefilter("ignore")
+    print("{:<55} {:>10} {:>10} {:>8}".format("file", "old (ms)", "new (ms)", "speedup"))
+    for filename in sorted(glob.glob("data/*.txt")):
+        try:
+            t_old = min(timeit.repeat(lambda: old_ingest(filename), number=1, repeat=NUM_REPEATS))
+        except Exception:
+            # Some exports (e.g. those with raw count data) can't be read by the old path at all
+            t_old = float("nan")
+        t_new = min(timeit.repeat(lambda: new_ingest(filename), number=1, repeat=NUM_REPEATS))
+        print("{:<55} {:>10.2f} {:>10.2f} {:>7.1f}x".format(filename[-55:], t_old * 1e3, t_new * 1e3, t_old / t_new))
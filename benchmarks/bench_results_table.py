@@ -0,0 +1,66 @@
+"""
+Benchmark - appending fit results to the results table
+
+Compares the old way ResultsTableModel stored its rows (one df.loc append per peak, and an
+iloc lookup per painted cell) against the ResultColumns arrays it uses now.
+
+Run from the top of the repo:
+    python -m benchmarks.bench_results_table
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+from htdma_code.model.result_columns import ResultColumns, COLUMN_NAMES
+
+NUM_SCANS = 5000
+PEAKS_PER_SCAN = 2
+
+
+def make_rows(rng):
+    rows = []
+    for scan_index in range(NUM_SCANS):
+        for peak_index in range(PEAKS_PER_SCAN):
+            rows.append((scan_index + 1, peak_index + 1, rng.uniform(10, 300),
+                         rng.uniform(0, 1e4), rng.uniform(1, 50)))
+    return rows
+
+
+def main():
+    rows = make_rows(np.random.default_rng(0))
+
+    start = time.perf_counter()
+    df = pd.DataFrame(columns=COLUMN_NAMES)
+    for row in rows:
+        df.loc[len(df)] = dict(zip(COLUMN_NAMES, row))
+    time_old_append = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(len(rows)):
+        df.iloc[i, 2]
+    time_old_lookup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = ResultColumns()
+    for i in range(0, len(rows), PEAKS_PER_SCAN):
+        results.append_rows(*zip(*rows[i:i+PEAKS_PER_SCAN]))
+    time_new_append = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(len(rows)):
+        results.get_value(i, 2)
+    time_new_lookup = time.perf_counter() - start
+
+    print("{} rows".format(len(rows)))
+    print("Append, DataFrame:     {:8.3f} sec".format(time_old_append))
+    print("Append, ResultColumns: {:8.3f} sec  ({:.0f}x)".format(time_new_append,
+                                                                time_old_append / time_new_append))
+    print("Cell lookups, DataFrame:     {:8.3f} sec".format(time_old_lookup))
+    print("Cell lookups, ResultColumns: {:8.3f} sec  ({:.0f}x)".format(time_new_lookup,
+                                                                      time_old_lookup / time_new_lookup))
+    assert np.allclose(results.to_dataframe()["dp"].to_numpy(), df["dp"].to_numpy(dtype=float))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark - following a run file that is still being written
+
+Writes the scans of an export out one at a time (the way AIM writes a growing run), and
+compares reading the whole file again after each new scan against RunFileTail.poll, which
+only converts the new scan column.
+
+Run from the top of the repo:
+    python -m benchmarks.bench_run_tail
+"""
+import os
+import tempfile
+import time
+import warnings
+
+import htdma_code.model.files.read_file_utils as read_file_utils
+from htdma_code.model.files.run_tail import RunFileTail
+
+FILENAME = "data/A-Pinene Carene 100.100.200ppb (7.14.txt"
+
+
+def write_first_scans(lines, num_scans, filename):
+    """
+    Write out a copy of the export with only its first num_scans scan columns
+    """
+    with open(filename, "w", encoding=read_file_utils.FILE_ENCODING) as f:
+        for line in lines:
+            fields = line.split("\t")
+            f.write("\t".join(fields[:num_scans + 1]) if len(fields) > 2 else line)
+            f.write("\n")
+
+
+if __name__ == '__main__':
+    warnings.simplefilter("ignore")
+    with open(FILENAME, encoding=read_file_utils.FILE_ENCODING) as f:
+        lines = f.read().splitlines()
+    num_scans = read_file_utils.read_run_file(FILENAME).get_num_scans()
+
+    (fd, live_filename) = tempfile.mkstemp(suffix=".txt")
+    os.close(fd)
+    try:
+        write_first_scans(lines, 1, live_filename)
+        tail = RunFileTail(live_filename)
+        tail.poll()
+
+        t_reread = 0.0
+        t_tail = 0.0
+        for n in range(2, num_scans + 1):
+            write_first_scans(lines, n, live_filename)
+
+            start = time.perf_counter()
+            read_file_utils.read_run_file(live_filename)
+            t_reread += time.perf_counter() - start
+
+            start = time.perf_counter()
+            run_data = tail.poll()
+            t_tail += time.perf_counter() - start
+            assert run_data is not None and run_data.get_num_scans() == 1
+    finally:
+        os.remove(live_filename)
+
+    num_polls = num_scans - 1
+    print("{} scans added one at a time to {}".format(num_polls, FILENAME))
+    print("  re-read whole file: {:8.2f} ms per scan".format(t_reread / num_polls * 1e3))
+    print("  RunFileTail.poll:   {:8.2f} ms per scan".format(t_tail / num_polls * 1e3))
+    print("  speedup:            {:8.1f}x".format(t_reread / t_tail))
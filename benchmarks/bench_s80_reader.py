@@ -0,0 +1,88 @@
+"""
+Benchmark - decoding .S80 files
+
+For every .S80 file in data/ with a text export next to it, checks that everything the
+.S80 reader decodes (setup, time stamps, scan parameters and dp midpoints) matches the
+text export, then times the decoder.
+
+The decoder is not timed against read_run_file: the .S80 file only holds the raw counts,
+not the dw/dlogDp concentrations of the export (see s80_reader), so the two do not return
+the same thing.
+
+Run from the top of the repo:
+    python -m benchmarks.bench_s80_reader
+"""
+import glob
+import os
+import sys
+import timeit
+import warnings
+
+import numpy as np
+
+import htdma_code.model.files.read_file_utils as read_file_utils
+import htdma_code.model.files.s80_reader as s80_reader
+
+NUM_REPEATS = 20
+
+# The text export only has ~6 significant digits
+RTOL = 1e-5
+
+# ...and the dp midpoints only 3
+DP_RTOL = 5e-3
+
+# Setup keys that depend on how AIM exported the run, not on the run itself
+EXPORT_SETTINGS = ("MULT_CHARGE_CORRECTION",)
+
+
+def check(s80_filename: str, txt_filename: str) -> list:
+    """
+    :return: a list of the differences found between the two files
+    """
+    s80 = s80_reader.read_s80_file(s80_filename)
+    run_data = read_file_utils.read_run_file(txt_filename)
+    errors = []
+
+    missing = set(run_data.setup) - set(s80.setup)
+    if missing:
+        errors.append("setup keys missing: {}".format(sorted(missing)))
+    for key, value in run_data.setup.items():
+        if key in missing or key in EXPORT_SETTINGS:
+            continue
+        if not np.isclose(s80.setup[key], value, rtol=RTOL):
+            errors.append("setup {}: {} != {}".format(key, s80.setup[key], value))
+
+    if s80.get_num_scans() != run_data.get_num_scans():
+        errors.append("num scans: {} != {}".format(s80.get_num_scans(), run_data.get_num_scans()))
+        return errors
+
+    if not s80.time_stamps.equals(run_data.time_stamps):
+        errors.append("time stamps differ")
+
+    for key in s80.scan_meta:
+        if not np.allclose(s80.get_scan_meta_values(key), run_data.get_scan_meta_values(key), rtol=RTOL):
+            errors.append("scan parameter {} differs".format(key))
+
+    if s80.dp.shape != run_data.dp.shape or not np.allclose(s80.dp, run_data.dp, rtol=DP_RTOL):
+        errors.append("dp midpoints differ")
+    return errors
+
+
+if __name__ == '__main__':
+    warnings.simplefilter("ignore")
+    num_failed = 0
+    print("{:<55} {:>10}".format("file", "S80 (ms)"))
+    for s80_filename in sorted(glob.glob("data/*" + s80_reader.S80_FILE_EXTENSION)):
+        txt_filename = os.path.splitext(s80_filename)[0] + ".txt"
+        if not os.path.exists(txt_filename):
+            continue
+
+        errors = check(s80_filename, txt_filename)
+        for error in errors:
+            print("MISMATCH {}: {}".format(s80_filename, error))
+        num_failed += bool(errors)
+
+        t_s80 = min(timeit.repeat(lambda: s80_reader.read_s80_file(s80_filename),
+                                  number=1, repeat=NUM_REPEATS))
+        print("{:<55} {:>10.2f}".format(s80_filename[-55:], t_s80 * 1e3))
+    sys.exit(1 if num_failed else 0)
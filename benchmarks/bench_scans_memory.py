@@ -0,0 +1,81 @@
+"""
+Benchmark - memory used to hold the scans of a run
+
+Compares the old way Scans held a run (a DataFrame with every scan as a column, then
+a copy of each column for each Scan, copied and converted again inside the Scan) against
+the single (n_scans, n_dp) matrix that Scans holds now, on a synthetic 10k scan run.
+
+Run from the top of the repo:
+    python -m benchmarks.bench_scans_memory
+"""
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from htdma_code.model.files.run_data import RunData
+from htdma_code.model.scans import Scans
+
+NUM_SCANS = 10000
+NUM_DP_VALUES = 104
+
+
+def make_run_data():
+    rng = np.random.default_rng(0)
+    dp = np.geomspace(8.2, 333.8, NUM_DP_VALUES)
+    conc = rng.lognormal(mean=10, sigma=2, size=(NUM_SCANS, NUM_DP_VALUES))
+    time_stamps = pd.date_range("2021-06-07 14:16:57", periods=NUM_SCANS, freq="135s")
+    scan_meta = {"Scan Up Time(s)": ["120"] * NUM_SCANS,
+                 "Total Concentration": ["1e6"] * NUM_SCANS}
+    return RunData(filename="synthetic.txt",
+                   data_file_version=1,
+                   setup={},
+                   scan_ids=np.arange(1, NUM_SCANS + 1),
+                   time_stamps=time_stamps,
+                   dp_labels=["{:.2f}".format(d) for d in dp],
+                   conc=conc,
+                   scan_meta=scan_meta)
+
+
+def old_scans(run_data):
+    """
+    What Scans.read_file and Scan.__init__ used to do, minus the filtering
+    """
+    df = run_data.to_dataframe()
+    num_dp_values = run_data.get_num_dp_values()
+    list_of_scans = []
+    for col in range(df.shape[1]):
+        df_col = df.iloc[:, [col]].copy()
+        df_data = df_col.iloc[1:1+num_dp_values, [0]].copy()
+        df_data.index = df_data.index.astype(float)
+        df_data = df_data.astype(float)
+        dp_range = df_data.index.to_numpy()
+        list_of_scans.append((df_data, dp_range, np.log(dp_range), df_data.iloc[:, 0].to_numpy()))
+    return df, list_of_scans
+
+
+def new_scans(run_data):
+    scans = Scans()
+    scans.read_run_data(run_data)
+    return scans
+
+
+def measure(func, run_data):
+    tracemalloc.start()
+    t_start = time.perf_counter()
+    result = func(run_data)
+    t_elapsed = time.perf_counter() - t_start
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, peak, t_elapsed
+
+
+if __name__ == '__main__':
+    print("{} scans x {} dp values".format(NUM_SCANS, NUM_DP_VALUES))
+    print("{:<6} {:>14} {:>14} {:>10}".format("", "held (MB)", "peak (MB)", "time (s)"))
+    for name, func in [("old", old_scans), ("new", new_scans)]:
+        # A fresh run each time, so the cached DataFrame isn't shared between the two
+        run_data = make_run_data()
+        _, current, peak, t_elapsed = measure(func, run_data)
+        print("{:<6} {:>14.1f} {:>14.1f} {:>10.2f}".format(name, current / 2**20, peak / 2**20, t_elapsed))
@@ -0,0 +1,94 @@
+"""
+Benchmark - the DMA transfer function of every channel of a scan as one TransferKernel
+
+For every export in data/, builds the transfer function of each channel of the scan (at the
+channel's voltage, for the run's flows, DMA and gas conditions) and checks that:
+    * it is the same as building one voltage at a time
+    * with and without diffusion they have the same area (diffusion only spreads the particles out)
+    * at high voltage, where diffusion hardly matters, they are nearly the same
+then times building the whole kernel at once against one voltage at a time.
+
+Run from the top of the repo:
+    python -m benchmarks.bench_transfer_kernel
+"""
+import glob
+import sys
+import timeit
+import warnings
+
+import numpy as np
+
+from htdma_code.model.files.read_file_utils import read_run_file
+from htdma_code.model.setupmods.setup import Setup
+from htdma_code.model.transfer_function import TransferKernel, channel_voltages
+
+NUM_REPEATS = 5
+
+# Number of points of the fine dp grid the areas are checked on
+NUM_FINE_DP = 2000
+
+# With and without diffusion, the areas match to this
+AREA_RTOL = 1e-2
+
+# Voltage above which the two transfer functions are nearly the same, and how close they are (of the peak)
+HIGH_VOLTAGE = 3000
+HIGH_VOLTAGE_ATOL = 0.1
+
+
+def kernel_args(setup: Setup) -> tuple:
+    """
+    :return: the flow, DMA and gas arguments of TransferKernel for a run
+    """
+    scan_params = setup.scan_params
+    dma = setup.dma_1_params
+    run_params = setup.run_params
+    return (scan_params.q_sh_lpm, scan_params.q_aIn_lpm, scan_params.q_aOut_lpm, scan_params.q_excess_lpm,
+            dma.length_cm, dma.radius_in_cm, dma.radius_out_cm, run_params.mean_free_path_m * 1e9,
+            run_params.mu_gas_viscosity_Pa_sec * 1e1, run_params.temp_k)
+
+
+def build_each(dp_range: np.ndarray, voltages: np.ndarray, args: tuple) -> np.ndarray:
+    """
+    Build the transfer function one voltage at a time
+    """
+    return np.array([TransferKernel(dp_range, v, *args).values[0] for v in voltages])
+
+
+if __name__ == '__main__':
+    warnings.simplefilter("ignore")
+    num_failed = 0
+    print("{:<45} {:>5} {:>10} {:>10} {:>8} {:>10}".format(
+        "file", "dp", "each (ms)", "all (ms)", "speedup", "area err"))
+    for filename in sorted(glob.glob("data/*.txt")):
+        run_data = read_run_file(filename)
+        setup = Setup()
+        setup.read_run_data(run_data)
+        args = kernel_args(setup)
+        dp_range = np.asarray(run_data.dp, dtype=float)
+        voltages = channel_voltages(dp_range, args[0], args[3], *args[4:9])
+
+        kernel = TransferKernel(dp_range, voltages, *args)
+        if not np.allclose(kernel.values, build_each(dp_range, voltages, args), rtol=1e-12, atol=1e-15):
+            print("MISMATCH {}: the kernel is not the same as one voltage at a time".format(filename))
+            num_failed += 1
+
+        # Areas on a fine grid that holds the whole transfer function of each channel
+        fine_dp = np.geomspace(dp_range[0] / 2, dp_range[-1] * 2, NUM_FINE_DP)
+        diffusing = TransferKernel(fine_dp, voltages, *args)
+        nondiffusing = TransferKernel(fine_dp, voltages, *args, is_diffusing=False)
+        area_diffusing = diffusing.values @ diffusing.log_dp_widths
+        area_nondiffusing = nondiffusing.values @ nondiffusing.log_dp_widths
+        area_error = float(np.max(np.abs(area_diffusing / area_nondiffusing - 1)))
+        if area_error > AREA_RTOL:
+            print("MISMATCH {}: the areas differ by {:.2e}".format(filename, area_error))
+            num_failed += 1
+        is_high = voltages > HIGH_VOLTAGE
+        if np.any(np.abs(diffusing.values[is_high] - nondiffusing.values[is_high]) > HIGH_VOLTAGE_ATOL):
+            print("MISMATCH {}: diffusion changes the transfer function above {} V".format(filename, HIGH_VOLTAGE))
+            num_failed += 1
+
+        t_each = min(timeit.repeat(lambda: build_each(dp_range, voltages, args), number=1, repeat=NUM_REPEATS))
+        t_all = min(timeit.repeat(lambda: TransferKernel(dp_range, voltages, *args), number=1, repeat=NUM_REPEATS))
+        print("{:<45} {:>5} {:>10.2f} {:>10.2f} {:>7.1f}x {:>10.2e}".format(
+            filename[-45:], dp_range.shape[0], t_each * 1e3, t_all * 1e3, t_each / t_all, area_error))
+    sys.exit(1 if num_failed else 0)
@@ -0,0 +1,81 @@
+"""
+Benchmark - converting electrical mobility to particle diameter
+
+Compares the old scalar fixed point loop (DMA_1._Zp_to_Dp, one Zp at a time) against the
+array valued Newton solver zp_to_dp, and against lookups in a cached MobilityTable, over a
+sweep of DMA 1 voltages. Reports the wall time and the largest difference to the old loop.
+
+Run from the top of the repo:
+    python -m benchmarks.bench_zp_to_dp
+"""
+import math
+import time
+
+import numpy as np
+
+from htdma_code.model.mobility import zp_to_dp, get_mobility_table, ELEM_CHARGE
+
+NUM_POINTS = 100000
+
+# TSI 3080 settings, the same as DMA_1(debug=True)
+LENGTH_CM = 44.44
+RADIUS_IN_CM = 0.937
+RADIUS_OUT_CM = 1.958
+Q_SH_CM3_SEC = 10.0 * 1000 / 60
+MEAN_FREE_PATH_NM = 68.0
+MU_GAS_VISCOSITY_POISE = 0.0001837
+
+
+def old_zp_to_dp(Zp, Cs=2, n_ch=1):
+    """
+    The scalar fixed point loop DMA_1._Zp_to_Dp used to run
+    """
+    def _compute_dp():
+        return (n_ch * ELEM_CHARGE * Cs) / (3 * math.pi * MU_GAS_VISCOSITY_POISE * Zp) * 1e7 * 1e1
+
+    dp = _compute_dp()
+    for _ in range(1000):
+        Cs = 1 + (MEAN_FREE_PATH_NM / dp) * (2.34 + 1.05*math.exp(-0.39 * (dp/MEAN_FREE_PATH_NM)))
+        last_dp = dp
+        dp = _compute_dp()
+        if math.fabs(last_dp - dp) < 0.1:
+            return dp
+    raise ValueError("Zp_to_dp: too many iterations!")
+
+
+def main():
+    voltage = np.geomspace(10, 10000, NUM_POINTS)
+    delta_axial = (LENGTH_CM * voltage) / np.log(RADIUS_OUT_CM / RADIUS_IN_CM)
+    Zp = (2 * Q_SH_CM3_SEC) / (4 * math.pi * delta_axial)
+
+    start = time.perf_counter()
+    dp_old = np.array([old_zp_to_dp(z) for z in Zp])
+    time_old = time.perf_counter() - start
+
+    start = time.perf_counter()
+    dp_new = zp_to_dp(Zp, MU_GAS_VISCOSITY_POISE, MEAN_FREE_PATH_NM)
+    time_new = time.perf_counter() - start
+
+    table = get_mobility_table(MEAN_FREE_PATH_NM, MU_GAS_VISCOSITY_POISE)
+    start = time.perf_counter()
+    dp_table = table.Zp_to_Dp(Zp)
+    time_table = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for z in Zp[:1000]:
+        table.Zp_to_Dp(z)
+    time_table_single = (time.perf_counter() - start) / 1000
+
+    print("{} points, dp {:.1f} - {:.1f} nm".format(NUM_POINTS, dp_new.min(), dp_new.max()))
+    print("Scalar loop:   {:8.3f} sec".format(time_old))
+    print("Newton arrays: {:8.3f} sec  ({:.0f}x)".format(time_new, time_old / time_new))
+    print("Table lookup:  {:8.3f} sec  ({:.0f}x)".format(time_table, time_old / time_table))
+    print("Single table lookup: {:.1f} usec".format(time_table_single * 1e6))
+    print("Max difference, Newton: {:.3f} nm".format(np.max(np.abs(dp_old - dp_new))))
+    print("Max difference, table:  {:.3f} nm".format(np.max(np.abs(dp_old - dp_table))))
+    print("Max relative difference, table vs Newton: {:.2e} (table midpoint error {:.2e}, Newton rtol 1e-10)".format(
+        np.max(np.abs(dp_table - dp_new) / dp_new), table.max_rel_error))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+batch - headless fitting of whole directories of AIM exports
+
+Fits every scan of every file matched by the given glob patterns, and writes the peaks
+of all of them to one consolidated CSV file. This never imports PySide2 or matplotlib,
+so it can run on machines without a display (e.g. for nightly processing).
+
+Usage (from the top of the repo):
+    python -m htdma_code.batch "data/*.txt" --peaks 2 --output results.csv
+"""
+import argparse
+import glob
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Tuple
+
+import pandas as pd
+
+import htdma_code.model.files.read_file_utils as read_file_utils
+import htdma_code.model.files.run_cache as run_cache
+from htdma_code.model.setupmods.setup import Setup
+from htdma_code.model.scans import Scans
+from htdma_code.model.charge_correction import get_run_charge_correction
+from htdma_code.model.scan import MAX_PEAKS_TO_FIT, AUTO_MAX_PEAKS, AUTO_CRITERIA, DEFAULT_AUTO_CRITERION
+from htdma_code.model.fit_cache import FitCache, DEFAULT_CACHE_DIR, FIT_CACHE_FILENAME
+
+DEFAULT_NUM_PEAKS = 2
+
+# Give this as the number of peaks to pick the number of peaks for each scan (see Scan.fit_auto)
+AUTO_NUM_PEAKS = "auto"
+DEFAULT_OUTPUT_FILENAME = "htdma_results.csv"
+
+# The number of files being processed (or waiting to be written out) at once, per worker.
+# This is what bounds the memory used, no matter how many files are matched
+FILES_IN_FLIGHT_PER_WORKER = 2
+
+# Columns of the consolidated results file
+RESULT_COLUMNS = ["file", "scan", "scan_id", "time_stamp", "peak", "dp", "height", "fwhh"]
+
+
+def parse_num_peaks(value: str):
+    """
+    Parse the number of peaks given on the command line
+
+    :return: the number of peaks, or None for AUTO_NUM_PEAKS
+    """
+    if value.strip().lower() == AUTO_NUM_PEAKS:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be a number or '{}'".format(AUTO_NUM_PEAKS))
+
+
+def find_files(patterns: List[str]) -> List[str]:
+    """
+    Expand glob patterns into a sorted list of files, without duplicates
+
+    :param patterns: glob patterns (or plain filenames)
+    :return: the list of matching files
+    """
+    filenames = set()
+    for pattern in patterns:
+        filenames.update(f for f in glob.glob(pattern, recursive=True) if os.path.isfile(f))
+    return sorted(filenames)
+
+
+def process_file(filename: str, num_peaks_desired: int, warm_start: bool = False,
+                 cache: FitCache = None, use_run_cache: bool = True, auto_max_peaks: int = AUTO_MAX_PEAKS,
+                 criterion: str = DEFAULT_AUTO_CRITERION,
+                 charge_correction: bool = False) -> Tuple[pd.DataFrame, int, int]:
+    """
+    Read in one run file, and fit every scan in it
+
+    :param filename: The file to process
+    :param num_peaks_desired: The number of peaks to fit to each scan, or None to pick it for each scan
+    :param warm_start: True to start each fit from the previous scan's fit (see Scans.fit_all)
+    :param cache: [Optional] a FitCache to look up fits in before fitting
+    :param use_run_cache: True to read (and write) the binary sidecar of the file (see run_cache)
+    :param auto_max_peaks: The most peaks to try, if num_peaks_desired is None
+    :param criterion: "aic" or "bic", to pick the number of peaks with if num_peaks_desired is None
+    :param charge_correction: True to correct the scans for multiply charged particles before fitting,
+                              unless the instrument already did (see charge_correction)
+    :return: (results, num_scans, num_failed) - a DataFrame with the RESULT_COLUMNS, one row
+    per fitted peak, the number of scans in the file, and the number of scans that failed to fit
+    """
+    if use_run_cache:
+        run_data = run_cache.read_run_file_cached(filename)
+    else:
+        run_data = read_file_utils.read_run_file(filename)
+
+    setup = Setup()
+    setup.read_run_data(run_data)
+    scans = Scans()
+    if charge_correction and not setup.run_params.is_charge_corrected:
+        scans.read_run_data(run_data, charge_correction=get_run_charge_correction(setup, run_data.dp))
+    else:
+        scans.read_run_data(run_data)
+
+    # We're already running in a worker, so fit the scans in this process
+    fit_result_set = scans.fit_all(num_peaks_desired, workers=1, warm_start=warm_start, cache=cache,
+                                   auto_max_peaks=auto_max_peaks, criterion=criterion)
+
+    df = fit_result_set.to_dataframe()
+    scan_indices = df["scan"].to_numpy() - 1
+    df.insert(0, "file", setup.basefilename)
+    df.insert(2, "scan_id", run_data.scan_ids[scan_indices])
+    df.insert(3, "time_stamp", run_data.time_stamps[scan_indices])
+    return df[RESULT_COLUMNS], run_data.get_num_scans(), len(fit_result_set.errors)
+
+
+def run_batch(filenames: List[str], output_filename: str, num_peaks_desired: int = DEFAULT_NUM_PEAKS,
+              workers: int = None, warm_start: bool = False, cache: FitCache = None,
+              use_run_cache: bool = True, verbose: bool = True, auto_max_peaks: int = AUTO_MAX_PEAKS,
+              criterion: str = DEFAULT_AUTO_CRITERION, charge_correction: bool = False) -> int:
+    """
+    Fit every scan of every file, and write all of the results to one CSV file.
+
+    Files are processed in parallel, with at most FILES_IN_FLIGHT_PER_WORKER files per
+    worker outstanding at once. Results are written out in the order of filenames as soon
+    as they are ready, so nothing accumulates in memory.
+
+    :param filenames: The files to process
+    :param output_filename: The CSV file to write
+    :param num_peaks_desired: The number of peaks to fit to each scan, or None to pick it for each scan
+    :param workers: The number of worker processes. Defaults to the number of CPUs
+    :param warm_start: True to start each fit from the previous scan's fit
+    :param cache: [Optional] a FitCache to look up fits in before fitting
+    :param use_run_cache: True to read (and write) the binary sidecars of the files (see run_cache)
+    :param verbose: True to print progress to stderr
+    :param auto_max_peaks: The most peaks to try, if num_peaks_desired is None
+    :param criterion: "aic" or "bic", to pick the number of peaks with if num_peaks_desired is None
+    :param charge_correction: True to correct the scans for multiply charged particles before fitting
+    :return: The number of files that could not be processed
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers < 1:
+        raise ValueError("Number of workers must be at least 1")
+    if num_peaks_desired is not None and (num_peaks_desired < 1 or num_peaks_desired > MAX_PEAKS_TO_FIT):
+        raise ValueError("Number of peaks must be between 1 and {}".format(MAX_PEAKS_TO_FIT))
+
+    max_in_flight = workers * FILES_IN_FLIGHT_PER_WORKER
+    num_failed_files = 0
+    num_rows = 0
+
+    # Results that finished before an earlier file did, waiting their turn to be written
+    finished = {}
+    i_next_to_write = 0
+    i_next_to_submit = 0
+
+    with open(output_filename, "w", newline="") as output_file, \
+            ProcessPoolExecutor(max_workers=workers) as executor:
+        pd.DataFrame(columns=RESULT_COLUMNS).to_csv(output_file, index=False)
+
+        in_flight = {}
+        while i_next_to_write < len(filenames):
+            # Keep the pool busy, as long as not too much is outstanding (including
+            # results still waiting to be written)
+            while i_next_to_submit < len(filenames) and \
+                    i_next_to_submit - i_next_to_write < max_in_flight:
+                future = executor.submit(process_file, filenames[i_next_to_submit],
+                                         num_peaks_desired, warm_start, cache, use_run_cache,
+                                         auto_max_peaks, criterion, charge_correction)
+                in_flight[future] = i_next_to_submit
+                i_next_to_submit += 1
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                finished[in_flight.pop(future)] = future
+
+            # Write out everything that is next in line
+            while i_next_to_write in finished:
+                future = finished.pop(i_next_to_write)
+                filename = filenames[i_next_to_write]
+                try:
+                    (df, num_scans, num_failed_scans) = future.result()
+                except Exception as e:
+                    num_failed_files += 1
+                    print("FAILED {}: {}".format(filename, e), file=sys.stderr)
+                else:
+                    df.to_csv(output_file, header=False, index=False)
+                    num_rows += df.shape[0]
+                    if verbose:
+                        print("{}: {} scans, {} peaks, {} failed fits".format(
+                            filename, num_scans, df.shape[0], num_failed_scans), file=sys.stderr)
+                i_next_to_write += 1
+
+    if verbose:
+        print("Wrote {} peaks from {} files to {}".format(
+            num_rows, len(filenames) - num_failed_files, output_filename), file=sys.stderr)
+    return num_failed_files
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m htdma_code.batch",
+                                     description="Fit every scan of a set of AIM export files, "
+                                                 "without starting the UI")
+    parser.add_argument("patterns", nargs="+",
+                        help="glob pattern(s) of the files to process, e.g. 'data/*.txt'")
+    parser.add_argument("-p", "--peaks", type=parse_num_peaks, default=DEFAULT_NUM_PEAKS,
+                        help="number of peaks to fit to each scan, or '{}' to pick it for each scan "
+                             "(default {})".format(AUTO_NUM_PEAKS, DEFAULT_NUM_PEAKS))
+    parser.add_argument("--max-peaks", type=int, default=AUTO_MAX_PEAKS,
+                        help="with --peaks {}, the most peaks to try (default {})".format(AUTO_NUM_PEAKS, AUTO_MAX_PEAKS))
+    parser.add_argument("--criterion", choices=AUTO_CRITERIA, default=DEFAULT_AUTO_CRITERION,
+                        help="with --peaks {}, how to score the candidates (default {})".format(
+                            AUTO_NUM_PEAKS, DEFAULT_AUTO_CRITERION))
+    parser.add_argument("--charge-correction", action="store_true",
+                        help="correct the scans for multiply charged particles before fitting "
+                             "(files the instrument already corrected are left as they are)")
+    parser.add_argument("-o", "--output", default=DEFAULT_OUTPUT_FILENAME,
+                        help="consolidated results CSV file (default {})".format(DEFAULT_OUTPUT_FILENAME))
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--warm-start", action="store_true",
+                        help="start each fit from the previous scan's fit")
+    parser.add_argument("--cache", default=None, metavar="PATH",
+                        help="fit cache database (default {})".format(os.path.join(DEFAULT_CACHE_DIR, FIT_CACHE_FILENAME)))
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always fit from scratch, and do not store the fits")
+    parser.add_argument("--no-sidecar", action="store_true",
+                        help="always parse the files, and do not write {} sidecars".format(run_cache.SIDECAR_SUFFIX))
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="do not print progress")
+    args = parser.parse_args(argv)
+
+    filenames = find_files(args.patterns)
+    if not filenames:
+        parser.error("no files match {}".format(" ".join(args.patterns)))
+
+    num_failed_files = run_batch(filenames, args.output,
+                                 num_peaks_desired=args.peaks,
+                                 workers=args.workers,
+                                 warm_start=args.warm_start,
+                                 cache=None if args.no_cache else FitCache(args.cache),
+                                 use_run_cache=not args.no_sidecar,
+                                 verbose=not args.quiet,
+                                 auto_max_peaks=args.max_peaks,
+                                 criterion=args.criterion,
+                                 charge_correction=args.charge_correction)
+    return 1 if num_failed_files else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
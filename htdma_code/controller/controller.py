@@ -10,6 +10,10 @@ class Controller:
         self.model = model
         self.main_view = main_view
         self.status_bar = main_view.statusBar()
+        self.results_table_model = main_view.results_table_model
+
+        # Scans added by following a file (fitted or not) go into the results table too
+        self.model.add_scans_added_listener(self.scans_added)
 
         # Set up the menu bindings
         self.main_view.file_open_action.triggered.connect(self.menu_file_open_action)
@@ -44,6 +48,7 @@ class Controller:
         if files:
             # read in the new file. Just use the first one. If they choose multiple files, ignore the rest
             self.model.process_new_file(files[0])
+            self.update_results_table_from_model()
             self.status_bar.showMessage("Read in file {}".format(files[0]))
 
             # Update the view
@@ -51,6 +56,23 @@ class Controller:
             # self.main_view.update_dma1_widget_views_from_model()
             # self.main_view.update_scan_widget_views_from_model()
 
+    def update_results_table_from_model(self):
+        """
+        Point the results table at the model's results, if the model has started new ones
+        (process_new_file and follow_file each do)
+        """
+        if self.model.total_results is not None and self.results_table_model.results is not self.model.total_results:
+            self.results_table_model.set_results(self.model.total_results)
+
+    def scans_added(self, first_scan_index: int, num_new_scans: int, fit_result_set):
+        """
+        Scans were added to the model by follow_file or poll_followed_file. Add their fitted
+        peaks (if they were fitted) to the results table
+        """
+        self.update_results_table_from_model()
+        if fit_result_set is not None:
+            self.results_table_model.add_fit_result_set(fit_result_set)
+
     def dma1_voltage_action(self):
         """
         User pressed enter on a new value for voltage for DMA 1. Thus, update the model, then update the entire
@@ -93,10 +115,21 @@ class Controller:
         if not self.model.current_scan:
             Qw.QMessageBox.warning(self.main_view,"No scans loaded!","Please load a file first")
         else:
-            self.model.current_scan.fit(num_peaks_desired=self.main_view.scan_form.scan_fit_num_peaks_spinbox.value())
+            num_peaks_desired = self.main_view.scan_form.scan_fit_num_peaks_spinbox.value()
+            if num_peaks_desired == 0:
+                # "Auto" - let the fit pick the number of peaks
+                self.model.current_scan.fit_auto()
+            else:
+                self.model.current_scan.fit(num_peaks_desired=num_peaks_desired)
+            try:
+                self.model.compute_hygroscopicity([self.model.current_scan.peak_fit_results],
+                                                  first_scan_index=self.model.current_scan_index)
+            except ValueError:
+                # e.g. DMA 1 has no dp yet. The growth factor and kappa are left blank
+                pass
             self.main_view.update_from_model()
 
-            self.model.total_results_table.add_scan_results(self.model.current_scan)
+            self.results_table_model.add_scan_results(self.model.current_scan)
 
             # self.main_view.update_scan_widget_views_from_model()
 
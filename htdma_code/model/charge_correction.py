@@ -0,0 +1,271 @@
+"""
+charge_correction - removing multiply charged particles from the scans
+
+A scan assigns every particle the diameter a singly charged particle of its mobility would
+have. A particle of diameter D carrying k charges has the mobility of a smaller singly charged
+particle, so the larger particles of a distribution also show up, k = 2, 3, ... times smaller
+in mobility, as extra counts at smaller dp (often as a spurious peak).
+
+Assuming the particles carry the bipolar charger's steady state charge distribution (as the
+instrument's own "Multiple Charge Correction" does), the measured distribution m (per channel,
+normalized as if every particle were singly charged) is linear in the true distribution n:
+
+    m = M n,   M[i, j] = delta_ij + sum over k >= 2 of
+                         integral over bin j of phi_k(D) Omega_i(Z_k(D)) dlogD / (phi_1(dp_i) W_i)
+
+where phi_k is the fraction of particles with k charges (Wiedensohler, 1988,
+https://doi.org/10.1016/0021-8502(88)90278-9, and Gunn's formula above 2 charges), Omega_i is
+the transfer function of channel i (see transfer_function), Z_k(D) the mobility of D with k
+charges, and W_i the integral of Omega_i over the singly charged particles, which the export
+already divided by. The singly charged term is kept as the identity, so the DMA's own
+resolution is left in the scans for the peak fits. Particles larger than the last channel
+are not known, and are left out.
+
+Multiply charged particles always land at smaller dp than their true size, so M is upper
+triangular with a unit diagonal, and always invertible. ChargeCorrection holds M^-1 for one
+dp grid, set of flows and gas conditions, so correcting a whole run is a single matrix product.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+from htdma_code.model.mobility import get_mobility_table
+from htdma_code.model.setupmods.setup import Setup
+from htdma_code.model.transfer_function import flow_parameters, nondiffusing_transfer, ELEMENTARY_CHARGE_C, \
+    BOLTZMANN_J_PER_K
+
+# Most charges on a particle to correct for
+DEFAULT_MAX_CHARGES = 6
+
+# TSI classifiers run with a negative center rod, which selects positively charged particles
+DEFAULT_POLARITY = 1
+
+# Wiedensohler's fit log10(phi_k) = sum a_i log10(D / nm)^i, for k = -2 ... 2 charges.
+# Valid from WIEDENSOHLER_MIN_DP_NM (the +-1 charges) or WIEDENSOHLER_MIN_DP_2_NM (+-2) up to WIEDENSOHLER_MAX_DP_NM
+WIEDENSOHLER_COEFFICIENTS = {
+    -2: (-26.3328, 35.9044, -21.4608, 7.0867, -1.3088, 0.1051),
+    -1: (-2.3197, 0.6175, 0.6201, -0.1105, -0.1260, 0.0297),
+    0: (-0.0003, -0.1014, 0.3073, -0.3372, 0.1023, -0.0105),
+    1: (-2.3484, 0.6044, 0.4800, 0.0013, -0.1553, 0.0320),
+    2: (-44.4756, 79.3772, -62.8900, 26.4492, -5.7480, 0.5049),
+}
+WIEDENSOHLER_MIN_DP_NM = 1.0
+WIEDENSOHLER_MIN_DP_2_NM = 20.0
+WIEDENSOHLER_MAX_DP_NM = 1000.0
+
+# Ratio of the positive to negative ion mobilities (times concentrations) in the charger, for Gunn's formula
+ION_MOBILITY_RATIO = 0.875
+
+# Vacuum permittivity (F/m), for Gunn's formula
+VACUUM_PERMITTIVITY_F_PER_M = 8.8541878128e-12
+
+# Number of points each channel's transfer function is integrated over
+NUM_TRANSFER_POINTS = 64
+
+# Number of corrections (i.e. different dp grids / flows / gas conditions) kept around
+MAX_CACHED_CORRECTIONS = 16
+
+
+def charging_probability(dp_nm, num_charges: int, temp_k: float):
+    """
+    The fraction of particles carrying num_charges charges after a bipolar charger. Wiedensohler's
+    fit is used for up to 2 charges inside its range, and Gunn's formula otherwise.
+
+    :param dp_nm: the particle diameter(s) in nanometers, a float or a numpy array
+    :param num_charges: the number of charges, negative for negatively charged particles
+    :param temp_k: the temperature (K), for Gunn's formula
+    :return: the fraction(s), the same shape as dp_nm
+    """
+    dp_nm = np.asarray(dp_nm, dtype=float)
+    if np.any(dp_nm <= 0):
+        raise ValueError("charging_probability - dp must be > 0")
+
+    # Gunn's formula - a gaussian in the number of charges
+    x = 2 * np.pi * VACUUM_PERMITTIVITY_F_PER_M * dp_nm * 1e-9 * BOLTZMANN_J_PER_K * temp_k / ELEMENTARY_CHARGE_C ** 2
+    phi = np.exp(-(num_charges - x * np.log(ION_MOBILITY_RATIO)) ** 2 / (2 * x)) / np.sqrt(2 * np.pi * x)
+
+    if num_charges in WIEDENSOHLER_COEFFICIENTS:
+        min_dp_nm = WIEDENSOHLER_MIN_DP_2_NM if abs(num_charges) == 2 else WIEDENSOHLER_MIN_DP_NM
+        is_in_range = (dp_nm >= min_dp_nm) & (dp_nm <= WIEDENSOHLER_MAX_DP_NM)
+        log_dp = np.log10(np.clip(dp_nm, min_dp_nm, WIEDENSOHLER_MAX_DP_NM))
+        log_phi = np.polynomial.polynomial.polyval(log_dp, WIEDENSOHLER_COEFFICIENTS[num_charges])
+        phi = np.where(is_in_range, 10 ** log_phi, phi)
+    return phi
+
+
+class ChargeCorrection:
+    """
+    ChargeCorrection removes the multiply charged particles from scans of one dp grid, set of
+    flows and gas conditions (see the top of this file)
+
+    Attributes:
+        * dp_range - the dp of each channel (nm), increasing
+        * max_charges - the most charges corrected for
+        * temp_k - the temperature the charging probabilities are for (K)
+        * polarity - 1 for positively charged particles, -1 for negative
+        * charging_probabilities - phi_k of each channel, shape (max_charges, n_dp). Row k - 1 is k charges
+        * matrix - the correction, shape (n_dp, n_dp). A (n_scans, n_dp) matrix of scans is
+                   corrected by conc @ matrix
+    """
+    def __init__(self, dp_range: np.ndarray, q_sh_lpm: float, q_aIn_lpm: float, q_aOut_lpm: float,
+                 q_excess_lpm: float, mean_free_path_nm: float, mu_gas_viscosity_poise: float, temp_k: float,
+                 max_charges: int = DEFAULT_MAX_CHARGES, polarity: int = DEFAULT_POLARITY):
+        """
+        :param dp_range: the dp of each channel (nm), increasing
+        :param q_sh_lpm: the sheath flow of the scanning DMA
+        :param q_aIn_lpm: the aerosol flow in
+        :param q_aOut_lpm: the sample flow out
+        :param q_excess_lpm: the excess flow
+        :param mean_free_path_nm: mean free path of the gas in nanometers
+        :param mu_gas_viscosity_poise: gas viscosity in Poise
+        :param temp_k: the temperature (K)
+        :param max_charges: the most charges to correct for
+        :param polarity: 1 for positively charged particles, -1 for negative
+        """
+        dp_range = np.asarray(dp_range, dtype=float)
+        if dp_range.ndim != 1 or dp_range.shape[0] < 2 or np.any(np.diff(dp_range) <= 0):
+            raise ValueError("ChargeCorrection: the dp values must be increasing")
+        if max_charges < 1:
+            raise ValueError("ChargeCorrection: max_charges must be >= 1")
+        if polarity not in (1, -1):
+            raise ValueError("ChargeCorrection: polarity must be 1 or -1")
+        self.dp_range = dp_range
+        self.max_charges = max_charges
+        self.temp_k = temp_k
+        self.polarity = polarity
+        self.charging_probabilities = np.array([charging_probability(dp_range, polarity * k, temp_k)
+                                                for k in range(1, max_charges + 1)])
+
+        (beta, delta) = flow_parameters(q_sh_lpm, q_aIn_lpm, q_aOut_lpm, q_excess_lpm)
+        tables = [get_mobility_table(mean_free_path_nm, mu_gas_viscosity_poise, k)
+                  for k in range(1, max_charges + 1)]
+        zp_center = tables[0].Dp_to_Zp(dp_range)
+
+        # What the export divided each channel by - its singly charged response to a flat dN/dlogDp
+        response = self.charging_probabilities[0] * \
+            self._integrate_channels(tables[0], zp_center, beta, delta, np.ones_like)[0]
+
+        num_dp = dp_range.shape[0]
+        measured_per_true = np.eye(num_dp)
+        for k in range(2, max_charges + 1):
+            phi = lambda dp_nm, k=k: charging_probability(dp_nm, polarity * k, temp_k)
+            (_, rows) = self._integrate_channels(tables[k - 1], zp_center, beta, delta, phi)
+            measured_per_true += rows / response[:, np.newaxis]
+        self.matrix = np.ascontiguousarray(np.linalg.inv(measured_per_true).T)
+
+    def __repr__(self):
+        s = "ChargeCorrection:\n"
+        s += "  dp: {:.1f} - {:.1f} nm ({} channels)\n".format(self.dp_range[0], self.dp_range[-1],
+                                                             self.dp_range.shape[0])
+        s += "  charges: up to {} ({})\n".format(self.max_charges, "+" if self.polarity > 0 else "-")
+        s += "  temp: {:.2f} K\n".format(self.temp_k)
+        return s
+
+    def apply(self, conc: np.ndarray) -> np.ndarray:
+        """
+        Correct scans for the multiply charged particles
+
+        Missing (NaN) values are taken as 0, so they don't spread to the other channels.
+        Channels can come out slightly negative where there are few counts. filter_bad_values
+        leaves those out of the fits like any other value <= 0.
+
+        :param conc: one scan, or a (n_scans, n_dp) matrix of them
+        :return: the corrected concentrations, the same shape as conc
+        """
+        conc = np.asarray(conc, dtype=float)
+        if conc.shape[-1] != self.dp_range.shape[0]:
+            raise ValueError("ChargeCorrection.apply - expected {} dp values, got {}".format(
+                self.dp_range.shape[0], conc.shape[-1]))
+        return np.where(np.isnan(conc), 0.0, conc) @ self.matrix
+
+    def _integrate_channels(self, table, zp_center: np.ndarray, beta: float, delta: float, phi) -> tuple:
+        """
+        Internal helper to integrate phi(D) Omega_i(Z(D)) dlogD for every channel i, over the
+        particles (with the charges of table) that channel passes
+
+        :param table: the MobilityTable for the number of charges
+        :param zp_center: the centroid mobility of each channel
+        :param phi: phi(dp_nm), the charging probability of the particles
+        :return: (the integral of each channel, shape (n_dp,),
+                  the same split over the dp bins the particles fall in, shape (n_dp, n_dp))
+        """
+        num_dp = self.dp_range.shape[0]
+
+        # The diameters passed by each channel, from its highest mobility to its lowest
+        zeta = np.linspace(1 + beta, 1 - beta, NUM_TRANSFER_POINTS)
+        log_dp = np.log(table.Zp_to_Dp(zp_center[:, np.newaxis] * zeta[np.newaxis, :]))
+        integrand = nondiffusing_transfer(zeta, beta, delta)[np.newaxis, :] * phi(np.exp(log_dp))
+
+        # Trapezoid weights of each point in log dp
+        step = np.diff(log_dp, axis=1)
+        weights = np.zeros_like(log_dp)
+        weights[:, 1:] += step / 2
+        weights[:, :-1] += step / 2
+        weights *= integrand
+
+        # Share each point between the two channels around it, linear in log dp. Points
+        # past the last channel are dropped
+        log_dp_range = np.log(self.dp_range)
+        position = np.interp(log_dp, log_dp_range, np.arange(num_dp), left=0.0, right=np.nan)
+        is_known = np.isfinite(position)
+        low = np.minimum(np.floor(np.nan_to_num(position)).astype(np.intp), num_dp - 2)
+        frac = np.where(is_known, np.nan_to_num(position) - low, 0.0)
+        weights = np.where(is_known, weights, 0.0)
+
+        rows = np.zeros((num_dp, num_dp))
+        channel = np.repeat(np.arange(num_dp), NUM_TRANSFER_POINTS)
+        np.add.at(rows, (channel, low.ravel()), (weights * (1 - frac)).ravel())
+        np.add.at(rows, (channel, low.ravel() + 1), (weights * frac).ravel())
+        return weights.sum(axis=1), rows
+
+
+@lru_cache(maxsize=MAX_CACHED_CORRECTIONS)
+def _get_charge_correction(dp_range: tuple, flows: tuple, mean_free_path_nm: float,
+                           mu_gas_viscosity_poise: float, temp_k: float, max_charges: int,
+                           polarity: int) -> ChargeCorrection:
+    """
+    INTERNAL FUNCTION -
+    The cached part of get_charge_correction. The dp values and flows are tuples, so they can be hashed
+    """
+    return ChargeCorrection(np.array(dp_range), *flows, mean_free_path_nm, mu_gas_viscosity_poise, temp_k,
+                            max_charges=max_charges, polarity=polarity)
+
+
+def get_charge_correction(dp_range: np.ndarray, q_sh_lpm: float, q_aIn_lpm: float, q_aOut_lpm: float,
+                          q_excess_lpm: float, mean_free_path_nm: float, mu_gas_viscosity_poise: float,
+                          temp_k: float, max_charges: int = DEFAULT_MAX_CHARGES,
+                          polarity: int = DEFAULT_POLARITY) -> ChargeCorrection:
+    """
+    Get the ChargeCorrection for a dp grid, set of flows and gas conditions. Corrections are
+    only built the first time they are asked for, and the most recently used
+    MAX_CACHED_CORRECTIONS are kept (across runs).
+
+    See ChargeCorrection for the arguments.
+
+    :return: the ChargeCorrection
+    """
+    flows = (float(q_sh_lpm), float(q_aIn_lpm), float(q_aOut_lpm), float(q_excess_lpm))
+    return _get_charge_correction(tuple(np.asarray(dp_range, dtype=float).tolist()), flows,
+                                  float(mean_free_path_nm), float(mu_gas_viscosity_poise), float(temp_k),
+                                  int(max_charges), int(polarity))
+
+
+def get_run_charge_correction(setup: Setup, dp_range: np.ndarray,
+                              max_charges: int = DEFAULT_MAX_CHARGES) -> ChargeCorrection:
+    """
+    Get the ChargeCorrection for the scans of a run, from the flows of its (current) scan and its
+    gas conditions. Check setup.run_params.is_charge_corrected first - the instrument may already
+    have corrected the scans.
+
+    :param setup: the Setup of the run
+    :param dp_range: the dp values of the run
+    :param max_charges: the most charges to correct for
+    :return: the ChargeCorrection
+    """
+    scan_params = setup.scan_params
+    run_params = setup.run_params
+    # 1 P = 10 Pa * s, and the mean free path is in m
+    return get_charge_correction(dp_range, scan_params.q_sh_lpm, scan_params.q_aIn_lpm, scan_params.q_aOut_lpm,
+                                 scan_params.q_excess_lpm, run_params.mean_free_path_m * 1e9,
+                                 run_params.mu_gas_viscosity_Pa_sec * 1e1, run_params.temp_k,
+                                 max_charges=max_charges)
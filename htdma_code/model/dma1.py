@@ -1,35 +1,20 @@
-import matplotlib.pyplot as plt
 import numpy as np
-import math
-from matplotlib.ticker import FormatStrFormatter
 
 from htdma_code.model.setupmods.setup import Setup
-from htdma_code.model.scans import Scans
-
-# ELEM_CHARGE is the elementary charge of a particle in Columb.
-# Coulumb is in m-kg-sec, so multiply by 1e5 to get in our cm-g-sec
-# THEN, 1 Columb = 10^-1 statcoulumb, so multiply by 10
-#ELEM_CHARGE = 1.602e-19 * 1e5
-ELEM_CHARGE = 1.602e-19 * 1e5 * 1e1
-#ELEM_CHARGE = 1.602176634e-19 * 10e5
-
-# From wikipedia - proper value for cgs.... statcoulumbs?!?!
-#ELEM_CHARGE = 4.80320425e-10
-
-#TODO ERROR! Verify ELEM_CHARGE value. Something seems incorrect
+from htdma_code.model.mobility import MIN_DP_CHECK, MAX_DP_CHECK, cunningham_slip_correction, get_mobility_table
+from htdma_code.model.transfer_function import TransferKernel, lpm_to_cm3_per_sec, centroid_mobility, \
+    diffusion_sigma, flow_parameters, get_transfer_kernel
 
 """
 See the following for an example of what dp should be for certain dma values
 https://www.tandfonline.com/doi/full/10.1080/02786826.2019.1642443
 """
-def lpm_to_cm3_per_sec(lpm):
-    """
-    Convert liters per minute to cubic cm per second
 
-    :param lpm: A flow specified in liters per minute
-    :return: The same flow in cubic cm per second
-    """
-    return lpm*1000/60
+# Number of dp values the theoretical distribution is computed at
+NUM_DIST_POINTS = 201
+
+# How far past the edges of the transfer function (in units of the diffusion sigma) the distribution goes
+DIST_SIGMA_MARGIN = 4
 
 class DMA_1:
     """
@@ -38,6 +23,13 @@ class DMA_1:
     This class encapsulates DMA 1, which is the non-scanning, static DMA in a TDMA setup. This is the DMA that the
     polydisperse flow comes into. We'll store only the parameters set by DMA 1. We will also generate the
     theoretical plot for DMA 1.
+
+    The theoretical distribution is DMA 1's transfer function (see transfer_function), with and without
+    diffusion, on NUM_DIST_POINTS dp values around the center:
+        * dp_dist - the dp values (nm)
+        * transfer_dist - the diffusing transfer function at each of them
+        * transfer_dist_nondiffusing - the transfer function without diffusion
+    dp_dist_left_bottom and dp_dist_right_bottom are where the transfer function without diffusion goes to 0.
     """
     DEFAULT_VOLTAGE = 5000.0
 
@@ -92,9 +84,6 @@ class DMA_1:
         # Other parameters that need to be set by the user
         self.voltage = self.DEFAULT_VOLTAGE
 
-        # Initial cunningham slip correction
-        self.init_Cs = 2
-
         # Initial number of charges
         self.n_ch = 1
 
@@ -102,6 +91,9 @@ class DMA_1:
         self.dp_dist_center = None
         self.dp_dist_left_bottom = None
         self.dp_dist_right_bottom = None
+        self.dp_dist = None
+        self.transfer_dist = None
+        self.transfer_dist_nondiffusing = None
 
         # Update the dp values
         self._compute_theoretical_dist()
@@ -170,17 +162,17 @@ class DMA_1:
                 self.dp_dist_center = None
                 self.dp_dist_left_bottom = None
                 self.dp_dist_right_bottom = None
+                self.dp_dist = None
+                self.transfer_dist = None
+                self.transfer_dist_nondiffusing = None
 
     def _compute_theoretical_dist(self, verbose=False):
         """
         Compute the theoretical distribution of DMA 1 based on parameters encapsulated
-        inside this object. This includes computing the center dp value, and the full width
-        half height values.
+        inside this object. This includes computing the center dp value, the dp values where the
+        transfer function without diffusion goes to 0, and the transfer function around them.
 
-        This function expects that the init_Cs and n_ch values have been set correctly
-        before calling.
-        * init_Cs: The initial value of Cunningham slip specified. For most
-        problems the default of 2 is acceptable
+        This function expects that the n_ch value has been set correctly before calling.
         * n_ch:    number of elementary charges on particle
 
         :param verbose: Debug output
@@ -195,105 +187,103 @@ class DMA_1:
         if verbose:
             print("Zp = {}, Zp_fwhh = {}".format(Zp, Zp_fwhh))
 
-        Cs = self.init_Cs  # Initial value for Cs
-
-        # Now, compute the corresponding dp
-        self.dp_dist_center = self._Zp_to_Dp(Zp, Cs=self.init_Cs, n_ch=self.n_ch, verbose=verbose)
+        # Now, compute the corresponding dp, along with the bottom points for the triangle.
+        # NOTE - electrical mobility and dp have an inverse relationship. Thus, we are
+        # flipping these (i.e. adding to the center to get the left, vice versa for right)
+        (self.dp_dist_center, self.dp_dist_left_bottom, self.dp_dist_right_bottom) = \
+            self.Zp_to_Dp(np.array([Zp, Zp + Zp_fwhh, Zp - Zp_fwhh])).tolist()
+
+        # The transfer function, out to where diffusion stops mattering
+        (beta, _) = flow_parameters(self.q_sh_lpm, self.q_aIn_lpm, self.q_aOut_lpm, self.q_excess_lpm)
+        sigma = diffusion_sigma(self.voltage, self.setup.run_params.temp_k, *self._get_geometry(), n_ch=self.n_ch)
+        zeta_margin = beta + DIST_SIGMA_MARGIN * sigma
+        table = get_mobility_table(self.mean_free_path_nm, self.mu_gas_viscosity_poise, self.n_ch)
+        (dp_min, dp_max) = np.clip(table.Zp_to_Dp(np.array([Zp * (1 + zeta_margin), Zp * max(1 - zeta_margin, beta)])),
+                                   MIN_DP_CHECK, MAX_DP_CHECK)
+        self.dp_dist = np.geomspace(dp_min, dp_max, NUM_DIST_POINTS)
+        self.transfer_dist = self.get_transfer_kernel(self.dp_dist).values[0]
+        self.transfer_dist_nondiffusing = self.get_transfer_kernel(self.dp_dist, is_diffusing=False).values[0]
 
         if verbose:
-            print("Dp (init value of Cs = 2) = {}".format(self.dp_dist_center))
+            print("Dp = {}".format(self.dp_dist_center))
 
-        # Compute the bottom points for the triangle. NOTE - electrical mobility
-        # and dp have an inverse relationship. Thus, we are flipping these (i.e.
-        # adding to the center to get the left, vice versa for right)
-        self.dp_dist_left_bottom = self._Zp_to_Dp(Zp + Zp_fwhh, Cs=self.init_Cs, n_ch=self.n_ch, verbose=verbose)
-        self.dp_dist_right_bottom = self._Zp_to_Dp(Zp - Zp_fwhh, Cs=self.init_Cs, n_ch=self.n_ch, verbose=verbose)
+    def get_transfer_kernel(self, dp_range: np.ndarray, voltages=None, is_diffusing: bool = True) -> TransferKernel:
+        """
+        Get DMA 1's transfer function on a dp grid, for its flows, dimensions and gas conditions, at
+        one voltage or a whole array of them. It is cached (see transfer_function.get_transfer_kernel),
+        so it can be convolved with distributions over and over without being computed again.
+
+        :param dp_range: the dp grid (nm), increasing
+        :param voltages: [Optional] the voltage(s). Defaults to self.voltage
+        :param is_diffusing: True to include diffusion
+        :return: the TransferKernel, with one row of values per voltage
+        """
+        if voltages is None:
+            voltages = self.voltage
+        return get_transfer_kernel(dp_range, voltages, self.q_sh_lpm, self.q_aIn_lpm, self.q_aOut_lpm,
+                                   self.q_excess_lpm, *self._get_geometry(), self.mean_free_path_nm,
+                                   self.mu_gas_viscosity_poise, self.setup.run_params.temp_k, n_ch=self.n_ch,
+                                   is_diffusing=is_diffusing)
+
+    def _get_geometry(self) -> tuple:
+        """
+        INTERNAL FUNCTION -
+        :return: (length, inner radius, outer radius) of DMA 1, in cm
+        """
+        params = self.setup.dma_1_params
+        return params.length_cm, params.radius_in_cm, params.radius_out_cm
 
-    def _compute_Zp(self):
+    def _compute_Zp(self, voltage=None):
         """
         INTERNAL FUNCTION -
         Compute Zp - the center of electrical mobility, and the full width
         half height value (fwhh)
 
+        :param voltage: The voltage (or a numpy array of voltages). Defaults to self.voltage
         :return: (Zp, full_width_half_height)
         """
-        delta_axial = (self.setup.dma_1_params.length_cm * self.voltage) / np.log(self.setup.dma_1_params.radius_out_cm / self.setup.dma_1_params.radius_in_cm)
-        # delta_axial = (DMA_Length_cm * V) / np.log(Radius_outer_cm/Radius_inner_cm)
-        Zp_center  = (self._q_sh_cm3_sec + self._q_excess_cm3_sec) / (4 * math.pi * delta_axial)
+        if voltage is None:
+            voltage = self.voltage
+        Zp_center = centroid_mobility(voltage, self.q_sh_lpm, self.q_excess_lpm, *self._get_geometry())
         Zp_fwhh    = (self._q_aIn_cm3_sec + self._q_aOut_cm3_sec) / (self._q_sh_cm3_sec + self._q_excess_cm3_sec) * Zp_center
         return (Zp_center, Zp_fwhh)
 
-    def _Zp_to_Dp(self,Zp,Cs,n_ch,verbose):
-        """
-        This function computes the particle diameter Dp in nanometers from
-        electrical mobility Zp.
-
-        This calculation is all from DMA literature based on quite a number
-        of variables. However, what we're going to do is a bit of a
-        kludgy close approximation in the Cunningham slip correction, Cs.
-        It itself a function of Dp, thus making this equation rather
-        non-straightforward to compute.
-
-        :param Zp:      center of electrical mobility
-        :param Cs:      Cunningham slip correction
-        :param n_ch:    number of elementary charges on particle
-        :param verbose: True if printing progress to console, False to suppress
-        :return:        The particle diameter Dp related to the specified Zp
+    def Zp_to_Dp(self, Zp):
         """
+        Compute the particle diameter Dp in nanometers from electrical mobility Zp,
+        using the gas conditions and number of charges of this DMA.
 
-        def _compute_dp():
-            """
-            THis is an internal helper function - never meant to be called
-            outside of the main function!
-            :return:
-            """
-            dp = (n_ch * ELEM_CHARGE * Cs) / (3 * math.pi * self.mu_gas_viscosity_poise * Zp)
-            #dp *= 1e7 # convert from cm to nm
-            #TODO ERROR! This is not the correct conversion!
-            dp *= 1e7 * 1e1
-            return dp
-
-        # For the time, we're going to iterate back and forth until we converge
-        # in on an answer:
-        DELTA_DP = 0.1
-        MAX_ITERATIONS = 1000
-        MIN_DP_CHECK = 1
-        MAX_DP_CHECK = 15000
-        step_num = 0
-        dp = _compute_dp()
-
-        while True:
-            Cs = self._Cunningham_slip_correction(dp)
-            last_dp = dp
-            dp = _compute_dp()
-            if dp < MIN_DP_CHECK:
-                raise ValueError("Zp_to_dp: {:.1f} too small. Check input values".format(dp))
-            if dp > MAX_DP_CHECK * 10:
-                raise ValueError("Zp_to_dp: {:.1f} too large. Check input values".format(dp))
-            if math.fabs(last_dp - dp) < DELTA_DP:
-                break
-            step_num += 1
-            if step_num > MAX_ITERATIONS:
-                raise ValueError("Zp_to_dp: too many iterations!")
-
-            if verbose:
-                print("Cs (pass {}) = {}".format(step_num,Cs))
-                print("Dp (pass {}) = {}".format(step_num,dp))
-
-        if dp > MAX_DP_CHECK:
-            raise ValueError("Zp_to_dp: {:.1f} too large. Check input values".format(dp))
+        The lookup goes through the cached MobilityTable for these gas conditions, so
+        only the first call for a given run (or gas) builds anything.
 
+        :param Zp: center of electrical mobility, a float or a numpy array
+        :return: The particle diameter(s) Dp related to the specified Zp
+        """
+        table = get_mobility_table(self.mean_free_path_nm, self.mu_gas_viscosity_poise, self.n_ch)
+        dp = table.Zp_to_Dp(Zp)
+        if np.any(dp < MIN_DP_CHECK):
+            raise ValueError("Zp_to_dp: {:.1f} too small. Check input values".format(np.min(dp)))
+        if np.any(dp > MAX_DP_CHECK):
+            raise ValueError("Zp_to_dp: {:.1f} too large. Check input values".format(np.max(dp)))
         return dp
 
+    def voltage_to_dp(self, voltage):
+        """
+        Compute the center dp for a voltage, or for a whole numpy array of voltages
+        (e.g. a full voltage sweep) in one call
+
+        :param voltage: The voltage(s) of DMA 1
+        :return: The center dp value(s) in nanometers
+        """
+        (Zp, _) = self._compute_Zp(np.asarray(voltage, dtype=float))
+        return self.Zp_to_Dp(Zp)
+
     def _Cunningham_slip_correction(self,dp):
         """
         Compute the Cunningham slip correction factor based on a specified
         particle diameter, dp, specified in nanometers.
         """
-
-        Cs = 1 + (self.mean_free_path_nm / dp) * \
-             (2.34 + 1.05*math.exp(-0.39 * (dp/self.mean_free_path_nm)))
-        return Cs
+        return cunningham_slip_correction(dp, self.mean_free_path_nm)
 
     def get_dp(self):
         """
@@ -303,47 +293,3 @@ class DMA_1:
         if not self.dp_dist_center:
             raise ValueError("ERROR - dp not computed yet, or voltage_lineedit changed without computing new dp")
         return self.dp_dist_center
-
-    def plot(self, ax: plt.Axes):
-        """
-        Create the distribution plot for DMA 1
-
-        :param ax: The Axes object to plot on
-
-        """
-
-        x = [self.dp_dist_left_bottom, self.dp_dist_center, self.dp_dist_right_bottom]
-        y = [0, 1, 0]
-
-        # TODO - Fix the center height
-
-        ax.set_xscale('log')
-        if self.dp_dist_center:
-            x_min = self.dp_dist_center // 100 * 100 - 100
-            if x_min <= 0:
-                x_min = 5
-            x_max = self.dp_dist_center // 100 * 100 + 200
-        else:
-            # Default values if dp has not been calculated
-            x_min = 300
-            x_max = 1000
-
-        if x_min > 300:
-            x_min = 300
-
-        if x_min >= 100:
-            x_ticks = 100
-        else:
-            x_ticks = 10
-
-        ax.set_xlim(x_min, x_max)
-        ax.set_xticks(np.arange(x_min, x_max, x_ticks))
-        ax.xaxis.set_major_formatter(FormatStrFormatter('%.0f'))
-
-        # TODO - Set "Dp" for x axis echo_label
-        ax.set_ylim(0, 1)
-        ax.set_title("DMA 1 theoretical distribution")
-        ax.plot(x, y)
-        ax.grid(True)
-
-
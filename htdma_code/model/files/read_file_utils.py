@@ -4,11 +4,12 @@ information from files
 """
 
 import numpy as np
-import pandas as pd
 import csv
 import sys
 import math
 
+from htdma_code.model.files.run_data import RunData
+
 #Let's define hard coded rows for info
 
 # Row info for TSI 3080 output
@@ -60,175 +61,485 @@ KEY_TOTAL_CONC = "Total Concentration"
 DATA_FILE_VERSION_1 = 1
 DATA_FILE_VERSION_2 = 2
 
-start_dp_row = -1
-end_dp_row = -1
-start_scan_data_row = -1
-end_scan_data_row = -1
-data_file_version = -1
-
+# All AIM exports are written out by Windows in this encoding
+FILE_ENCODING = "ISO-8859-1"
+
+# Format of the Date and Start Time rows of an export, joined with a space
+TIME_STAMP_FORMAT = "%m/%d/%y %H:%M:%S"
+
+# Version 2 files use different row labels for the scan parameters. Map them to the original
+V2_ROW_LABELS = {"Scan Time (s)": KEY_SCAN_UP_TIME,
+                 "Retrace Time (s)": KEY_SCAN_RETRACE_TIME,
+                 "Sheath Flow (L/min)": KEY_SHEATH_FLOW,
+                 "Aerosol Flow (L/min)": KEY_AEROSOL_IN_FLOW,
+                 "Low Voltage (V)": KEY_LOW_V,
+                 "High Voltage (V)": KEY_HIGH_V,
+                 "Lower Size (nm)": KEY_LOW_DP_NM,
+                 "Upper Size (nm)": KEY_HIGH_DP_NM,
+                 "Diameter Midpoint (nm)": "Diameter Midpoint"}
+
+# Version 2 files have some extra rows we're not using at the moment
+V2_UNUSED_ROWS = ["Sample Temp (C)",
+                  "Sample Pressure (kPa)",
+                  "Relative Humidity (%)",
+                  "Mean Free Path (m)",
+                  "Gas Viscosity (Pa*s)"]
+
+def _parse_setup_row(row: list, dict_result: dict, data_file_version: int) -> bool:
+    """
+    INTERNAL FUNCTION -
+    Check whether a row of the file holds one of the setup values we need, and if so,
+    store it in dict_result
+
+    :param row: a row of the file, already split into fields
+    :param dict_result: the setup dictionary being filled in
+    :param data_file_version: the version of the file being read
+    :return: True if the row was a setup value, False otherwise
+    """
+    if KEY_DMA_RADIUS_IN in row[0]:
+        val = float(row[1])
+        if data_file_version == DATA_FILE_VERSION_1:
+            val *= 100 # kludge fix because of cm vs. m bug?
+        dict_result["DMA_1_RADIUS_IN_CM"] = val
+    elif KEY_DMA_RADIUS_OUT in row[0]:
+        val = float(row[1])
+        if data_file_version == DATA_FILE_VERSION_1:
+            val *= 100 # kludge fix because of cm vs. m bug?
+        dict_result["DMA_1_RADIUS_OUT_CM"] = val
+    elif KEY_DMA_LENGTH in row[0]:
+        val = float(row[1])
+        if data_file_version == DATA_FILE_VERSION_1:
+            val *= 100
+        dict_result["DMA_1_LENGTH_CM"] = val
+    elif KEY_DMA_GAS_VISCOSITY in row[0]:
+        dict_result["MU_GAS_VISCOSITY_Pa_Sec"] = float(row[1])
+    elif KEY_DMA_GAS_DENSITY in row[0]:
+        dict_result["GAS_DENSITY"] = float(row[1])
+    elif KEY_DMA_MEAN_FREE_PATH in row[0]:
+        dict_result["MEAN_FREE_PATH_M"] = float(row[1])
+    elif KEY_DMA_REF_TEMP in row[0]:
+        dict_result["REF_TEMP_K"] = float(row[1])
+    elif KEY_DMA_REF_PRES in row[0]:
+        dict_result["REF_PRES_kPa"] = float(row[1])
+    elif KEY_DMA_MULT_CHARGE_CORRECTION in row[0]:
+        dict_result["MULT_CHARGE_CORRECTION"] = row[1].strip().upper() == "TRUE"
+    else:
+        return False
+    return True
+
+def _is_total_conc_row(label: str, data_file_version: int) -> bool:
+    """
+    INTERNAL FUNCTION -
+    :return: True if the row label marks the last row of the scan block
+    """
+    if data_file_version == DATA_FILE_VERSION_1:
+        return "Total Concentration" in label
+    return "Total Conc." in label
 
-def read_setup(filename: str) -> dict:
+def _to_float_matrix(rows: list) -> np.ndarray:
+    """
+    INTERNAL FUNCTION -
+    Convert a list of rows of strings into a float64 matrix. Blank or garbage cells
+    become NaN, just like pandas would have done.
     """
-    Read in the first 18 rows of the data file using pandas read_csv
+    try:
+        return np.array(rows, dtype=np.float64)
+    except ValueError:
+        # Imported here, so the model layer imports without pandas (see benchmarks/bench_import_time.py)
+        import pandas as pd
+        flat = pd.to_numeric(pd.Series([v for row in rows for v in row]), errors="coerce")
+        return flat.to_numpy(dtype=np.float64).reshape(len(rows), -1)
 
-    Params:
-    * filename - a string representing the file to read in
 
-    Returns:
-    * A pandas DataFrame containing the keyed info we need
+def get_scan_columns(sample_row: list) -> list:
     """
+    :param sample_row: the "Sample #" row of a file, split into fields
+    :return: the indices of the columns of the row that hold a scan (newer files pad
+    the rows with empty columns)
+    """
+    return [i for i in range(1, len(sample_row)) if sample_row[i].strip() != ""]
 
-    dict_result = {}
+def parse_header(lines) -> tuple:
+    """
+    Read the header block of a file (everything above "Sample #"), and the "Sample #" row itself.
+    Nothing after the "Sample #" row is consumed from lines.
+
+    :param lines: an iterator over the lines of the file
+    :return: (data_file_version, dict_setup, sample_row, row_num) - sample_row is the "Sample #"
+    row split into fields (None if it was not found), and row_num is its row number (1 based)
+    """
+    version = DATA_FILE_VERSION_1
+    dict_setup = {}
     row_num = 0
-    global start_scan_data_row, end_scan_data_row, start_dp_row, end_dp_row, data_file_version
-
-    # Let's assume the data file version is original
-    data_file_version = DATA_FILE_VERSION_1
-
-    with open(filename, mode='r') as infile:
-        reader = csv.reader(infile, delimiter='\t')
-        for row in reader:
-            row_num += 1
-            #print(row_num, row)
-
-            if "AIM Version" in row[0]:
-                data_file_version = DATA_FILE_VERSION_2
-            elif KEY_DMA_RADIUS_IN in row[0]:
-                val = float(row[1])
-                if data_file_version == DATA_FILE_VERSION_1:
-                    val *= 100 # kludge fix because of cm vs. m bug?
-                dict_result["DMA_1_RADIUS_IN_CM"] = val
-            elif KEY_DMA_RADIUS_OUT in row[0]:
-                val = float(row[1])
-                if data_file_version == DATA_FILE_VERSION_1:
-                    val *= 100 # kludge fix because of cm vs. m bug?
-                dict_result["DMA_1_RADIUS_OUT_CM"] = val
-            elif KEY_DMA_LENGTH in row[0]:
-                val = float(row[1])
-                if data_file_version == DATA_FILE_VERSION_1:
-                    val *= 100
-                dict_result["DMA_1_LENGTH_CM"] = val
-            elif KEY_DMA_GAS_VISCOSITY in row[0]:
-                dict_result["MU_GAS_VISCOSITY_Pa_Sec"] = float(row[1])
-            elif KEY_DMA_GAS_DENSITY in row[0]:
-                dict_result["GAS_DENSITY"] = float(row[1])
-            elif KEY_DMA_MEAN_FREE_PATH in row[0]:
-                dict_result["MEAN_FREE_PATH_M"] = float(row[1])
-            elif KEY_DMA_REF_TEMP in row[0]:
-                dict_result["REF_TEMP_K"] = float(row[1])
-            elif KEY_DMA_REF_PRES in row[0]:
-                dict_result["REF_PRES_kPa"] = float(row[1])
-            elif "Sample #" in row[0]:
-                start_scan_data_row = row_num
-            elif "Diameter Midpoint" in row[0]:
+    for line in lines:
+        row_num += 1
+        row = line.rstrip('\r\n').split('\t')
+        if "AIM Version" in row[0]:
+            version = DATA_FILE_VERSION_2
+        elif "Sample #" in row[0]:
+            # Checking for gas density, since some files sent over did not include this...
+            if "GAS_DENSITY" not in dict_setup:
+                dict_setup["GAS_DENSITY"] = DEF_DMA_GAS_DENSITY
+            return version, dict_setup, row, row_num
+        else:
+            _parse_setup_row(row, dict_setup, version)
+    return version, dict_setup, None, row_num
+
+def parse_scan_block(lines, scan_columns: list, row_num: int, data_file_version: int) -> tuple:
+    """
+    Read the rows below "Sample #", down through the total concentration row, keeping only
+    the given scan columns.
+
+    :param lines: an iterator over the lines of the file, positioned just after the "Sample #" row
+    :param scan_columns: the indices of the columns to read
+    :param row_num: the row number of the "Sample #" row
+    :param data_file_version: the version of the file being read
+    :return: (scan_header_rows, dp_labels, dp_rows, scan_meta, row_markers), where row_markers is
+    (start_dp_row, end_dp_row, end_scan_data_row). None if the total concentration row was not found
+    """
+    # The sections of the scan block, in the order we walk through them
+    IN_SCAN_HEADER, IN_DP_ROWS, IN_SCAN_PARAMS = range(3)
+
+    scan_header_rows = {}
+    dp_labels = []
+    dp_rows = []
+    scan_meta = {}
+    start_dp_row = -1
+    end_dp_row = -1
+
+    section = IN_SCAN_HEADER
+    for line in lines:
+        row_num += 1
+        row = line.rstrip('\r\n').split('\t')
+        label = row[0]
+        values = [row[i] if i < len(row) else "" for i in scan_columns]
+
+        if section == IN_SCAN_HEADER:
+            if "Diameter Midpoint" in label:
                 start_dp_row = row_num + 1
-            elif "Scan" in row[0] and "Time" in row[0]:
+                section = IN_DP_ROWS
+            else:
+                scan_header_rows[label] = values
+        elif section == IN_DP_ROWS:
+            if "Scan" in label and "Time" in label:
                 end_dp_row = row_num - 1
-            elif data_file_version == DATA_FILE_VERSION_1 and "Total Concentration" in row[0]:
-                end_scan_data_row = row_num
-            elif data_file_version == DATA_FILE_VERSION_2 and "Total Conc." in row[0]:
-                end_scan_data_row = row_num
-
-    # Checking for gas density, since some files sent over did not include this...
-    if "GAS_DENSITY" not in dict_result:
-        dict_result["GAS_DENSITY"] = DEF_DMA_GAS_DENSITY
-
-    # df = pd.read_csv(filename,
-    #                  header=None,
-    #                  sep='\t',
-    #                  index_col=0,
-    #                  nrows=18,
-    #                  encoding = "ISO-8859-1")
-
-    # dict_result = {}
-    # NOTE - The downloaded file shows this as cm, but the numbers in the file are clearly m
-    # self.dma_1.radius_in_cm = float(df.iloc[ROW_DMA_RADIUS_IN,0])
-    # self.dma_1.radius_out_cm = float(df.iloc[ROW_DMA_RADIUS_OUT,0])
-    # self.dma_1.length_cm = float(df.iloc[ROW_DMA_LENGTH, 0])
-    # dict_result["DMA_1_RADIUS_IN_CM"] = float(df.iloc[ROW_DMA_RADIUS_IN, 0]) * 100
-    # dict_result["DMA_1_RADIUS_OUT_CM"] = float(df.iloc[ROW_DMA_RADIUS_OUT,0]) * 100
-    # dict_result["DMA_1_LENGTH_CM"] = float(df.iloc[ROW_DMA_LENGTH, 0]) * 100
-    #
-    # dict_result["MU_GAS_VISCOSITY_Pa_Sec"] = float(df.iloc[ROW_DMA_GAS_VISCOSITY])
-    # dict_result["GAS_DENSITY"] = float(df.iloc[ROW_DMA_GAS_DENSITY])
-    # dict_result["MEAN_FREE_PATH_M"] = float(df.iloc[ROW_DMA_MEAN_FREE_PATH])
-    # dict_result["REF_TEMP_K"] = float(df.iloc[ROW_DMA_REF_TEMP])
-    # dict_result["REF_PRES_kPa"] = float(df.iloc[ROW_DMA_REF_PRES])
+                section = IN_SCAN_PARAMS
+            else:
+                dp_labels.append(label)
+                dp_rows.append(values)
+
+        if section == IN_SCAN_PARAMS:
+            if _is_total_conc_row(label, data_file_version):
+                scan_meta[KEY_TOTAL_CONC] = values
+                return scan_header_rows, dp_labels, dp_rows, scan_meta, (start_dp_row, end_dp_row, row_num)
+            if data_file_version == DATA_FILE_VERSION_2 and label in V2_UNUSED_ROWS:
+                continue
+            scan_meta[V2_ROW_LABELS.get(label, label)] = values
+    return None
+
+def parse_time_stamps(date_times):
+    """
+    Parse the "Date Start Time" strings of the scans. Every export seen so far uses
+    TIME_STAMP_FORMAT, which is parsed in one go. Anything else falls back to letting
+    pandas work out the format, one string at a time.
 
-    return dict_result
+    :param date_times: a list (or Series) of the date and start time strings, joined with a space
+    :return: the time stamps, as a pandas DatetimeIndex (or Series)
+    """
+    import pandas as pd
+    try:
+        return pd.to_datetime(date_times, format=TIME_STAMP_FORMAT)
+    except ValueError:
+        return pd.to_datetime(date_times)
+
+def build_run_data(filename: str, data_file_version: int, dict_setup: dict, scan_ids: list,
+                    scan_block: tuple) -> RunData:
+    """
+    Put together a RunData from the pieces returned by parse_header and parse_scan_block
+    """
+    (scan_header_rows, dp_labels, dp_rows, scan_meta, _) = scan_block
+
+    # Set up a uniform timestamp for each scan
+    time_stamps = parse_time_stamps([d + " " + t for (d, t) in zip(scan_header_rows["Date"],
+                                                                  scan_header_rows["Start Time"])])
+
+    # Scans are stored as rows, so each scan is contiguous in memory
+    if scan_ids:
+        conc = np.ascontiguousarray(_to_float_matrix(dp_rows).T)
+    else:
+        conc = np.zeros((0, len(dp_rows)), dtype=np.float64)
+
+    return RunData(filename=filename,
+                   data_file_version=data_file_version,
+                   setup=dict_setup,
+                   scan_ids=np.array(scan_ids, dtype=int),
+                   time_stamps=time_stamps,
+                   dp_labels=[label.strip() for label in dp_labels],
+                   conc=conc,
+                   scan_meta=scan_meta)
+
+
+class RunFileReader:
+    """
+    RunFileReader - reads a single run file (an AIM text export)
+
+    All of the state found while parsing (the file version and the row markers for the
+    scan block) is kept in the reader itself, so any number of files can be read at the
+    same time from different threads, as long as each uses its own reader.
+
+    Attributes:
+        * filename - the name of the file to read
+        * data_file_version - DATA_FILE_VERSION_1 or DATA_FILE_VERSION_2, once the file is read
+        * start_scan_data_row - the row number (1 based) of the "Sample #" row
+        * end_scan_data_row - the row number of the total concentration row
+        * start_dp_row - the row number of the first dp value
+        * end_dp_row - the row number of the last dp value
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.data_file_version = -1
+        self.start_scan_data_row = -1
+        self.end_scan_data_row = -1
+        self.start_dp_row = -1
+        self.end_dp_row = -1
+
+    def __repr__(self):
+        s = "RunFileReader:\n"
+        s += "  file: {}\n".format(self.filename)
+        s += "  version: {}\n".format(self.data_file_version)
+        s += "  scan rows: {} - {}\n".format(self.start_scan_data_row, self.end_scan_data_row)
+        s += "  dp rows: {} - {}\n".format(self.start_dp_row, self.end_dp_row)
+        return s
+
+    def get_num_dp_values(self) -> int:
+        """
+        :return: the number of dp values found in the file. Only valid once the file is read
+        """
+        return self.end_dp_row - self.start_dp_row + 1
+
+    def _check_text_export(self):
+        """
+        INTERNAL FUNCTION - raise a ValueError if the file is an .S80 binary file. Those hold the
+        raw CPC counts, not the concentrations of a text export, so they can't be read as a run.
+        """
+        # Imported here, s80_reader imports this module
+        from htdma_code.model.files.s80_reader import is_s80_file
+        if is_s80_file(self.filename):
+            raise ValueError("{} is an AIM .S80 file, which only holds the raw counts. "
+                             "Export it to text from AIM first".format(self.filename))
+
+    def read(self) -> RunData:
+        """
+        Read in an entire run in a single pass over the file. This replaces calling
+        read_setup followed by read_scans_into_dataframe, which walked the file twice.
+
+        The file is read line by line. The header block (everything above "Sample #")
+        gives the setup info, the "Diameter Midpoint" rows give the dp values and concentrations,
+        and the rows from "Scan Up Time" down through "Total Concentration" give the per-scan
+        parameters. Nothing below the total concentration row is read.
+
+        :return: a RunData object holding everything we need for the run
+        """
+        self._check_text_export()
+        with open(self.filename, mode='r', encoding=FILE_ENCODING) as infile:
+            (version, dict_setup, sample_row, row_num) = parse_header(infile)
+            if sample_row is None:
+                raise ValueError("read_run_file - unable to locate first row of scans in {}".format(self.filename))
+
+            # Newer files pad the rows with empty columns. Only keep the columns with a scan number
+            scan_columns = get_scan_columns(sample_row)
+            scan_block = parse_scan_block(infile, scan_columns, row_num, version)
+
+        if scan_block is None:
+            raise ValueError("read_run_file - unable to locate the end of the scans in {}".format(self.filename))
+
+        (self.start_dp_row, self.end_dp_row, self.end_scan_data_row) = scan_block[-1]
+        self.start_scan_data_row = row_num
+        self.data_file_version = version
+
+        return build_run_data(self.filename, version, dict_setup,
+                               [sample_row[i].strip() for i in scan_columns], scan_block)
+
+    def read_setup(self) -> dict:
+        """
+        Read in the first 18 rows of the data file using pandas read_csv
+
+        NOTE - this walks the entire file. If you need the scans too, use read, which
+        reads everything in a single pass.
+
+        The row markers found along the way are stored in this reader, for use by
+        read_scans_into_dataframe.
+
+        Returns:
+        * A pandas DataFrame containing the keyed info we need
+        """
+        self._check_text_export()
+
+        dict_result = {}
+        row_num = 0
+
+        # Let's assume the data file version is original
+        data_file_version = DATA_FILE_VERSION_1
+
+        with open(self.filename, mode='r', encoding=FILE_ENCODING) as infile:
+            reader = csv.reader(infile, delimiter='\t')
+            for row in reader:
+                row_num += 1
+                #print(row_num, row)
+
+                if "AIM Version" in row[0]:
+                    data_file_version = DATA_FILE_VERSION_2
+                elif _parse_setup_row(row, dict_result, data_file_version):
+                    pass
+                elif "Sample #" in row[0]:
+                    self.start_scan_data_row = row_num
+                elif "Diameter Midpoint" in row[0]:
+                    self.start_dp_row = row_num + 1
+                elif "Scan" in row[0] and "Time" in row[0]:
+                    self.end_dp_row = row_num - 1
+                elif data_file_version == DATA_FILE_VERSION_1 and "Total Concentration" in row[0]:
+                    self.end_scan_data_row = row_num
+                elif data_file_version == DATA_FILE_VERSION_2 and "Total Conc." in row[0]:
+                    self.end_scan_data_row = row_num
+
+        self.data_file_version = data_file_version
+
+        # Checking for gas density, since some files sent over did not include this...
+        if "GAS_DENSITY" not in dict_result:
+            dict_result["GAS_DENSITY"] = DEF_DMA_GAS_DENSITY
+
+        # df = pd.read_csv(filename,
+        #                  header=None,
+        #                  sep='\t',
+        #                  index_col=0,
+        #                  nrows=18,
+        #                  encoding = "ISO-8859-1")
+
+        # dict_result = {}
+        # NOTE - The downloaded file shows this as cm, but the numbers in the file are clearly m
+        # self.dma_1.radius_in_cm = float(df.iloc[ROW_DMA_RADIUS_IN,0])
+        # self.dma_1.radius_out_cm = float(df.iloc[ROW_DMA_RADIUS_OUT,0])
+        # self.dma_1.length_cm = float(df.iloc[ROW_DMA_LENGTH, 0])
+        # dict_result["DMA_1_RADIUS_IN_CM"] = float(df.iloc[ROW_DMA_RADIUS_IN, 0]) * 100
+        # dict_result["DMA_1_RADIUS_OUT_CM"] = float(df.iloc[ROW_DMA_RADIUS_OUT,0]) * 100
+        # dict_result["DMA_1_LENGTH_CM"] = float(df.iloc[ROW_DMA_LENGTH, 0]) * 100
+        #
+        # dict_result["MU_GAS_VISCOSITY_Pa_Sec"] = float(df.iloc[ROW_DMA_GAS_VISCOSITY])
+        # dict_result["GAS_DENSITY"] = float(df.iloc[ROW_DMA_GAS_DENSITY])
+        # dict_result["MEAN_FREE_PATH_M"] = float(df.iloc[ROW_DMA_MEAN_FREE_PATH])
+        # dict_result["REF_TEMP_K"] = float(df.iloc[ROW_DMA_REF_TEMP])
+        # dict_result["REF_PRES_kPa"] = float(df.iloc[ROW_DMA_REF_PRES])
+
+        return dict_result
+
+    def read_scans_into_dataframe(self) -> tuple:
+        """
+        Read in all of the scans for a given run. read_setup must be called first on this reader.
+
+        NOTE - this re-reads the file with pandas. Prefer read, which reads everything in
+        a single pass. RunData.to_dataframe returns this same DataFrame.
+
+        Returns:
+            (df, num_dp_values) tuple, where
+            * df - pandas DataFrame containing all scans for the run
+            * num_dp_values - an int specifying the number of diameters captured from the file
+        """
+
+        import pandas as pd
+
+        if self.start_scan_data_row == -1:
+            sys.exit("Error! Unable to locate first row of scans!")
+
+        df = pd.read_csv(self.filename,
+                            header=0,
+                            sep='\t',
+                            index_col=0,
+                            skiprows=self.start_scan_data_row-1,
+                            nrows=self.end_scan_data_row-self.start_scan_data_row, # Remember, first row is the column header
+                            encoding="ISO-8859-1")
+
+        # The new version puts extra columns in! Argh!!!! More absurdness.
+        columns_to_drop = []
+        if self.data_file_version == DATA_FILE_VERSION_2:
+            for col in df.columns:
+                if "Unnamed" in col:
+                    columns_to_drop.append(col)
+            if len(columns_to_drop) > 0:
+                df = df.drop(labels=columns_to_drop,axis=1)
+
+            # Rename columns to map them to the original
+            df = df.rename(index=V2_ROW_LABELS)
+
+        # All files need to have total concentration standardized
+        for ind in df.index:
+            if "Total Conc" in ind:
+                df = df.rename(index={ind : KEY_TOTAL_CONC})
+
+        # Set up a uniform timestamp for each scan
+        ts = parse_time_stamps(df.apply(lambda col: col["Date"] + " " + col["Start Time"], axis=0))
+        df.loc["Date", :] = ts
+        df = df.drop(index=["Start Time"])
+        df = df.drop(index=["Diameter Midpoint"])
+
+        if self.data_file_version == DATA_FILE_VERSION_2:
+            # This version has some extra rows up at the top we're not using at the moment
+            df = df.drop(index=V2_UNUSED_ROWS)
+
+        num_dp_values = self.get_num_dp_values()
+
+        #verison 2 -need ot deal with status, comment, and aerosol out, cpc sample
+        return (df, num_dp_values)
+
+
+def read_run_file(filename: str) -> RunData:
+    """
+    Read in an entire run in a single pass. See RunFileReader.read
+
+    :param filename: the name of the file to process
+    :return: a RunData object holding everything we need for the run
+    """
+    return RunFileReader(filename).read()
 
-def read_scans_into_dataframe(filename: str) -> (pd.DataFrame, int):
+def read_setup(filename: str) -> dict:
     """
-    Read in all of the scans for a given run
+    Read in the setup info for a run. See RunFileReader.read_setup
 
-    Params:
-    * filename - the name of the file to process
+    :param filename: a string representing the file to read in
+    :return: a dict containing the keyed info we need
+    """
+    return RunFileReader(filename).read_setup()
 
-    Returns:
-        (df, num_dp_values) tuple, where
-        * df - pandas DataFrame containing all scans for the run
-        * num_dp_values - an int specifying the number of diameters captured from the file
+def read_scans_into_dataframe(filename: str) -> tuple:
     """
+    Read in all of the scans for a given run. See RunFileReader.read_scans_into_dataframe
 
-    global start_scan_data_row, end_scan_data_row, start_dp_row, end_dp_row, data_file_version
-    if start_scan_data_row == -1:
-        sys.exit("Error! Unable to locate first row of scans!")
-
-    df = pd.read_csv(filename,
-                        header=0,
-                        sep='\t',
-                        index_col=0,
-                        skiprows=start_scan_data_row-1,
-                        nrows=end_scan_data_row-start_scan_data_row, # Remember, first row is the column header
-                        encoding="ISO-8859-1")
-
-    # The new version puts extra columns in! Argh!!!! More absurdness.
-    columns_to_drop = []
-    if data_file_version == DATA_FILE_VERSION_2:
-        for col in df.columns:
-            if "Unnamed" in col:
-                columns_to_drop.append(col)
-        if len(columns_to_drop) > 0:
-            df = df.drop(labels=columns_to_drop,axis=1)
-
-        # Rename columns to map them to the original
-        df = df.rename(index={"Scan Time (s)": KEY_SCAN_UP_TIME,
-                   "Retrace Time (s)" : KEY_SCAN_RETRACE_TIME,
-                   "Sheath Flow (L/min)" : KEY_SHEATH_FLOW,
-                   "Aerosol Flow (L/min)" : KEY_AEROSOL_IN_FLOW,
-                   "Low Voltage (V)" : KEY_LOW_V,
-                   "High Voltage (V)" : KEY_HIGH_V,
-                   "Lower Size (nm)" : KEY_LOW_DP_NM,
-                   "Upper Size (nm)" : KEY_HIGH_DP_NM,
-                   "Diameter Midpoint (nm)" : "Diameter Midpoint"
-                })
-
-    # All files need to have total concentration standardized
-    for ind in df.index:
-        if "Total Conc" in ind:
-            df = df.rename(index={ind : KEY_TOTAL_CONC})
+    :param filename: the name of the file to process
+    :return: (df, num_dp_values) tuple
+    """
+    reader = RunFileReader(filename)
+    reader.read_setup()
+    return reader.read_scans_into_dataframe()
 
-    # Set up a uniform timestamp for each scan
-    ts = pd.to_datetime(df.apply(lambda col: col["Date"] + " " + col["Start Time"], axis=0))
-    df.loc["Date", :] = ts
-    df = df.drop(index=["Start Time"])
-    df = df.drop(index=["Diameter Midpoint"])
-
-    if data_file_version == DATA_FILE_VERSION_2:
-        # This version has some extra rows up at the top we're not using at the moment
-        df = df.drop(index=["Sample Temp (C)",
-                            "Sample Pressure (kPa)",
-                            "Relative Humidity (%)",
-                            "Mean Free Path (m)",
-                            "Gas Viscosity (Pa*s)"
-                            ])
-
-    num_dp_values = end_dp_row - start_dp_row + 1
-
-    #verison 2 -need ot deal with status, comment, and aerosol out, cpc sample
-    return (df, num_dp_values)
-
-def extract_scan_params(df_scans: pd.DataFrame, scan_num=0) -> dict:
+def get_scan_flows(run_data: RunData) -> np.ndarray:
+    """
+    The flows of every scan of a run, from the per-scan parameters of the RunData. The same
+    values extract_scan_params (and ScanParams) give one scan at a time.
+
+    :param run_data: a RunData object returned by read_run_file
+    :return: a numpy float64 array of shape (n_scans, 4), with the columns sheath, aerosol in,
+             aerosol out and excess flow (lpm)
+    """
+    q_sh = run_data.get_scan_meta_values(KEY_SHEATH_FLOW)
+    q_a_in = run_data.get_scan_meta_values(KEY_AEROSOL_IN_FLOW)
+    if run_data.data_file_version == DATA_FILE_VERSION_1:
+        q_a_out = run_data.get_scan_meta_values(KEY_CPC_INLET_FLOW)
+    else:
+        q_a_out = q_a_in
+    # Only an asymmetric setup has an excess flow different from the sheath flow
+    q_excess = np.where(q_a_in != q_a_out, q_sh + q_a_in - q_a_out, q_sh)
+    return np.column_stack((q_sh, q_a_in, q_a_out, q_excess))
+
+def extract_scan_params(df_scans, scan_num=0, data_file_version=DATA_FILE_VERSION_1) -> dict:
     """
     From a complete DataFrame of all scans, extract out the scan parameters
     for a specified scan
@@ -237,31 +548,31 @@ def extract_scan_params(df_scans: pd.DataFrame, scan_num=0) -> dict:
     :param scan_num: An integer representing the scan number to extract.
                      Default is the first scan, and this is rarely necessary as most
                      runs will have the same values for every scan
+    :param data_file_version: The version of the file the scans were read from (see RunData)
     :returns: A Python dictionary mapping parameter names to their values
     """
 
-    global start_scan_data_row, end_scan_data_row, start_dp_row, end_dp_row, data_file_version
-
-    num_dp_values = end_dp_row - start_dp_row + 1
+    # The first row is the time stamp, followed by the dp values, then the scan parameters
+    num_dp_values = df_scans.index.get_loc(KEY_SCAN_UP_TIME) - 1
 
     dict_result = {}
 #    dict_result["SCAN_UP_TIME"] = float(df_scans.iat[num_dp_values + ROW_OFFSET_SCAN_UP_TIME, scan_num])
-    dict_result["SCAN_UP_TIME"] = float(df_scans.loc[KEY_SCAN_UP_TIME][scan_num])
+    dict_result["SCAN_UP_TIME"] = float(df_scans.loc[KEY_SCAN_UP_TIME].iloc[scan_num])
 #    dict_result["SCAN_DOWN_TIME"] = float(df_scans.iat[num_dp_values + ROW_OFFSET_SCAN_RETRACE_TIME, scan_num])
-    dict_result["SCAN_DOWN_TIME"] = float(df_scans.loc[KEY_SCAN_RETRACE_TIME][scan_num])
+    dict_result["SCAN_DOWN_TIME"] = float(df_scans.loc[KEY_SCAN_RETRACE_TIME].iloc[scan_num])
 #    dict_result["SCAN_SHEATH_FLOW_LPM"] = float(df_scans.iat[num_dp_values + ROW_OFFSET_SHEATH_FLOW, scan_num])
-    dict_result["SCAN_SHEATH_FLOW_LPM"] = float(df_scans.loc[KEY_SHEATH_FLOW][scan_num])
+    dict_result["SCAN_SHEATH_FLOW_LPM"] = float(df_scans.loc[KEY_SHEATH_FLOW].iloc[scan_num])
 #    dict_result["SCAN_AEROSOL_IN_LPM"] = float(df_scans.iat[num_dp_values + ROW_OFFSET_AEROSOL_IN_FLOW, scan_num])
-    dict_result["SCAN_AEROSOL_IN_LPM"] = float(df_scans.loc[KEY_AEROSOL_IN_FLOW][scan_num])
+    dict_result["SCAN_AEROSOL_IN_LPM"] = float(df_scans.loc[KEY_AEROSOL_IN_FLOW].iloc[scan_num])
 #    dict_result["SCAN_LOW_V"] = float(df_scans.iat[num_dp_values + ROW_OFFSET_LOW_V, scan_num])
-    dict_result["SCAN_LOW_V"] = float(df_scans.loc[KEY_LOW_V][scan_num])
+    dict_result["SCAN_LOW_V"] = float(df_scans.loc[KEY_LOW_V].iloc[scan_num])
 #    dict_result["SCAN_HIGH_V"] = float(df_scans.iat[num_dp_values + ROW_OFFSET_HIGH_V, scan_num])
-    dict_result["SCAN_HIGH_V"] = float(df_scans.loc[KEY_HIGH_V][scan_num])
+    dict_result["SCAN_HIGH_V"] = float(df_scans.loc[KEY_HIGH_V].iloc[scan_num])
 #    dict_result["SCAN_LOW_DP_NM"] = float(df_scans.iat[num_dp_values + ROW_OFFSET_LOW_DP_NM, scan_num])
-    dict_result["SCAN_LOW_DP_NM"] = float(df_scans.loc[KEY_LOW_DP_NM][scan_num])
+    dict_result["SCAN_LOW_DP_NM"] = float(df_scans.loc[KEY_LOW_DP_NM].iloc[scan_num])
 #    dict_result["SCAN_HIGH_DP_NM"] = float(df_scans.iat[num_dp_values + ROW_OFFSET_HIGH_DP_NM, scan_num])
-    dict_result["SCAN_HIGH_DP_NM"] = float(df_scans.loc[KEY_HIGH_DP_NM][scan_num])
-    dict_result["SCAN_TOTAL_CONC"] = float(df_scans.loc[KEY_TOTAL_CONC][scan_num])
+    dict_result["SCAN_HIGH_DP_NM"] = float(df_scans.loc[KEY_HIGH_DP_NM].iloc[scan_num])
+    dict_result["SCAN_TOTAL_CONC"] = float(df_scans.loc[KEY_TOTAL_CONC].iloc[scan_num])
 
     if data_file_version == DATA_FILE_VERSION_1:
         dict_result["SCAN_AEROSOL_OUT_LPM"] = float(df_scans.iat[num_dp_values + ROW_OFFSET_CPC_INLET_FLOW, scan_num])
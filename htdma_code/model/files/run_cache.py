@@ -0,0 +1,185 @@
+"""
+run_cache - a binary sidecar cache of parsed run files
+
+The first time a run file is read, everything parsed out of it (i.e. the RunData) is written
+next to it, in a directory named after the file plus SIDECAR_SUFFIX:
+
+    run.txt
+    run.txt.htdma-cache/
+        conc.npy         - the concentration matrix, (n_scans, n_dp) float64
+        scan_ids.npy     - the scan numbers
+        time_stamps.npy  - the scan start times, as int64 nanoseconds
+        meta.json        - the setup dict, dp labels, scan parameters and the source file's
+                           size, mtime and sha256
+
+Later reads load the arrays straight from the .npy files. The concentration matrix is memory
+mapped, so opening a run is near instant and worker processes share the same pages.
+
+The sidecar is only used if it matches the source file. If the size or mtime of the file
+changed, the sidecar is only trusted if the sha256 of the file still matches.
+"""
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+import htdma_code.model.files.read_file_utils as read_file_utils
+from htdma_code.model.files.run_data import RunData
+
+SIDECAR_SUFFIX = ".htdma-cache"
+
+# Bump this whenever the layout of the sidecar changes
+SIDECAR_FORMAT_VERSION = 2
+
+FILENAME_META = "meta.json"
+FILENAME_CONC = "conc.npy"
+FILENAME_SCAN_IDS = "scan_ids.npy"
+FILENAME_TIME_STAMPS = "time_stamps.npy"
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def get_sidecar_dir(filename: str) -> str:
+    """
+    :return: the sidecar directory for a run file
+    """
+    return filename + SIDECAR_SUFFIX
+
+
+def hash_file(filename: str) -> str:
+    """
+    :return: the sha256 of a file's contents, as a hex string
+    """
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def read_run_file_cached(filename: str, use_mmap: bool = True) -> RunData:
+    """
+    Read a run file through its sidecar cache. If there is no valid sidecar, the file is
+    parsed with read_file_utils.read_run_file, and a sidecar is written for next time
+    (if the directory can be written to).
+
+    :param filename: The run file
+    :param use_mmap: True to memory map the concentration matrix (read only) from the sidecar
+    :return: a RunData
+    """
+    run_data = load_run_cache(filename, use_mmap=use_mmap)
+    if run_data is not None:
+        return run_data
+
+    run_data = read_file_utils.read_run_file(filename)
+    try:
+        write_run_cache(run_data, filename)
+    except OSError:
+        # e.g. a read only directory. We still have the data, so carry on without the sidecar
+        pass
+    return run_data
+
+
+def load_run_cache(filename: str, use_mmap: bool = True) -> RunData:
+    """
+    Load the RunData of a run file from its sidecar
+
+    :param filename: The run file (not the sidecar)
+    :param use_mmap: True to memory map the concentration matrix (read only)
+    :return: a RunData, or None if there is no sidecar or it does not match the file
+    """
+    sidecar_dir = get_sidecar_dir(filename)
+    try:
+        with open(os.path.join(sidecar_dir, FILENAME_META), "r") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if meta.get("format_version") != SIDECAR_FORMAT_VERSION:
+        return None
+
+    # Is this sidecar still for the same file?
+    stat = os.stat(filename)
+    if stat.st_size != meta["source_size"]:
+        return None
+    if stat.st_mtime_ns != meta["source_mtime_ns"]:
+        # Touched or copied, but maybe not changed. The hash settles it
+        if hash_file(filename) != meta["source_sha256"]:
+            return None
+        meta["source_mtime_ns"] = stat.st_mtime_ns
+        try:
+            _write_meta(sidecar_dir, meta)
+        except OSError:
+            pass
+
+    try:
+        conc = np.load(os.path.join(sidecar_dir, FILENAME_CONC), mmap_mode="r" if use_mmap else None)
+        scan_ids = np.load(os.path.join(sidecar_dir, FILENAME_SCAN_IDS))
+        time_stamps = np.load(os.path.join(sidecar_dir, FILENAME_TIME_STAMPS))
+    except (OSError, ValueError):
+        return None
+
+    if conc.shape != (scan_ids.shape[0], len(meta["dp_labels"])):
+        return None
+
+    import pandas as pd
+
+    return RunData(filename=filename,
+                   data_file_version=meta["data_file_version"],
+                   setup=meta["setup"],
+                   scan_ids=scan_ids,
+                   time_stamps=pd.DatetimeIndex(time_stamps.astype("datetime64[ns]")),
+                   dp_labels=meta["dp_labels"],
+                   conc=conc,
+                   scan_meta=meta["scan_meta"])
+
+
+def write_run_cache(run_data: RunData, filename: str):
+    """
+    Write the sidecar for a run file
+
+    :param run_data: The RunData parsed from the file
+    :param filename: The run file the data was parsed from
+    """
+    sidecar_dir = get_sidecar_dir(filename)
+    os.makedirs(sidecar_dir, exist_ok=True)
+
+    # Remove the old meta file first, so a half written sidecar is never seen as valid
+    meta_filename = os.path.join(sidecar_dir, FILENAME_META)
+    if os.path.exists(meta_filename):
+        os.remove(meta_filename)
+
+    np.save(os.path.join(sidecar_dir, FILENAME_CONC), np.ascontiguousarray(run_data.conc, dtype=np.float64))
+    np.save(os.path.join(sidecar_dir, FILENAME_SCAN_IDS), np.asarray(run_data.scan_ids))
+    np.save(os.path.join(sidecar_dir, FILENAME_TIME_STAMPS),
+            np.asarray(run_data.time_stamps, dtype="datetime64[ns]").astype(np.int64))
+
+    stat = os.stat(filename)
+    meta = {"format_version": SIDECAR_FORMAT_VERSION,
+            "source_size": stat.st_size,
+            "source_mtime_ns": stat.st_mtime_ns,
+            "source_sha256": hash_file(filename),
+            "data_file_version": run_data.data_file_version,
+            "setup": run_data.setup,
+            "dp_labels": list(run_data.dp_labels),
+            "scan_meta": run_data.scan_meta}
+    _write_meta(sidecar_dir, meta)
+
+
+def remove_run_cache(filename: str):
+    """
+    Delete the sidecar of a run file, if there is one
+    """
+    shutil.rmtree(get_sidecar_dir(filename), ignore_errors=True)
+
+
+def _write_meta(sidecar_dir: str, meta: dict):
+    """
+    Internal helper to (atomically) write the meta file of a sidecar
+    """
+    tmp_filename = os.path.join(sidecar_dir, FILENAME_META + ".tmp")
+    with open(tmp_filename, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_filename, os.path.join(sidecar_dir, FILENAME_META))
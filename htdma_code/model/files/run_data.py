@@ -0,0 +1,101 @@
+"""
+run_data - a typed container for everything parsed out of a single run file
+"""
+from typing import Dict, List
+
+import numpy as np
+
+
+class RunData:
+    """
+    RunData encapsulates all of the information read in from a single run file (i.e. an
+    AIM text export) in one pass.
+
+    Attributes:
+        * filename - the name of the file the run was read from
+        * data_file_version - the version of the AIM export format (see read_file_utils)
+        * setup - a dict of the run setup info, using the same keys as read_file_utils.read_setup
+        * scan_ids - numpy int array of the scan numbers recorded in the file (usually 1 based)
+        * time_stamps - pandas DatetimeIndex with the start time of each scan
+        * dp - numpy float64 array of the diameter midpoints (nm), shape (n_dp,)
+        * conc - numpy float64 array of the concentrations, shape (n_scans, n_dp)
+        * dp_labels - the diameter midpoints exactly as they were written in the file
+        * scan_meta - dict mapping the (standardized) row label of each per-scan parameter
+                      to a list of the raw string values, one per scan
+    """
+    def __init__(self,
+                 filename: str,
+                 data_file_version: int,
+                 setup: dict,
+                 scan_ids: np.ndarray,
+                 time_stamps,
+                 dp_labels: List[str],
+                 conc: np.ndarray,
+                 scan_meta: Dict[str, List[str]]):
+        self.filename = filename
+        self.data_file_version = data_file_version
+        self.setup = setup
+        self.scan_ids = scan_ids
+        self.time_stamps = time_stamps
+        self.dp_labels = dp_labels
+        self.dp = np.asarray(dp_labels, dtype=np.float64)
+        self.conc = conc
+        self.scan_meta = scan_meta
+
+        # The legacy DataFrame layout is only built if someone asks for it
+        self._df = None
+
+    def __repr__(self):
+        s = "RunData:\n"
+        s += "  file: {}\n".format(self.filename)
+        s += "  version: {}\n".format(self.data_file_version)
+        s += "  Num scans: {}\n".format(self.get_num_scans())
+        s += "  Num dp values: {}\n".format(self.get_num_dp_values())
+        return s
+
+    def get_num_scans(self) -> int:
+        """
+        :return: the number of scans in the run
+        """
+        return self.conc.shape[0]
+
+    def get_num_dp_values(self) -> int:
+        """
+        :return: the number of channels / dp values in each scan
+        """
+        return self.conc.shape[1]
+
+    def get_scan_meta_values(self, key: str) -> np.ndarray:
+        """
+        Convert one of the per-scan parameter rows into a numpy float array
+
+        :param key: The row label of the parameter (e.g. read_file_utils.KEY_SHEATH_FLOW)
+        :return: A numpy float64 array with one value per scan
+        """
+        return np.asarray(self.scan_meta[key], dtype=np.float64)
+
+    def to_dataframe(self):
+        """
+        Build (once) the DataFrame that read_file_utils.read_scans_into_dataframe has always
+        returned. Scans are columns, labelled by the scan number as a string. The first row
+        is the time stamp of the scan, followed by one row per dp value and one row per
+        scan parameter.
+
+        :return: A pandas DataFrame in the legacy layout
+        """
+        if self._df is None:
+            # Only the legacy layout needs pandas, so it is not imported with the rest of the model
+            import pandas as pd
+            num_dp_values = self.get_num_dp_values()
+            index = ["Date"] + self.dp_labels + list(self.scan_meta.keys())
+
+            data = np.empty((len(index), self.get_num_scans()), dtype=object)
+            data[0, :] = list(self.time_stamps)
+            data[1:1+num_dp_values, :] = self.conc.T
+            for i, values in enumerate(self.scan_meta.values()):
+                data[1+num_dp_values+i, :] = values
+
+            self._df = pd.DataFrame(data,
+                                    index=pd.Index(index, name="Sample #"),
+                                    columns=[str(scan_id) for scan_id in self.scan_ids])
+        return self._df
@@ -0,0 +1,123 @@
+"""
+run_tail - reads the scans of a run file that is still being written
+
+AIM exports store one scan per column, so a new scan makes every row of the file longer,
+and the file is written out again. RunFileTail reads the header of the file once, and
+remembers where the scan block starts. Each poll only reads from there, and only converts
+the scan columns it has not seen yet.
+"""
+import os
+
+import htdma_code.model.files.read_file_utils as read_file_utils
+from htdma_code.model.files.run_data import RunData
+
+
+class RunFileTail:
+    """
+    RunFileTail follows a run file as it grows. Each call to poll returns a RunData with just
+    the scans that were added since the previous call.
+
+    A poll that finds the file half written (e.g. the total concentration row is not there
+    yet, or the last line is not finished) returns nothing, and the next poll tries again.
+
+    Attributes:
+        * filename - the run file being followed
+        * data_file_version - the version of the AIM export format (see read_file_utils),
+                              once the header is read
+        * setup - the setup dict of the run (see read_file_utils.read_setup), once the header is read
+        * dp_labels - the diameter midpoints of the run, once the first scans are read
+        * num_scans_read - the number of scans returned so far
+        * scan_block_offset - the byte offset of the "Sample #" row, once the header is read
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.data_file_version = None
+        self.setup = None
+        self.dp_labels = None
+        self.num_scans_read = 0
+        self.scan_block_offset = None
+        self._scan_block_row_num = None
+
+        # (size, mtime) of the file the last time it was completely read
+        self._last_stat = None
+
+    def __repr__(self):
+        s = "RunFileTail:\n"
+        s += "  file: {}\n".format(self.filename)
+        s += "  Num scans read: {}\n".format(self.num_scans_read)
+        s += "  Scan block offset: {}\n".format(self.scan_block_offset)
+        return s
+
+    def poll(self) -> RunData:
+        """
+        Read any scans added to the file since the last poll
+
+        :return: a RunData with only the new scans, or None if there are none (yet)
+        """
+        stat = os.stat(self.filename)
+        if (stat.st_size, stat.st_mtime_ns) == self._last_stat:
+            return None
+
+        with open(self.filename, mode="rb") as infile:
+            if self.scan_block_offset is None and not self._read_header(infile):
+                return None
+            infile.seek(self.scan_block_offset)
+            data = infile.read()
+
+        # Ignore a last line that is still being written
+        data = data[:data.rfind(b"\n") + 1]
+        lines = data.decode(read_file_utils.FILE_ENCODING).splitlines()
+        if not lines or "Sample #" not in lines[0]:
+            # The file is being written out again, and hasn't got this far yet
+            return None
+
+        sample_row = lines[0].split("\t")
+        scan_columns = read_file_utils.get_scan_columns(sample_row)
+        if len(scan_columns) < self.num_scans_read:
+            raise ValueError("RunFileTail - {} has fewer scans than before. Was it replaced?".format(self.filename))
+
+        new_columns = scan_columns[self.num_scans_read:]
+        if not new_columns:
+            self._last_stat = (stat.st_size, stat.st_mtime_ns)
+            return None
+
+        scan_block = read_file_utils.parse_scan_block(iter(lines[1:]), new_columns, self._scan_block_row_num,
+                                                      self.data_file_version)
+        if scan_block is None:
+            return None
+
+        run_data = read_file_utils.build_run_data(self.filename, self.data_file_version, self.setup,
+                                                  [sample_row[i].strip() for i in new_columns], scan_block)
+        if self.dp_labels is None:
+            self.dp_labels = run_data.dp_labels
+        elif run_data.dp_labels != self.dp_labels:
+            raise ValueError("RunFileTail - the dp values of {} changed".format(self.filename))
+
+        self.num_scans_read += run_data.get_num_scans()
+        self._last_stat = (stat.st_size, stat.st_mtime_ns)
+        return run_data
+
+    def _read_header(self, infile) -> bool:
+        """
+        Internal helper to read the setup info, and find where the scan block starts
+
+        :return: True if the header was read, False if the file hasn't got as far as "Sample #" yet
+        """
+        line_offsets = []
+
+        def _lines():
+            offset = 0
+            for line in infile:
+                line_offsets.append(offset)
+                offset += len(line)
+                yield line.decode(read_file_utils.FILE_ENCODING)
+
+        (version, dict_setup, sample_row, row_num) = read_file_utils.parse_header(_lines())
+        if sample_row is None:
+            return False
+
+        self.data_file_version = version
+        self.setup = dict_setup
+        self.scan_block_offset = line_offsets[-1]
+        self._scan_block_row_num = row_num
+        return True
@@ -0,0 +1,287 @@
+"""
+s80_reader - reads TSI AIM .S80 binary run files directly, without an AIM text export
+
+An .S80 file is a fixed size header followed by one fixed size record per scan:
+
+    header (HEADER_SIZE bytes)
+        signature, number of scans, start time, classifier / DMA / CPC models,
+        DMA geometry (m) and the reference gas properties
+    record (RECORD_LENGTH bytes, the first field of each record), one per scan
+        time stamp, scan up / retrace times, sheath and aerosol flows (m^3/s), td,
+        high / low voltage, upper / lower size (nm), particle density, then the raw
+        CPC counts of the up scan followed by those of the retrace, one per COUNTS_PER_SEC
+
+The layout was worked out against AIM exports of the same runs (see benchmarks/bench_s80_reader.py).
+
+The whole file is memory mapped and decoded with numpy.frombuffer and structured dtypes,
+so the counts are never copied until they are used.
+
+NOTE: The dw/dlogDp concentrations of a text export are NOT in an .S80 file. AIM computes
+them when exporting, from the raw counts, with its own multiple charge and diffusion
+corrections. What is stored (and returned here) are the raw counts.
+
+The counts are not converted here either. Binning them into the export's channels and dividing
+by the sampled volume, charging_probability and the area of the TransferKernel of each channel
+gives the run's mean export values to within ~10% from ~90 to ~300 nm, bar a few channels.
+Below that, AIM's diffusion loss correction takes over (x3 at 20 nm, x48 at 8 nm). It depends on AIM's model of the classifier's
+plumbing, which is not in the file, and no single Gormley-Kennedy length reproduces it.
+
+For now this is a standalone decoder: nothing else in the app reads .S80 files, and
+read_file_utils.read_run_file (so the UI and the batch command) refuses them with a ValueError.
+Runs still have to be exported to text from AIM to be fitted.
+"""
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+import htdma_code.model.files.read_file_utils as read_file_utils
+
+S80_FILE_EXTENSION = ".S80"
+S80_SIGNATURE = b"=SMPS (C) TSI Inc. 1999-"
+
+# Header fields: name -> (byte offset, type)
+HEADER_FIELDS = {"num_scans": (0x14a, "<u2"),
+                 "start_time": (0x252, "<u4"),    # unix time
+                 "classifier_model": (0x256, "<u2"),
+                 "dma_model": (0x258, "<u2"),
+                 "radius_in_m": (0x25e, "<f8"),
+                 "radius_out_m": (0x266, "<f8"),
+                 "length_m": (0x26e, "<f8"),
+                 "cpc_model": (0x276, "<u2"),
+                 "ref_temp_k": (0x27e, "<f8"),
+                 "ref_pres_kpa": (0x286, "<f8"),
+                 "gas_viscosity_pa_sec": (0x28e, "<f8"),
+                 "mean_free_path_m": (0x296, "<f8")}
+HEADER_SIZE = 0x2b6
+
+# Record fields: name -> (byte offset, type). The counts follow at RECORD_OFFSET_COUNTS
+RECORD_FIELDS = {"record_length": (0, "<u4"),
+                 "time": (4, "<u4"),              # unix time
+                 "month": (8, "<u2"),
+                 "day": (10, "<u2"),
+                 "year": (12, "<u2"),
+                 "hour": (14, "<u2"),
+                 "minute": (16, "<u2"),
+                 "second": (18, "<u2"),
+                 "scan_up_time": (20, "<u2"),     # sec
+                 "retrace_time": (22, "<u2"),     # sec
+                 "sheath_flow": (32, "<f8"),      # m^3/s
+                 "aerosol_flow": (40, "<f8"),     # m^3/s
+                 "td": (48, "<f8"),               # sec
+                 "high_v": (64, "<f8"),
+                 "low_v": (72, "<f8"),
+                 "upper_size_nm": (80, "<f8"),
+                 "lower_size_nm": (88, "<f8"),
+                 "density": (96, "<f8")}          # g/cc
+RECORD_OFFSET_COUNTS = 0x1fa
+COUNTS_TYPE = "<u4"
+
+# The CPC counts are recorded at 10 Hz
+COUNTS_PER_SEC = 10
+
+M3_PER_SEC_TO_LPM = 1000 * 60
+M_TO_CM = 100
+
+# Channels/Decade of the AIM export. It is a setting of the export, and is not stored in
+# the .S80 file. 64 is the AIM default
+DEFAULT_CHANNELS_PER_DECADE = 64
+
+# The per-scan parameters, in the row labels of a text export (see read_file_utils)
+KEY_TD = "td(s)"
+KEY_DENSITY = "Density(g/cc)"
+
+
+def is_s80_file(filename: str) -> bool:
+    """
+    :return: True if the file starts with the .S80 signature
+    """
+    with open(filename, "rb") as f:
+        return f.read(len(S80_SIGNATURE)) == S80_SIGNATURE
+
+
+def get_dp_midpoints(lower_size_nm: float, upper_size_nm: float,
+                     channels_per_decade: int = DEFAULT_CHANNELS_PER_DECADE) -> np.ndarray:
+    """
+    Compute the diameter midpoints of the channels AIM reports for a size range. The channel
+    boundaries are at 10^(k / channels_per_decade) nm, and only channels completely inside
+    [lower_size_nm, upper_size_nm] are reported.
+
+    :return: a numpy float64 array of the midpoints (nm)
+    """
+    if channels_per_decade <= 0:
+        raise ValueError("channels_per_decade must be > 0")
+    if not 0 < lower_size_nm < upper_size_nm:
+        raise ValueError("Invalid size range {} - {} nm".format(lower_size_nm, upper_size_nm))
+    first = np.ceil(np.log10(lower_size_nm) * channels_per_decade)
+    last = np.floor(np.log10(upper_size_nm) * channels_per_decade)
+    return 10 ** ((np.arange(first, last) + 0.5) / channels_per_decade)
+
+
+def _header_dtype() -> np.dtype:
+    """
+    INTERNAL FUNCTION -
+    :return: the structured dtype of the header
+    """
+    return np.dtype({"names": list(HEADER_FIELDS.keys()),
+                     "formats": [f for (_, f) in HEADER_FIELDS.values()],
+                     "offsets": [o for (o, _) in HEADER_FIELDS.values()],
+                     "itemsize": HEADER_SIZE})
+
+
+def _record_dtype(record_length: int, num_up_counts: int, num_retrace_counts: int) -> np.dtype:
+    """
+    INTERNAL FUNCTION -
+    :return: the structured dtype of one scan record
+    """
+    counts_size = np.dtype(COUNTS_TYPE).itemsize
+    if RECORD_OFFSET_COUNTS + (num_up_counts + num_retrace_counts) * counts_size != record_length:
+        raise ValueError("Record length {} does not match {} up and {} retrace counts".format(
+            record_length, num_up_counts, num_retrace_counts))
+
+    names = list(RECORD_FIELDS.keys()) + ["up_counts", "retrace_counts"]
+    formats = [f for (_, f) in RECORD_FIELDS.values()] + \
+              [(COUNTS_TYPE, (num_up_counts,)), (COUNTS_TYPE, (num_retrace_counts,))]
+    offsets = [o for (o, _) in RECORD_FIELDS.values()] + \
+              [RECORD_OFFSET_COUNTS, RECORD_OFFSET_COUNTS + num_up_counts * counts_size]
+    return np.dtype({"names": names, "formats": formats, "offsets": offsets, "itemsize": record_length})
+
+
+def _to_datetime64(records: np.ndarray) -> np.ndarray:
+    """
+    INTERNAL FUNCTION -
+    :return: the date and time fields of the records as a numpy datetime64[ns] array
+    """
+    months = (records["year"].astype(np.int64) - 1970) * 12 + records["month"] - 1
+    days = months.astype("datetime64[M]").astype("datetime64[D]") + (records["day"].astype(np.int64) - 1)
+    seconds = (records["hour"].astype(np.int64) * 60 + records["minute"]) * 60 + records["second"]
+    return (days + seconds.astype("timedelta64[s]")).astype("datetime64[ns]")
+
+
+class S80Data:
+    """
+    S80Data holds everything decoded from an .S80 file. The setup and the scan parameters
+    use the same keys as read_file_utils, so they can be used wherever those of a text
+    export are.
+
+    Attributes:
+        * filename - the name of the file the run was read from
+        * setup - a dict of the run setup info, with the same keys as read_file_utils.read_setup.
+                  MULT_CHARGE_CORRECTION is always False, as the counts are not corrected
+        * classifier_model, dma_model, cpc_model - the TSI model numbers of the instruments
+        * scan_ids - numpy int array of the scan numbers (1 based)
+        * time_stamps - pandas DatetimeIndex with the start time of each scan
+        * dp - numpy float64 array of the diameter midpoints (nm) a text export would
+               have (see get_dp_midpoints)
+        * scan_meta - dict mapping the row label (as in a text export) of each per-scan
+                      parameter to a numpy float64 array, one value per scan
+        * up_counts - numpy uint32 array of the raw CPC counts of the up scans, shape
+                      (n_scans, scan up time * COUNTS_PER_SEC). Memory mapped, read only
+        * retrace_counts - the same, for the retraces
+    """
+    def __init__(self, filename: str, channels_per_decade: int = DEFAULT_CHANNELS_PER_DECADE):
+        self.filename = filename
+        self._read(channels_per_decade)
+
+    def __repr__(self):
+        s = "S80Data:\n"
+        s += "  file: {}\n".format(self.filename)
+        s += "  Classifier: {}, DMA: {}, CPC: {}\n".format(self.classifier_model, self.dma_model, self.cpc_model)
+        s += "  Num scans: {}\n".format(self.get_num_scans())
+        s += "  Num dp values: {}\n".format(self.get_num_dp_values())
+        s += "  Counts per scan: {} up, {} retrace\n".format(self.up_counts.shape[1], self.retrace_counts.shape[1])
+        return s
+
+    def get_num_scans(self) -> int:
+        """
+        :return: the number of scans in the run
+        """
+        return self.up_counts.shape[0]
+
+    def get_num_dp_values(self) -> int:
+        """
+        :return: the number of channels / dp values a text export of the run would have
+        """
+        return self.dp.shape[0]
+
+    def get_scan_meta_values(self, key: str) -> np.ndarray:
+        """
+        :param key: The row label of the parameter (e.g. read_file_utils.KEY_SHEATH_FLOW)
+        :return: A numpy float64 array with one value per scan
+        """
+        return self.scan_meta[key]
+
+    def _read(self, channels_per_decade: int):
+        """
+        Internal helper to memory map and decode the file
+        """
+        mm = np.memmap(self.filename, dtype=np.uint8, mode="r")
+        if mm.shape[0] < HEADER_SIZE or bytes(mm[:len(S80_SIGNATURE)]) != S80_SIGNATURE:
+            raise ValueError("{} is not an .S80 file".format(self.filename))
+
+        header = np.frombuffer(mm, dtype=_header_dtype(), count=1)[0]
+        num_scans = int(header["num_scans"])
+        if num_scans == 0:
+            raise ValueError("{} has no scans".format(self.filename))
+
+        # Every record has the same length, and the same number of counts as the first one
+        first = np.frombuffer(mm, dtype=_record_dtype(RECORD_OFFSET_COUNTS, 0, 0), count=1, offset=HEADER_SIZE)[0]
+        record_length = int(first["record_length"])
+        if mm.shape[0] != HEADER_SIZE + num_scans * record_length:
+            raise ValueError("{}: size {} does not match {} scans of {} bytes".format(
+                self.filename, mm.shape[0], num_scans, record_length))
+        record_dtype = _record_dtype(record_length,
+                                     int(first["scan_up_time"]) * COUNTS_PER_SEC,
+                                     int(first["retrace_time"]) * COUNTS_PER_SEC)
+        records = np.frombuffer(mm, dtype=record_dtype, count=num_scans, offset=HEADER_SIZE)
+        if np.any(records["record_length"] != record_length):
+            raise ValueError("{}: scans have different record lengths".format(self.filename))
+
+        self.classifier_model = int(header["classifier_model"])
+        self.dma_model = int(header["dma_model"])
+        self.cpc_model = int(header["cpc_model"])
+
+        self.setup = {"DMA_1_RADIUS_IN_CM": float(header["radius_in_m"]) * M_TO_CM,
+                      "DMA_1_RADIUS_OUT_CM": float(header["radius_out_m"]) * M_TO_CM,
+                      "DMA_1_LENGTH_CM": float(header["length_m"]) * M_TO_CM,
+                      "MU_GAS_VISCOSITY_Pa_Sec": float(header["gas_viscosity_pa_sec"]),
+                      "MEAN_FREE_PATH_M": float(header["mean_free_path_m"]),
+                      "REF_TEMP_K": float(header["ref_temp_k"]),
+                      "REF_PRES_kPa": float(header["ref_pres_kpa"]),
+                      # Not stored in the file
+                      "GAS_DENSITY": read_file_utils.DEF_DMA_GAS_DENSITY,
+                      # The file holds the raw counts, no correction has been applied to them. AIM's
+                      # Multiple Charge Correction is an export setting
+                      "MULT_CHARGE_CORRECTION": False}
+
+        self.scan_ids = np.arange(1, num_scans + 1)
+        # The instrument's local clock, like the Date and Start Time of a text export
+        self.time_stamps = pd.DatetimeIndex(_to_datetime64(records))
+
+        self.scan_meta = {read_file_utils.KEY_SCAN_UP_TIME: records["scan_up_time"].astype(np.float64),
+                          read_file_utils.KEY_SCAN_RETRACE_TIME: records["retrace_time"].astype(np.float64),
+                          read_file_utils.KEY_SHEATH_FLOW: records["sheath_flow"] * M3_PER_SEC_TO_LPM,
+                          read_file_utils.KEY_AEROSOL_IN_FLOW: records["aerosol_flow"] * M3_PER_SEC_TO_LPM,
+                          read_file_utils.KEY_LOW_V: records["low_v"].copy(),
+                          read_file_utils.KEY_HIGH_V: records["high_v"].copy(),
+                          read_file_utils.KEY_LOW_DP_NM: records["lower_size_nm"].copy(),
+                          read_file_utils.KEY_HIGH_DP_NM: records["upper_size_nm"].copy(),
+                          KEY_DENSITY: records["density"].copy(),
+                          KEY_TD: records["td"].copy()}
+
+        self.dp = get_dp_midpoints(float(records["lower_size_nm"][0]), float(records["upper_size_nm"][0]),
+                                   channels_per_decade)
+
+        self.up_counts = records["up_counts"]
+        self.retrace_counts = records["retrace_counts"]
+
+
+def read_s80_file(filename: str, channels_per_decade: int = DEFAULT_CHANNELS_PER_DECADE) -> S80Data:
+    """
+    Read an .S80 file
+
+    :param filename: The .S80 file
+    :param channels_per_decade: The Channels/Decade to compute the dp midpoints with
+    :return: an S80Data
+    """
+    return S80Data(filename, channels_per_decade)
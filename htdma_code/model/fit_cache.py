@@ -0,0 +1,213 @@
+"""
+FitCache - a persistent, content addressed cache of scan fit results
+"""
+import hashlib
+import os
+import pickle
+import sqlite3
+import time
+
+import numpy as np
+
+# Default location of the cache database. Set HTDMA_CACHE_DIR to put it somewhere else
+DEFAULT_CACHE_DIR = os.environ.get("HTDMA_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".htdma_cache"))
+FIT_CACHE_FILENAME = "fit_cache.sqlite"
+
+# When the stored results grow beyond this, the least recently used ones are evicted
+DEFAULT_MAX_SIZE_BYTES = 256 * 1024 * 1024
+
+# How long to wait for another process to finish writing to the cache (sec)
+SQLITE_TIMEOUT_SEC = 30.0
+
+# A hit only marks an entry as recently used if it was last used longer ago than this (sec).
+# The marks are written in batches of TOUCH_BATCH_SIZE, so lookups don't take the write lock
+TOUCH_MIN_INTERVAL_SEC = 60.0
+TOUCH_BATCH_SIZE = 256
+
+
+def fit_cache_key(values: np.ndarray, dp_range: np.ndarray, num_peaks_desired: int, fitter_version: int,
+                  variant: str = "") -> str:
+    """
+    Compute the key a fit is stored under. It is a hash of everything the fit depends on:
+    the raw scan values, the dp values, the number of peaks and the version of the fitter.
+
+    :param variant: [Optional] tells apart different kinds of fit of the same scan (e.g. Scan.fit_auto)
+    :return: a hex string
+    """
+    h = hashlib.sha256()
+    h.update("htdma-fit:{}:{}:{}:{}:".format(fitter_version, variant, num_peaks_desired, len(dp_range)).encode())
+    h.update(np.ascontiguousarray(dp_range, dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+class FitCache:
+    """
+    FitCache stores the fit results of scans (the PeakFitResult list and TotalFitResult), in an
+    SQLite database, so a scan that has been fitted before never has to be fitted again. Entries
+    are looked up by fit_cache_key, so identical scans share an entry, whatever run they came from.
+
+    The cache is limited by the total size of the stored results. When it grows beyond
+    max_size_bytes, the least recently used entries are evicted.
+
+    The database is in WAL mode, so any number of processes can look fits up while one of them
+    writes. A lookup does not write anything: which entries were used is kept in memory, and
+    written in batches (see flush). The total size of the stored results is kept in a one row
+    meta table, so storing a fit does not have to add up the size of every entry.
+
+    The database connection is opened on first use, and a FitCache can be pickled (e.g. handed to
+    worker processes), in which case each process opens its own connection.
+
+    Attributes:
+        * path - the SQLite database file
+        * max_size_bytes - the size limit of the stored results
+    """
+    def __init__(self, path: str = None, max_size_bytes: int = DEFAULT_MAX_SIZE_BYTES):
+        if max_size_bytes <= 0:
+            raise ValueError("FitCache: max_size_bytes must be > 0")
+        self.path = path if path is not None else os.path.join(DEFAULT_CACHE_DIR, FIT_CACHE_FILENAME)
+        self.max_size_bytes = max_size_bytes
+        self._conn = None
+        # key -> time of the hits not written yet
+        self._pending_touches = {}
+
+    def __repr__(self):
+        s = "FitCache:\n"
+        s += "  path: {}\n".format(self.path)
+        s += "  Num entries: {}\n".format(self.get_num_entries())
+        s += "  Size: {} / {} bytes\n".format(self.get_size_bytes(), self.max_size_bytes)
+        return s
+
+    def __getstate__(self):
+        # Connections can't be pickled. The copy opens its own
+        return {"path": self.path, "max_size_bytes": self.max_size_bytes}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self.max_size_bytes = state["max_size_bytes"]
+        self._conn = None
+        self._pending_touches = {}
+
+    def get(self, key: str):
+        """
+        Look up a fit, and mark it as recently used (written with the next batch, see flush)
+
+        :param key: The key from fit_cache_key
+        :return: (num_peaks_predicted, peak_fit_results, total_fit_result), or None if not found
+        """
+        conn = self._connect()
+        row = conn.execute("SELECT data, last_used FROM fits WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[1] > TOUCH_MIN_INTERVAL_SEC:
+            self._pending_touches[key] = now
+            if len(self._pending_touches) >= TOUCH_BATCH_SIZE:
+                self.flush()
+        return pickle.loads(row[0])
+
+    def put(self, key: str, num_peaks_predicted, peak_fit_results, total_fit_result):
+        """
+        Store the results of a fit, then evict the least recently used entries if the
+        cache has grown too big
+        """
+        data = pickle.dumps((num_peaks_predicted, peak_fit_results, total_fit_result),
+                            protocol=pickle.HIGHEST_PROTOCOL)
+        conn = self._connect()
+        with conn:
+            # Taking the size of an entry being replaced off first also takes the write lock, so no
+            # other process can change the entry in between
+            conn.execute("UPDATE meta SET total_size = total_size + ? - "
+                         "COALESCE((SELECT size FROM fits WHERE key = ?), 0)", (len(data), key))
+            conn.execute("INSERT OR REPLACE INTO fits (key, data, size, last_used) VALUES (?, ?, ?, ?)",
+                         (key, data, len(data), time.time()))
+            self._write_touches(conn)
+            self._evict(conn)
+
+    def flush(self):
+        """
+        Write the recently used marks of the hits since the last flush. This happens on its own
+        every TOUCH_BATCH_SIZE hits, with every put, and on close
+        """
+        if self._pending_touches:
+            conn = self._connect()
+            with conn:
+                self._write_touches(conn)
+
+    def get_num_entries(self) -> int:
+        """
+        :return: the number of fits stored
+        """
+        return self._connect().execute("SELECT COUNT(*) FROM fits").fetchone()[0]
+
+    def get_size_bytes(self) -> int:
+        """
+        :return: the total size of the stored results
+        """
+        return self._connect().execute("SELECT total_size FROM meta").fetchone()[0]
+
+    def clear(self):
+        """
+        Remove every entry
+        """
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM fits")
+            conn.execute("UPDATE meta SET total_size = 0")
+        self._pending_touches = {}
+
+    def close(self):
+        if self._conn is not None:
+            self.flush()
+            self._conn.close()
+            self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Internal helper to open (and if needed, create) the database
+        """
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT_SEC)
+            # WAL lets readers carry on while another process writes, and only needs to sync at checkpoints
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            with self._conn:
+                self._conn.execute("CREATE TABLE IF NOT EXISTS fits ("
+                                   "key TEXT PRIMARY KEY, data BLOB NOT NULL, "
+                                   "size INTEGER NOT NULL, last_used REAL NOT NULL)")
+                self._conn.execute("CREATE INDEX IF NOT EXISTS fits_last_used ON fits (last_used)")
+                # The running total of the sizes. A database from before it existed is added up once
+                self._conn.execute("CREATE TABLE IF NOT EXISTS meta ("
+                                   "id INTEGER PRIMARY KEY CHECK (id = 0), total_size INTEGER NOT NULL)")
+                self._conn.execute("INSERT OR IGNORE INTO meta (id, total_size) "
+                                   "SELECT 0, COALESCE(SUM(size), 0) FROM fits")
+        return self._conn
+
+    def _write_touches(self, conn: sqlite3.Connection):
+        """
+        Internal helper to write the pending recently used marks. Must be called inside a transaction
+        """
+        conn.executemany("UPDATE fits SET last_used = ? WHERE key = ?",
+                         [(t, key) for (key, t) in self._pending_touches.items()])
+        self._pending_touches = {}
+
+    def _evict(self, conn: sqlite3.Connection):
+        """
+        Internal helper to delete the least recently used entries until the cache fits in
+        max_size_bytes. Must be called inside a transaction
+        """
+        excess = conn.execute("SELECT total_size FROM meta").fetchone()[0] - self.max_size_bytes
+        if excess <= 0:
+            return
+        keys = []
+        evicted_size = 0
+        for (key, size) in conn.execute("SELECT key, size FROM fits ORDER BY last_used ASC"):
+            keys.append((key,))
+            evicted_size += size
+            if evicted_size >= excess:
+                break
+        conn.executemany("DELETE FROM fits WHERE key = ?", keys)
+        conn.execute("UPDATE meta SET total_size = total_size - ?", (evicted_size,))
@@ -0,0 +1,96 @@
+"""
+FitResultSet - the results of fitting every scan in a run
+"""
+from typing import Dict, List
+
+from htdma_code.model.scan import PeakFitResult, TotalFitResult
+
+
+class FitResultSet:
+    """
+    FitResultSet collects the fit results of all scans in a run, stored in scan order.
+    Scans that were not fitted (because the fit failed, or the batch was cancelled
+    before getting to them) have None for their results.
+
+    Attributes:
+        * num_peaks_desired - the number of peaks that was asked for (None if it was picked for each scan)
+        * num_peaks_predicted - list of the number of peaks found by find_peaks, per scan
+        * peak_fit_results - list of the PeakFitResult lists, per scan
+        * total_fit_results - list of the TotalFitResult objects, per scan
+        * was_warm_started - list of booleans, True where the scan was fitted from the previous scan's fit
+        * errors - dict mapping a scan index to the error message of a failed fit
+        * is_cancelled - True if the batch was cancelled before all scans were fitted
+    """
+    def __init__(self, num_scans: int, num_peaks_desired: int):
+        self.num_peaks_desired = num_peaks_desired
+        self.num_peaks_predicted: List[int] = [None] * num_scans
+        self.peak_fit_results: List[List[PeakFitResult]] = [None] * num_scans
+        self.total_fit_results: List[TotalFitResult] = [None] * num_scans
+        self.was_warm_started: List[bool] = [False] * num_scans
+        self.errors: Dict[int, str] = {}
+        self.is_cancelled = False
+
+    def __repr__(self):
+        s = "FitResultSet:\n"
+        s += "  Num scans: {}\n".format(self.get_num_scans())
+        s += "  Num fitted: {}\n".format(self.get_num_fitted())
+        s += "  Num warm started: {}\n".format(sum(self.was_warm_started))
+        s += "  Num failed: {}\n".format(len(self.errors))
+        if self.is_cancelled:
+            s += "  CANCELLED\n"
+        return s
+
+    def __len__(self):
+        return self.get_num_scans()
+
+    def get_num_scans(self) -> int:
+        """
+        :return: the number of scans in the run, fitted or not
+        """
+        return len(self.total_fit_results)
+
+    def get_num_fitted(self) -> int:
+        """
+        :return: the number of scans that were fitted successfully
+        """
+        return sum(1 for result in self.total_fit_results if result is not None)
+
+    def set_scan_result(self, scan_index: int,
+                        num_peaks_predicted: int,
+                        peak_fit_results: List[PeakFitResult],
+                        total_fit_result: TotalFitResult,
+                        was_warm_started: bool = False):
+        """
+        Store the results of fitting one scan
+        """
+        self.num_peaks_predicted[scan_index] = num_peaks_predicted
+        self.peak_fit_results[scan_index] = peak_fit_results
+        self.total_fit_results[scan_index] = total_fit_result
+        self.was_warm_started[scan_index] = was_warm_started
+
+    def set_scan_error(self, scan_index: int, error: str):
+        """
+        Record that fitting a scan failed
+        """
+        self.errors[scan_index] = error
+
+    def to_dataframe(self):
+        """
+        Flatten the results into one row per fitted peak, using the same columns as
+        the results table in the UI
+
+        :return: a pandas DataFrame with columns scan, peak, dp, height, fwhh
+        """
+        # Imported here, as Scans (and the fits in the workers) never need pandas
+        import pandas as pd
+        rows = []
+        for scan_index, peaks in enumerate(self.peak_fit_results):
+            if not peaks:
+                continue
+            for peak in peaks:
+                rows.append({"scan": scan_index + 1,
+                             "peak": peak.index + 1,
+                             "dp": peak.dp,
+                             "height": peak.height,
+                             "fwhh": peak.fwhh})
+        return pd.DataFrame(rows, columns=["scan", "peak", "dp", "height", "fwhh"])
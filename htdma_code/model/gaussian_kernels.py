@@ -0,0 +1,146 @@
+"""
+gaussian_kernels - compiled versions of the N gaussian fit model and its Jacobian
+
+When numba is installed, the model and its Jacobian are each computed in one compiled loop
+over the peaks and points, instead of the handful of temporary (n_points, n_peaks) arrays
+that the numpy broadcasting in scan._ngaussian and scan._ngaussian_jac allocates on every
+call. curve_fit calls them many times per fit, on only 100 - 200 points, so those
+allocations and the per call overhead of numpy are most of the cost.
+
+numba is optional. Without it (or with HTDMA_NO_NUMBA=1 in the environment, which also
+reaches the worker processes of Scans.fit_all) the numpy versions are used. numba is only
+imported, and the kernels only compiled, the first time they are used.
+
+Usage:
+    if get_backend() == BACKEND_NUMBA:
+        y = ngaussian(x, *params)
+"""
+import importlib.util
+import os
+
+import numpy as np
+
+BACKEND_NUMPY = "numpy"
+BACKEND_NUMBA = "numba"
+BACKENDS = (BACKEND_NUMPY, BACKEND_NUMBA)
+
+# Set this environment variable to 1 to use the numpy model even when numba is installed
+DISABLE_NUMBA_ENV_VAR = "HTDMA_NO_NUMBA"
+
+SQRT_2_PI = np.sqrt(2 * np.pi)
+
+# The backend in use, decided on first use (see get_backend)
+_backend = None
+
+# (model, jacobian), once compiled
+_kernels = None
+
+
+def is_numba_available() -> bool:
+    """
+    :return: True if numba is installed. numba is not imported to find out
+    """
+    return importlib.util.find_spec("numba") is not None
+
+
+def get_backend() -> str:
+    """
+    :return: BACKEND_NUMBA if numba is installed and not disabled with DISABLE_NUMBA_ENV_VAR
+             (or if set_backend picked it), otherwise BACKEND_NUMPY
+    """
+    global _backend
+    if _backend is None:
+        is_disabled = os.environ.get(DISABLE_NUMBA_ENV_VAR, "0") not in ("", "0")
+        _backend = BACKEND_NUMBA if is_numba_available() and not is_disabled else BACKEND_NUMPY
+    return _backend
+
+
+def set_backend(backend: str):
+    """
+    Pick the backend for this process
+
+    :param backend: BACKEND_NUMPY or BACKEND_NUMBA
+    """
+    global _backend
+    if backend not in BACKENDS:
+        raise ValueError("set_backend - backend must be one of {}".format(", ".join(BACKENDS)))
+    if backend == BACKEND_NUMBA and not is_numba_available():
+        raise ValueError("set_backend - numba is not installed")
+    _backend = backend
+
+
+def ngaussian(x, *params):
+    """
+    The compiled version of scan._ngaussian, with the same arguments
+
+    :return: the summed gaussians, the same shape as x
+    """
+    x = np.asarray(x, dtype=float)
+    return _get_kernels()[0](x.ravel(), np.asarray(params, dtype=float)).reshape(x.shape)
+
+
+def ngaussian_jac(x, *params):
+    """
+    The compiled version of scan._ngaussian_jac, with the same arguments
+
+    :return: an array of shape (len(x), 3 * n_peaks). Column k is the derivative with respect
+             to params[k]
+    """
+    x = np.asarray(x, dtype=float)
+    return _get_kernels()[1](x.ravel(), np.asarray(params, dtype=float))
+
+
+def _ngaussian_loop(x, params):
+    """
+    INTERNAL FUNCTION -
+    The kernel of ngaussian, compiled by numba. x is 1-D
+    """
+    num_points = x.shape[0]
+    y = np.zeros(num_points)
+    for j in range(params.shape[0] // 3):
+        amp = params[3 * j]
+        mu = params[3 * j + 1]
+        sigma = params[3 * j + 2]
+        scale = amp / (sigma * SQRT_2_PI)
+        for i in range(num_points):
+            z = (x[i] - mu) / sigma
+            y[i] += scale * np.exp(-0.5 * z * z)
+    return y
+
+
+def _ngaussian_jac_loop(x, params):
+    """
+    INTERNAL FUNCTION -
+    The kernel of ngaussian_jac, compiled by numba. x is 1-D
+    """
+    num_points = x.shape[0]
+    num_params = params.shape[0]
+    jac = np.empty((num_points, num_params))
+    for i in range(num_points):
+        for j in range(num_params // 3):
+            amp = params[3 * j]
+            mu = params[3 * j + 1]
+            sigma = params[3 * j + 2]
+            z = (x[i] - mu) / sigma
+            g = np.exp(-0.5 * z * z) / (sigma * SQRT_2_PI)
+            amp_g_over_sigma = amp * g / sigma
+            jac[i, 3 * j] = g
+            jac[i, 3 * j + 1] = amp_g_over_sigma * z
+            jac[i, 3 * j + 2] = amp_g_over_sigma * (z * z - 1)
+    return jac
+
+
+def _get_kernels() -> tuple:
+    """
+    INTERNAL FUNCTION -
+    Compile the kernels the first time they are needed. numba keeps them in its on disk
+    cache, so other processes (e.g. the fit_all workers) don't compile them again
+
+    :return: (model, jacobian)
+    """
+    global _kernels
+    if _kernels is None:
+        import numba
+        jit = numba.njit(cache=True, nogil=True)
+        _kernels = (jit(_ngaussian_loop), jit(_ngaussian_jac_loop))
+    return _kernels
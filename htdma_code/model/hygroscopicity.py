@@ -0,0 +1,230 @@
+"""
+hygroscopicity - growth factors and kappa of the fitted peaks
+
+DMA 1 selects dry particles of one diameter (DMA_1.dp_dist_center). After they are humidified,
+each peak fitted to a scan of DMA 2 is a population that grew to the peak's dp. The growth
+factor of a peak is
+
+    GF = dp_peak / dp_dry
+
+and its hygroscopicity parameter kappa follows from kappa-Koehler theory (Petters and
+Kreidenweis, 2007, https://doi.org/10.5194/acp-7-1961-2007). At equilibrium with the RH of
+DMA 2,
+
+    S = (GF^3 - 1) / (GF^3 - (1 - kappa)) * exp(A / (dp_dry * GF)),   A = 4 sigma Mw / (R T rho_w)
+
+where S = RH / 100. Since GF is measured, this is solved for kappa in closed form, so whole
+arrays of peaks are done at once with no iteration:
+
+    kappa = (GF^3 - 1) * (exp(A / (dp_dry * GF)) / S - 1)
+"""
+from typing import List
+
+import numpy as np
+
+from htdma_code.model.scan import PeakFitResult
+
+# Properties of water for the Kelvin term (SI units)
+WATER_MOLAR_MASS_KG_PER_MOL = 0.018015
+WATER_DENSITY_KG_PER_M3 = 997.0
+GAS_CONSTANT_J_PER_MOL_K = 8.314462618
+
+# Surface tension of the droplets, taken as that of pure water (N/m)
+DEFAULT_SURFACE_TENSION_N_PER_M = 0.072
+
+# Bisection steps of growth_factor_from_kappa. 50 takes a bracket a few GF wide below 1e-14
+GF_BISECTION_ITERATIONS = 50
+
+# Column names of RunHygroscopicity.to_dataframe
+COLUMN_NAMES = ["scan", "peak", "dp", "growth_factor", "kappa"]
+
+
+def kelvin_diameter_nm(temp_k, surface_tension_n_per_m=DEFAULT_SURFACE_TENSION_N_PER_M):
+    """
+    The Kelvin diameter A = 4 sigma Mw / (R T rho_w) of water
+
+    :param temp_k: the temperature (K), a float or a numpy array
+    :param surface_tension_n_per_m: the surface tension of the droplets (N/m)
+    :return: A in nanometers (about 2.1 nm at room temperature)
+    """
+    a_m = 4 * surface_tension_n_per_m * WATER_MOLAR_MASS_KG_PER_MOL / \
+          (GAS_CONSTANT_J_PER_MOL_K * np.asarray(temp_k, dtype=float) * WATER_DENSITY_KG_PER_M3)
+    return a_m * 1e9
+
+
+def growth_factor(dp_nm, dp_dry_nm):
+    """
+    :param dp_nm: the humidified diameter(s), e.g. the dp of fitted peaks
+    :param dp_dry_nm: the dry diameter(s) selected by DMA 1
+    :return: dp_nm / dp_dry_nm, broadcast over the arrays given
+    """
+    dp_dry_nm = np.asarray(dp_dry_nm, dtype=float)
+    if np.any(dp_dry_nm <= 0):
+        raise ValueError("growth_factor - the dry diameter must be > 0")
+    return np.asarray(dp_nm, dtype=float) / dp_dry_nm
+
+
+def kappa_from_growth_factor(gf, dp_dry_nm, rh, temp_k, surface_tension_n_per_m=DEFAULT_SURFACE_TENSION_N_PER_M):
+    """
+    Solve kappa-Koehler theory for kappa, given the growth factor at a known RH. All arguments
+    can be floats or numpy arrays, and are broadcast against each other.
+
+    A growth factor below 1 gives a negative kappa. That is left as is, since it usually means
+    the particles restructured (or the peak is not real), and is worth seeing in a time series.
+
+    :param gf: the growth factor(s)
+    :param dp_dry_nm: the dry diameter(s) (nm)
+    :param rh: the relative humidity of DMA 2 (%)
+    :param temp_k: the temperature (K)
+    :param surface_tension_n_per_m: the surface tension of the droplets (N/m)
+    :return: kappa, NaN where gf is not > 0
+    """
+    rh = np.asarray(rh, dtype=float)
+    if np.any(rh <= 0):
+        raise ValueError("kappa_from_growth_factor - rh must be > 0")
+    gf = np.asarray(gf, dtype=float)
+    dp_dry_nm = np.asarray(dp_dry_nm, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        kelvin = np.exp(kelvin_diameter_nm(temp_k, surface_tension_n_per_m) / (dp_dry_nm * gf))
+        kappa = (gf ** 3 - 1) * (kelvin / (rh / 100) - 1)
+    return np.where(gf > 0, kappa, np.nan)
+
+
+def growth_factor_from_kappa(kappa, dp_dry_nm, rh, temp_k, surface_tension_n_per_m=DEFAULT_SURFACE_TENSION_N_PER_M,
+                             num_iterations: int = GF_BISECTION_ITERATIONS):
+    """
+    Solve kappa-Koehler theory for the equilibrium growth factor of particles with a known kappa.
+    This direction has no closed form, so it is solved by bisection, on all the values at once.
+    The bracket is [1, GF without the Kelvin term], which holds the only root below 100% RH.
+    All arguments can be floats or numpy arrays, and are broadcast against each other.
+
+    For many lookups at one temperature, KoehlerGrid (see koehler_grid) is much faster.
+
+    :param kappa: the hygroscopicity parameter(s), >= 0
+    :param dp_dry_nm: the dry diameter(s) (nm)
+    :param rh: the relative humidity (%), below 100
+    :param temp_k: the temperature (K)
+    :param surface_tension_n_per_m: the surface tension of the droplets (N/m)
+    :param num_iterations: the number of bisection steps. Each one halves the bracket
+    :return: the growth factor(s)
+    """
+    (kappa, dp_dry_nm, rh) = np.broadcast_arrays(*(np.asarray(value, dtype=float) for value in (kappa, dp_dry_nm, rh)))
+    if np.any(kappa < 0):
+        raise ValueError("growth_factor_from_kappa - kappa must be >= 0")
+    if np.any((rh <= 0) | (rh >= 100)):
+        raise ValueError("growth_factor_from_kappa - rh must be between 0 and 100")
+    s = rh / 100
+    kelvin_nm = kelvin_diameter_nm(temp_k, surface_tension_n_per_m)
+
+    low = np.ones(kappa.shape)
+    high = np.cbrt(1 + kappa * s / (1 - s))
+    for _ in range(num_iterations):
+        gf = (low + high) / 2
+        gf3_minus_1 = gf ** 3 - 1
+        with np.errstate(divide="ignore", invalid="ignore"):
+            is_below = gf3_minus_1 / (gf3_minus_1 + kappa) * np.exp(kelvin_nm / (dp_dry_nm * gf)) < s
+        low = np.where(is_below, gf, low)
+        high = np.where(is_below, high, gf)
+    return (low + high) / 2
+
+
+class RunHygroscopicity:
+    """
+    RunHygroscopicity holds the growth factor and kappa of every fitted peak of a run, one
+    entry per peak in scan order, as the time series of the run
+
+    Attributes:
+        * scan_index - the scan of each peak
+        * peak_index - the index of each peak within its scan
+        * dp_nm - the fitted dp of each peak
+        * growth_factor - the growth factor of each peak
+        * kappa - the kappa of each peak
+        * dp_dry_nm - the dry diameter(s) the growth factors are relative to
+        * rh - the relative humidity (%) of DMA 2
+        * temp_k - the temperature (K)
+    """
+    def __init__(self, scan_index: np.ndarray, peak_index: np.ndarray, dp_nm: np.ndarray,
+                 growth_factor: np.ndarray, kappa: np.ndarray, dp_dry_nm, rh, temp_k):
+        self.scan_index = scan_index
+        self.peak_index = peak_index
+        self.dp_nm = dp_nm
+        self.growth_factor = growth_factor
+        self.kappa = kappa
+        self.dp_dry_nm = dp_dry_nm
+        self.rh = rh
+        self.temp_k = temp_k
+
+    def __repr__(self):
+        s = "RunHygroscopicity:\n"
+        s += "  Num peaks: {}\n".format(self.get_num_peaks())
+        s += "  Num scans: {}\n".format(len(np.unique(self.scan_index)))
+        if self.get_num_peaks() > 0:
+            s += "  growth factor: {:.3f} - {:.3f}\n".format(np.nanmin(self.growth_factor),
+                                                               np.nanmax(self.growth_factor))
+            s += "  kappa: {:.3f} - {:.3f}\n".format(np.nanmin(self.kappa), np.nanmax(self.kappa))
+        return s
+
+    def __len__(self):
+        return self.get_num_peaks()
+
+    def get_num_peaks(self) -> int:
+        """
+        :return: the number of peaks, over all scans
+        """
+        return self.scan_index.shape[0]
+
+    def to_dataframe(self):
+        """
+        :return: one row per peak, with the COLUMN_NAMES
+        """
+        import pandas as pd
+        return pd.DataFrame(dict(zip(COLUMN_NAMES, (self.scan_index, self.peak_index, self.dp_nm,
+                                                    self.growth_factor, self.kappa))))
+
+
+def compute_run_hygroscopicity(peak_fit_results: List[List[PeakFitResult]], dp_dry_nm, rh, temp_k,
+                               surface_tension_n_per_m=DEFAULT_SURFACE_TENSION_N_PER_M,
+                               first_scan_index: int = 0) -> RunHygroscopicity:
+    """
+    Compute the growth factor and kappa of every fitted peak of a run in one go, and set them
+    on the PeakFitResults too.
+
+    dp_dry_nm, rh and temp_k can be a single value for the whole run (e.g. DMA_1.dp_dist_center,
+    RunParams.rh and RunParams.temp_k), or an array with one value per scan.
+
+    :param peak_fit_results: the PeakFitResult list of each scan, e.g. FitResultSet.peak_fit_results.
+                             None for a scan that was not fitted
+    :param dp_dry_nm: the dry diameter selected by DMA 1 (nm)
+    :param rh: the relative humidity of DMA 2 (%)
+    :param temp_k: the temperature (K)
+    :param surface_tension_n_per_m: the surface tension of the droplets (N/m)
+    :param first_scan_index: the index of the scan of peak_fit_results[0] in the run
+    :return: a RunHygroscopicity
+    """
+    num_scans = len(peak_fit_results)
+    counts = np.array([len(peaks) if peaks else 0 for peaks in peak_fit_results], dtype=np.intp)
+    all_peaks = [peak for peaks in peak_fit_results if peaks for peak in peaks]
+    dp_nm = np.fromiter((peak.dp for peak in all_peaks), dtype=float, count=len(all_peaks))
+
+    scan_index = np.repeat(np.arange(num_scans), counts)
+    peak_index = np.arange(len(all_peaks)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    def _per_peak(value):
+        # A value per scan becomes a value per peak
+        value = np.asarray(value, dtype=float)
+        if value.ndim == 0:
+            return value
+        if value.shape != (num_scans,):
+            raise ValueError("compute_run_hygroscopicity - expected one value per scan ({}), got {}".format(
+                num_scans, value.shape))
+        return value[scan_index]
+
+    gf = growth_factor(dp_nm, _per_peak(dp_dry_nm))
+    kappa = kappa_from_growth_factor(gf, _per_peak(dp_dry_nm), _per_peak(rh), _per_peak(temp_k),
+                                     surface_tension_n_per_m)
+
+    for (peak, peak_gf, peak_kappa) in zip(all_peaks, gf.tolist(), kappa.tolist()):
+        peak.growth_factor = peak_gf
+        peak.kappa = peak_kappa
+
+    return RunHygroscopicity(scan_index + first_scan_index, peak_index, dp_nm, gf, kappa, dp_dry_nm, rh, temp_k)
@@ -0,0 +1,402 @@
+"""
+inversion - growth factor distributions of the scans, by inverting the TDMA kernel
+
+Fitting gaussians to a scan ignores that neither DMA selects a single size. DMA 1 passes dry
+particles with its transfer function Omega_1(Dd), and channel i of the DMA 2 scan counts the
+grown particles with Omega_2,i(g Dd) (see transfer_function). For P(g), the number concentration
+of the particles in each growth factor bin, a scan of dN/dlogDp values is then
+
+    y_i = sum_g K(i, g) P(g),   K(i, g) = ln(10) / A_i * integral w(Dd) Omega_2,i(g Dd) dln Dd
+
+where w is Omega_1 normalized to 1 over ln Dd (the dry particles are taken to be evenly spread
+over DMA 1's narrow window) and A_i is the area of Omega_2,i over ln dp, the same width the
+instrument divides the counts of channel i by. Each channel only sees a narrow band of growth
+factors, so K is kept as a sparse matrix.
+
+InversionKernel builds K once per run configuration (dp channels, DMA 1 voltage, flows, DMA and
+gas conditions, growth factor grid), along with the Cholesky factorization of the Tikhonov
+regularized normal equations (K^T K + lambda^2 L^T L) P = K^T y, with L the second difference.
+Inverting a batch of scans solves those for all of them with that one factorization, which gives
+a smooth first guess, then makes it non-negative by either
+    * "twomey" - a simultaneous form of Twomey's (1975) multiplicative iteration,
+                 P <- P * K^T (y / K P) / K^T 1, run on every scan of the batch at once
+    * "nnls" - scipy.optimize.nnls of each scan against K stacked on lambda L
+InversionResult holds the growth factor probability density of each scan, normalized to 1
+over g. get_inversion_kernel caches the kernels.
+"""
+import math
+from functools import lru_cache
+from typing import List
+
+import numpy as np
+import scipy.linalg
+import scipy.optimize
+import scipy.sparse
+from numpy.lib.stride_tricks import sliding_window_view
+
+from htdma_code.model.mobility import get_mobility_table
+from htdma_code.model.transfer_function import TransferKernel, centroid_mobility, channel_voltages, \
+    diffusion_sigma, flow_parameters, log_bin_edges
+
+# The ways of making the first guess non-negative (see the module docstring)
+INVERSION_METHODS = ("twomey", "nnls")
+DEFAULT_INVERSION_METHOD = "twomey"
+
+# The growth factor grid, if none is given
+DEFAULT_GF_RANGE = (0.8, 3.0)
+DEFAULT_NUM_GF = 100
+
+# Weight of the smoothness of P in the first guess, relative to the size of K^T K
+DEFAULT_REGULARIZATION = 0.1
+
+# Kernel values below this fraction of the largest one are dropped from the sparse matrix
+KERNEL_CUTOFF = 1e-6
+
+# How far past DMA 1's transfer function without diffusion (in units of the diffusion sigma) the dry dp grid goes
+DRY_SIGMA_MARGIN = 4
+
+# The channel areas are integrated from dp_range[0] / AREA_DP_FACTOR to dp_range[-1] * AREA_DP_FACTOR,
+# with this log dp step
+AREA_DP_FACTOR = 2.0
+AREA_LOG_DP_STEP = 0.005
+
+# Twomey iterations stop after this many, or once no growth factor bin of a scan changes by more
+# than TWOMEY_TOLERANCE of the scan's largest bin
+TWOMEY_MAX_ITERATIONS = 200
+TWOMEY_TOLERANCE = 1e-3
+
+# The first guess is raised to at least this fraction of the scan's largest bin before the Twomey
+# iterations, since they can never move a bin away from 0
+TWOMEY_FLOOR = 1e-3
+
+# Number of kernels (i.e. different run configurations / growth factor grids) kept around
+MAX_CACHED_INVERSION_KERNELS = 8
+
+# The columns of InversionResult.to_dataframe
+COLUMN_NAMES = ["scan", "total_conc", "mean_gf", "nrmse"]
+
+
+class InversionResult:
+    """
+    InversionResult holds the growth factor distribution of each inverted scan, in scan order
+
+    Attributes:
+        * scan_index - the index of each scan in the run
+        * gf - the growth factor at the center of each bin
+        * gf_widths - the width of each growth factor bin
+        * conc - the number concentration in each growth factor bin, shape (n_scans, n_gf)
+        * pdf - the growth factor probability density, normalized to 1 over gf, shape (n_scans, n_gf)
+        * total_conc - the number concentration of all growth factors, per scan
+        * mean_gf - the mean growth factor, per scan
+        * fit_values - the scans the distributions give back, shape (n_scans, n_dp)
+        * nrmse - the rmse of fit_values divided by the root sum of squares of the scan, per scan
+        * method - the inversion method ("twomey" or "nnls")
+    """
+    def __init__(self, scan_index: np.ndarray, gf: np.ndarray, gf_widths: np.ndarray, conc: np.ndarray,
+                 fit_values: np.ndarray, nrmse: np.ndarray, method: str):
+        self.scan_index = scan_index
+        self.gf = gf
+        self.gf_widths = gf_widths
+        self.conc = conc
+        self.fit_values = fit_values
+        self.nrmse = nrmse
+        self.method = method
+
+        self.total_conc = conc.sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.pdf = np.where(self.total_conc[:, np.newaxis] > 0,
+                                conc / self.total_conc[:, np.newaxis] / gf_widths, 0.0)
+            self.mean_gf = conc @ gf / self.total_conc
+
+    def __repr__(self):
+        s = "InversionResult:\n"
+        s += "  Num scans: {}\n".format(self.get_num_scans())
+        s += "  gf: {:.3f} - {:.3f} ({} bins)\n".format(self.gf[0], self.gf[-1], self.gf.shape[0])
+        s += "  method: {}\n".format(self.method)
+        if self.get_num_scans() > 0:
+            s += "  mean gf: {:.3f} - {:.3f}\n".format(np.nanmin(self.mean_gf), np.nanmax(self.mean_gf))
+        return s
+
+    def __len__(self):
+        return self.get_num_scans()
+
+    def get_num_scans(self) -> int:
+        """
+        :return: the number of scans inverted
+        """
+        return self.scan_index.shape[0]
+
+    def to_dataframe(self):
+        """
+        :return: a pandas DataFrame with one row per scan, with the COLUMN_NAMES followed by the pdf in a
+                 column per growth factor
+        """
+        # Imported here so that Scan does not pull pandas in
+        import pandas as pd
+        df = pd.DataFrame(dict(zip(COLUMN_NAMES, (self.scan_index, self.total_conc, self.mean_gf, self.nrmse))))
+        df_pdf = pd.DataFrame(self.pdf, columns=["pdf_{:.4f}".format(gf) for gf in self.gf.tolist()])
+        return pd.concat([df, df_pdf], axis=1)
+
+
+def concat_inversion_results(results: List[InversionResult]) -> InversionResult:
+    """
+    Put the results of several batches of scans (e.g. inverted with the kernels of different
+    flows) back together in scan order. They must share the same growth factor grid
+
+    :param results: the InversionResults
+    :return: one InversionResult with all the scans
+    """
+    if not results:
+        raise ValueError("concat_inversion_results - no results")
+    for result in results[1:]:
+        if not np.array_equal(result.gf, results[0].gf) or result.method != results[0].method:
+            raise ValueError("concat_inversion_results - the results have different growth factor grids or methods")
+    scan_index = np.concatenate([result.scan_index for result in results])
+    order = np.argsort(scan_index, kind="stable")
+
+    def _concat(name):
+        return np.concatenate([getattr(result, name) for result in results])[order]
+
+    return InversionResult(scan_index[order], results[0].gf, results[0].gf_widths, _concat("conc"),
+                           _concat("fit_values"), _concat("nrmse"), results[0].method)
+
+
+class InversionKernel:
+    """
+    InversionKernel holds the TDMA kernel K of a run configuration, and everything needed to
+    invert batches of scans against it (see the module docstring)
+
+    Attributes:
+        * dp_range - the dp of each channel of the scans (nm)
+        * gf - the growth factor at the center of each bin, log spaced
+        * gf_widths - the width of each growth factor bin
+        * dp_dry_nm - the centroid dp of DMA 1
+        * num_dry_dp - the number of dry dp values DMA 1's transfer function is integrated over
+        * regularization - the weight of the smoothness of P in the first guess
+        * matrix - K, a scipy.sparse CSR matrix of shape (n_dp, n_gf)
+    """
+    def __init__(self, dp_range: np.ndarray, voltage_1: float, q_sh_lpm: float, q_aIn_lpm: float,
+                 q_aOut_lpm: float, q_excess_lpm: float, length_cm: float, radius_in_cm: float,
+                 radius_out_cm: float, mean_free_path_nm: float, mu_gas_viscosity_poise: float, temp_k: float,
+                 gf_range: tuple = DEFAULT_GF_RANGE, num_gf: int = DEFAULT_NUM_GF, is_diffusing: bool = True,
+                 regularization: float = DEFAULT_REGULARIZATION):
+        """
+        Both DMAs have the same flows and dimensions, as in the run files
+
+        :param dp_range: the dp of each channel of the scans (nm), increasing
+        :param voltage_1: the voltage of DMA 1
+        :param q_sh_lpm: the sheath flow
+        :param q_aIn_lpm: the aerosol flow in
+        :param q_aOut_lpm: the sample flow out
+        :param q_excess_lpm: the excess flow
+        :param length_cm: the length of the DMAs
+        :param radius_in_cm: the radius of the inner electrodes
+        :param radius_out_cm: the radius of the outer electrodes
+        :param mean_free_path_nm: mean free path of the gas in nanometers
+        :param mu_gas_viscosity_poise: gas viscosity in Poise
+        :param temp_k: the temperature (K)
+        :param gf_range: the (smallest, largest) growth factor
+        :param num_gf: the number of growth factor bins
+        :param is_diffusing: True to include diffusion in the transfer functions
+        :param regularization: the weight of the smoothness of P in the first guess, relative to K
+        """
+        dp_range = np.asarray(dp_range, dtype=float)
+        (gf_min, gf_max) = gf_range
+        if not 0 < gf_min < gf_max:
+            raise ValueError("InversionKernel: gf_range {} must be increasing and > 0".format(gf_range))
+        if num_gf < 3:
+            raise ValueError("InversionKernel: num_gf = {} must be at least 3".format(num_gf))
+        if voltage_1 <= 0:
+            raise ValueError("InversionKernel: the voltage of DMA 1 must be > 0")
+        if regularization < 0:
+            raise ValueError("InversionKernel: the regularization must be >= 0")
+        flows = (q_sh_lpm, q_aIn_lpm, q_aOut_lpm, q_excess_lpm)
+        geometry = (length_cm, radius_in_cm, radius_out_cm)
+        gas = (mean_free_path_nm, mu_gas_viscosity_poise, temp_k)
+        self.dp_range = dp_range
+        self.regularization = regularization
+
+        log_gf = np.linspace(math.log(gf_min), math.log(gf_max), num_gf)
+        log_step = log_gf[1] - log_gf[0]
+        self.gf = np.exp(log_gf)
+        self.gf_widths = np.diff(np.exp(log_bin_edges(self.gf)))
+
+        # The dry particles DMA 1 passes, on a dp grid with the same log step as the growth factors
+        table = get_mobility_table(mean_free_path_nm, mu_gas_viscosity_poise, 1)
+        zp_1 = centroid_mobility(voltage_1, q_sh_lpm, q_excess_lpm, *geometry)
+        self.dp_dry_nm = float(table.Zp_to_Dp(zp_1))
+        (beta, delta) = flow_parameters(*flows)
+        sigma = diffusion_sigma(voltage_1, temp_k, *geometry) if is_diffusing else 0.0
+        zeta_margin = beta * (1 + abs(delta)) + DRY_SIGMA_MARGIN * sigma
+        (dp_dry_min, dp_dry_max) = table.Zp_to_Dp(zp_1 * np.array([1 + zeta_margin, max(1 - zeta_margin, beta)]))
+        self.num_dry_dp = int(math.ceil(math.log(dp_dry_max / dp_dry_min) / log_step)) + 1
+        dp_dry = dp_dry_min * np.exp(log_step * np.arange(self.num_dry_dp))
+        dry_weights = TransferKernel(dp_dry, voltage_1, *flows, *geometry, *gas, is_diffusing=is_diffusing).values[0]
+        dry_weights = dry_weights / dry_weights.sum()
+
+        # DMA 2's channels, for the wet particles of every growth factor and dry dp. Growth factor j
+        # of dry dp k lands in wet dp bin j + k, so each column of K sums a window of num_dry_dp bins
+        dp_wet = self.gf[0] * dp_dry_min * np.exp(log_step * np.arange(num_gf + self.num_dry_dp - 1))
+        voltages = channel_voltages(dp_range, q_sh_lpm, q_excess_lpm, *geometry, mean_free_path_nm,
+                                    mu_gas_viscosity_poise)
+        omega_2 = TransferKernel(dp_wet, voltages, *flows, *geometry, *gas, is_diffusing=is_diffusing).values
+        matrix = sliding_window_view(omega_2, self.num_dry_dp, axis=1) @ dry_weights
+
+        # From counts to dN/dlogDp, the way the instrument does it
+        dp_area = np.exp(np.arange(math.log(dp_range[0] / AREA_DP_FACTOR), math.log(dp_range[-1] * AREA_DP_FACTOR),
+                                   AREA_LOG_DP_STEP))
+        area_kernel = TransferKernel(dp_area, voltages, *flows, *geometry, *gas, is_diffusing=is_diffusing)
+        matrix *= math.log(10) / (area_kernel.values @ area_kernel.log_dp_widths)[:, np.newaxis]
+        matrix[matrix < KERNEL_CUTOFF * matrix.max()] = 0
+        self.matrix = scipy.sparse.csr_matrix(matrix)
+
+        # The regularized normal equations, factorized once for every scan inverted with this kernel.
+        # A tiny ridge keeps them positive definite when some growth factors are out of the scan's reach
+        self._second_difference = scipy.sparse.diags([1.0, -2.0, 1.0], [0, 1, 2], shape=(num_gf - 2, num_gf))
+        gram = (self.matrix.T @ self.matrix).toarray()
+        smoothness = (self._second_difference.T @ self._second_difference).toarray()
+        scale = np.trace(gram) / num_gf
+        self._smoothing = regularization ** 2 * scale * num_gf / np.trace(smoothness)
+        self._factor = scipy.linalg.cho_factor(gram + self._smoothing * smoothness + 1e-10 * scale * np.eye(num_gf))
+        self._column_sums = np.asarray(self.matrix.sum(axis=0)).ravel()
+        self._augmented = None
+
+    def __repr__(self):
+        s = "InversionKernel:\n"
+        s += "  dp: {:.1f} - {:.1f} nm ({} channels)\n".format(self.dp_range[0], self.dp_range[-1],
+                                                              self.dp_range.shape[0])
+        s += "  gf: {:.3f} - {:.3f} ({} bins)\n".format(self.gf[0], self.gf[-1], self.gf.shape[0])
+        s += "  dry dp: {:.2f} nm ({} points)\n".format(self.dp_dry_nm, self.num_dry_dp)
+        s += "  non-zeros: {} of {}\n".format(self.matrix.nnz, self.matrix.shape[0] * self.matrix.shape[1])
+        return s
+
+    def invert(self, conc: np.ndarray, method: str = DEFAULT_INVERSION_METHOD,
+               scan_index: np.ndarray = None) -> InversionResult:
+        """
+        Invert a batch of scans to their growth factor distributions
+
+        :param conc: one scan, or a (n_scans, n_dp) matrix of them (dN/dlogDp). NaN and negative values count as 0
+        :param method: "twomey" or "nnls" (see the module docstring)
+        :param scan_index: [Optional] the index of each scan in the run. Defaults to 0, 1, ...
+        :return: an InversionResult
+        """
+        if method not in INVERSION_METHODS:
+            raise ValueError("invert - method must be one of {}, not {}".format(INVERSION_METHODS, method))
+        conc = np.atleast_2d(np.asarray(conc, dtype=float))
+        if conc.shape[1] != self.dp_range.shape[0]:
+            raise ValueError("invert - expected {} dp values, got {}".format(self.dp_range.shape[0], conc.shape[1]))
+        if scan_index is None:
+            scan_index = np.arange(conc.shape[0])
+        y = np.where(np.isfinite(conc) & (conc > 0), conc, 0.0)
+
+        # The first guess of every scan, with the one factorization
+        first_guess = scipy.linalg.cho_solve(self._factor, self.matrix.T @ y.T).T
+        if method == "twomey":
+            gf_conc = self._twomey(y, first_guess)
+        else:
+            gf_conc = self._nnls(y)
+
+        fit_values = (self.matrix @ gf_conc.T).T
+        y_norm = np.sqrt(np.sum(y * y, axis=1))
+        rmse = np.sqrt(np.mean((y - fit_values) ** 2, axis=1))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            nrmse = np.where(y_norm > 0, rmse / y_norm, np.inf)
+        return InversionResult(np.asarray(scan_index), self.gf, self.gf_widths, gf_conc, fit_values, nrmse, method)
+
+    def _twomey(self, y: np.ndarray, first_guess: np.ndarray) -> np.ndarray:
+        """
+        INTERNAL FUNCTION -
+        The Twomey iterations of every scan at once, from the first guesses
+
+        :return: the number concentration in each growth factor bin, shape (n_scans, n_gf)
+        """
+        is_seen = self._column_sums > 0
+        column_sums = np.where(is_seen, self._column_sums, 1.0)
+        gf_conc = np.maximum(first_guess, TWOMEY_FLOOR * np.maximum(first_guess.max(axis=1, keepdims=True), 0))
+        gf_conc[:, ~is_seen] = 0
+
+        # Only the scans that have not converged yet keep iterating
+        i_active = np.arange(y.shape[0])
+        for _ in range(TWOMEY_MAX_ITERATIONS):
+            if i_active.shape[0] == 0:
+                break
+            current = gf_conc[i_active]
+            fit = self.matrix @ current.T
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ratio = np.where(fit > 0, y[i_active].T / fit, 1.0)
+            updated = current * ((self.matrix.T @ ratio).T / column_sums)
+            gf_conc[i_active] = updated
+            largest = updated.max(axis=1)
+            change = np.max(np.abs(updated - current), axis=1)
+            i_active = i_active[change > TWOMEY_TOLERANCE * largest]
+        return gf_conc
+
+    def _nnls(self, y: np.ndarray) -> np.ndarray:
+        """
+        INTERNAL FUNCTION -
+        Non-negative least squares of each scan against K stacked on the smoothness rows
+
+        :return: the number concentration in each growth factor bin, shape (n_scans, n_gf)
+        """
+        if self._augmented is None:
+            self._augmented = np.vstack([self.matrix.toarray(),
+                                         math.sqrt(self._smoothing) * self._second_difference.toarray()])
+        zeros = np.zeros(self._second_difference.shape[0])
+        return np.array([scipy.optimize.nnls(self._augmented, np.concatenate((row, zeros)))[0] for row in y])
+
+
+@lru_cache(maxsize=MAX_CACHED_INVERSION_KERNELS)
+def _get_inversion_kernel(dp_range: tuple, voltage_1: float, flows: tuple, geometry: tuple, mean_free_path_nm: float,
+                          mu_gas_viscosity_poise: float, temp_k: float, gf_range: tuple, num_gf: int,
+                          is_diffusing: bool, regularization: float) -> InversionKernel:
+    """
+    INTERNAL FUNCTION -
+    The cached part of get_inversion_kernel. The dp values are a tuple, so they can be hashed
+    """
+    return InversionKernel(np.array(dp_range), voltage_1, *flows, *geometry, mean_free_path_nm,
+                           mu_gas_viscosity_poise, temp_k, gf_range=gf_range, num_gf=num_gf,
+                           is_diffusing=is_diffusing, regularization=regularization)
+
+
+def get_inversion_kernel(dp_range: np.ndarray, voltage_1: float, q_sh_lpm: float, q_aIn_lpm: float,
+                         q_aOut_lpm: float, q_excess_lpm: float, length_cm: float, radius_in_cm: float,
+                         radius_out_cm: float, mean_free_path_nm: float, mu_gas_viscosity_poise: float,
+                         temp_k: float, gf_range: tuple = DEFAULT_GF_RANGE, num_gf: int = DEFAULT_NUM_GF,
+                         is_diffusing: bool = True,
+                         regularization: float = DEFAULT_REGULARIZATION) -> InversionKernel:
+    """
+    Get the InversionKernel of a run configuration. Kernels are only built (and factorized) the
+    first time they are asked for, and the most recently used MAX_CACHED_INVERSION_KERNELS are kept.
+
+    See InversionKernel for the arguments.
+
+    :return: the InversionKernel
+    """
+    flows = (float(q_sh_lpm), float(q_aIn_lpm), float(q_aOut_lpm), float(q_excess_lpm))
+    geometry = (float(length_cm), float(radius_in_cm), float(radius_out_cm))
+    return _get_inversion_kernel(tuple(np.asarray(dp_range, dtype=float).tolist()), float(voltage_1), flows, geometry,
+                                 float(mean_free_path_nm), float(mu_gas_viscosity_poise), float(temp_k),
+                                 (float(gf_range[0]), float(gf_range[1])), int(num_gf), bool(is_diffusing),
+                                 float(regularization))
+
+
+def get_run_inversion_kernel(setup, dma1, dp_range: np.ndarray, scan_params=None, **kwargs) -> InversionKernel:
+    """
+    Get the InversionKernel for the scans of a run that has been read into a Setup, with DMA 1
+    at its current voltage
+
+    :param setup: the Setup of the run
+    :param dma1: the run's DMA_1
+    :param dp_range: the dp of each channel of the scans (nm)
+    :param scan_params: [Optional] the ScanParams with the flows of the scans. Defaults to setup.scan_params
+    :param kwargs: gf_range, num_gf, is_diffusing or regularization (see InversionKernel)
+    :return: the InversionKernel
+    """
+    if scan_params is None:
+        scan_params = setup.scan_params
+    dma = setup.dma_1_params
+    run_params = setup.run_params
+    return get_inversion_kernel(dp_range, dma1.voltage, scan_params.q_sh_lpm, scan_params.q_aIn_lpm,
+                                scan_params.q_aOut_lpm, scan_params.q_excess_lpm, dma.length_cm, dma.radius_in_cm,
+                                dma.radius_out_cm, run_params.mean_free_path_m * 1e9,
+                                run_params.mu_gas_viscosity_Pa_sec * 1e1, run_params.temp_k, **kwargs)
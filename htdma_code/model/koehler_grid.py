@@ -0,0 +1,257 @@
+"""
+koehler_grid - a precomputed kappa-Koehler growth factor grid, for fast lookups
+
+Getting kappa from a measured growth factor has a closed form (see
+hygroscopicity.kappa_from_growth_factor). Going the other way, the growth factor of particles
+with a given kappa, dry diameter and RH, has to be solved iteratively
+(hygroscopicity.growth_factor_from_kappa). KoehlerGrid solves it once for one temperature and
+surface tension, on a grid of
+
+    dry diameter  GRID_DP_DRY_MIN_NM - GRID_DP_DRY_MAX_NM, log spaced
+    kappa         0 - GRID_KAPPA_MAX, spaced as the square of a uniform grid (dense near 0)
+    RH            GRID_RH_MIN - GRID_RH_MAX %, uniform in ln(1 - RH / 100) (dense near 100%)
+
+and answers queries by trilinear interpolation of GF^3, which is close to linear in kappa
+and in RH / (100 - RH). All three axes are uniform after those transforms, so finding the
+cell of a query is arithmetic, not a search.
+
+Error bound: the interpolated growth factor is compared against the exact solver at the center
+of every grid cell, where trilinear interpolation is furthest from the grid points. The largest
+difference is kept as KoehlerGrid.max_error. For the default grid it is about 1e-3 in GF (at
+RH near GRID_RH_MAX), and about 2e-4 below 90% RH, which is far below the uncertainty
+of a measured growth factor. Queries outside the grid are solved exactly.
+
+Grids are saved as .npy files (plus a small .json of what they were built for) in the cache
+directory, and memory mapped when they are loaded again. Delete them at any time to have them
+rebuilt. Changing the grid (or GRID_FORMAT_VERSION) makes old files be ignored.
+"""
+import json
+import os
+from functools import lru_cache
+
+import numpy as np
+
+from htdma_code.model.fit_cache import DEFAULT_CACHE_DIR
+from htdma_code.model.hygroscopicity import DEFAULT_SURFACE_TENSION_N_PER_M, growth_factor_from_kappa
+
+# Bump this whenever the grid axes or the values stored change
+GRID_FORMAT_VERSION = 1
+
+# The grid axes (see above)
+GRID_DP_DRY_MIN_NM = 10.0
+GRID_DP_DRY_MAX_NM = 1000.0
+GRID_NUM_DP_DRY = 41
+GRID_KAPPA_MAX = 1.4
+GRID_NUM_KAPPA = 71
+GRID_RH_MIN = 10.0
+GRID_RH_MAX = 98.0
+GRID_NUM_RH = 89
+
+DEFAULT_GRID_DIR = os.path.join(DEFAULT_CACHE_DIR, "koehler_grids")
+
+# Number of grids (i.e. different temperatures / surface tensions) kept in memory
+MAX_CACHED_GRIDS = 8
+
+
+class KoehlerGrid:
+    """
+    KoehlerGrid answers kappa -> growth factor queries for one temperature and surface tension,
+    by interpolating a precomputed grid (see the top of this file for the grid and its error bound)
+
+    Attributes:
+        * temp_k - the temperature the grid was built for (K)
+        * surface_tension_n_per_m - the surface tension the grid was built for (N/m)
+        * gf3 - GF^3 on the grid, shape (GRID_NUM_DP_DRY, GRID_NUM_KAPPA, GRID_NUM_RH).
+                Memory mapped if the grid was loaded from a file
+        * max_error - the largest error in GF found at the cell centers
+    """
+    def __init__(self, temp_k: float, surface_tension_n_per_m: float = DEFAULT_SURFACE_TENSION_N_PER_M,
+                 gf3: np.ndarray = None, max_error: float = None):
+        """
+        :param temp_k: the temperature (K)
+        :param surface_tension_n_per_m: the surface tension of the droplets (N/m)
+        :param gf3: [Optional] the grid values, if they were already computed (e.g. loaded from a file).
+                    Otherwise the grid is built, and its error measured
+        :param max_error: the error bound of gf3, if it is given
+        """
+        if temp_k <= 0:
+            raise ValueError("KoehlerGrid: temperature must be > 0 K")
+        self.temp_k = temp_k
+        self.surface_tension_n_per_m = surface_tension_n_per_m
+
+        (log_dp_dry, kappa, rh) = _grid_axes()
+        self._log_dp_dry_start = log_dp_dry[0]
+        self._log_dp_dry_step = log_dp_dry[1] - log_dp_dry[0]
+        self._log_1_minus_s_start = np.log(1 - GRID_RH_MIN / 100)
+        self._log_1_minus_s_step = (np.log(1 - GRID_RH_MAX / 100) - self._log_1_minus_s_start) / (GRID_NUM_RH - 1)
+
+        if gf3 is None:
+            self.gf3 = growth_factor_from_kappa(kappa[np.newaxis, :, np.newaxis],
+                                                np.exp(log_dp_dry)[:, np.newaxis, np.newaxis],
+                                                rh[np.newaxis, np.newaxis, :],
+                                                temp_k, surface_tension_n_per_m) ** 3
+            self.max_error = self._measure_max_error()
+        else:
+            if gf3.shape != (GRID_NUM_DP_DRY, GRID_NUM_KAPPA, GRID_NUM_RH):
+                raise ValueError("KoehlerGrid: the grid values have the wrong shape {}".format(gf3.shape))
+            self.gf3 = gf3
+            self.max_error = max_error
+
+    def __repr__(self):
+        s = "KoehlerGrid:\n"
+        s += "  temp: {:.2f} K\n".format(self.temp_k)
+        s += "  surface tension: {:.4f} N/m\n".format(self.surface_tension_n_per_m)
+        s += "  dp dry: {:.0f} - {:.0f} nm, kappa: 0 - {}, rh: {} - {} %\n".format(
+            GRID_DP_DRY_MIN_NM, GRID_DP_DRY_MAX_NM, GRID_KAPPA_MAX, GRID_RH_MIN, GRID_RH_MAX)
+        s += "  max error: {:.2e}\n".format(self.max_error)
+        return s
+
+    def growth_factor(self, kappa, dp_dry_nm, rh):
+        """
+        Look up the equilibrium growth factor. The arguments are broadcast against each other.
+
+        :param kappa: the hygroscopicity parameter(s)
+        :param dp_dry_nm: the dry diameter(s) (nm)
+        :param rh: the relative humidity (%)
+        :return: the growth factor(s), within about max_error of growth_factor_from_kappa
+        """
+        (kappa, dp_dry_nm, rh) = np.broadcast_arrays(*(np.asarray(value, dtype=float)
+                                                       for value in (kappa, dp_dry_nm, rh)))
+
+        # Fractional grid coordinates along each (transformed) axis
+        with np.errstate(divide="ignore", invalid="ignore"):
+            coords = ((np.log(dp_dry_nm) - self._log_dp_dry_start) / self._log_dp_dry_step,
+                      np.sqrt(kappa / GRID_KAPPA_MAX) * (GRID_NUM_KAPPA - 1),
+                      (np.log(1 - rh / 100) - self._log_1_minus_s_start) / self._log_1_minus_s_step)
+        is_inside = np.ones(kappa.shape, dtype=bool)
+        cells = []
+        weights = []
+        for (coord, num_points) in zip(coords, self.gf3.shape):
+            is_inside &= (coord >= 0) & (coord <= num_points - 1)
+            cell = np.clip(np.floor(np.nan_to_num(coord)), 0, num_points - 2).astype(np.intp)
+            cells.append(cell)
+            weights.append(np.clip(np.nan_to_num(coord) - cell, 0, 1))
+
+        # Trilinear interpolation - interpolate along RH at the 4 (dp, kappa) corners of each cell,
+        # then along kappa, then along dp. Indexing the flattened grid saves 3-D fancy indexing
+        flat_gf3 = self.gf3.reshape(-1)
+        (num_kappa, num_rh) = self.gf3.shape[1:]
+        base = (cells[0] * num_kappa + cells[1]) * num_rh + cells[2]
+        (w_dp, w_kappa, w_rh) = weights
+        edges = []
+        for offset in (0, num_rh, num_kappa * num_rh, (num_kappa + 1) * num_rh):
+            low = flat_gf3[base + offset]
+            edges.append(low + w_rh * (flat_gf3[base + offset + 1] - low))
+        low = edges[0] + w_kappa * (edges[1] - edges[0])
+        high = edges[2] + w_kappa * (edges[3] - edges[2])
+        gf = np.cbrt(low + w_dp * (high - low))
+
+        # Anything off the grid gets solved exactly
+        if not np.all(is_inside):
+            gf[~is_inside] = growth_factor_from_kappa(kappa[~is_inside], dp_dry_nm[~is_inside], rh[~is_inside],
+                                                      self.temp_k, self.surface_tension_n_per_m)
+        if gf.ndim == 0:
+            return float(gf)
+        return gf
+
+    def _measure_max_error(self) -> float:
+        """
+        Internal helper to compare the interpolated growth factor against the exact one at the
+        center of every grid cell
+
+        :return: the largest difference found
+        """
+        (log_dp_dry, kappa, rh) = _grid_axes(cell_centers=True)
+        (kappa, dp_dry_nm, rh) = np.meshgrid(kappa, np.exp(log_dp_dry), rh)
+        exact = growth_factor_from_kappa(kappa, dp_dry_nm, rh, self.temp_k, self.surface_tension_n_per_m)
+        return float(np.max(np.abs(self.growth_factor(kappa, dp_dry_nm, rh) - exact)))
+
+
+def _grid_axes(cell_centers: bool = False) -> tuple:
+    """
+    INTERNAL FUNCTION -
+    :param cell_centers: True for the centers of the grid cells, rather than the grid points
+    :return: (log dry diameters, kappas, rhs) along the axes of the grid
+    """
+    def _axis(start, end, num_points):
+        axis = np.linspace(start, end, num_points)
+        return (axis[1:] + axis[:-1]) / 2 if cell_centers else axis
+
+    log_dp_dry = _axis(np.log(GRID_DP_DRY_MIN_NM), np.log(GRID_DP_DRY_MAX_NM), GRID_NUM_DP_DRY)
+    kappa = GRID_KAPPA_MAX * _axis(0, 1, GRID_NUM_KAPPA) ** 2
+    rh = 100 * (1 - np.exp(_axis(np.log(1 - GRID_RH_MIN / 100), np.log(1 - GRID_RH_MAX / 100), GRID_NUM_RH)))
+    return log_dp_dry, kappa, rh
+
+
+def get_grid_filenames(temp_k: float, surface_tension_n_per_m: float, grid_dir: str) -> tuple:
+    """
+    :return: (grid .npy file, .json file) that the grid for these conditions is saved in
+    """
+    base = os.path.join(grid_dir, "koehler_v{}_{:.2f}K_{:.5f}Nm".format(GRID_FORMAT_VERSION, temp_k,
+                                                                      surface_tension_n_per_m))
+    return base + ".npy", base + ".json"
+
+
+def load_koehler_grid(temp_k: float, surface_tension_n_per_m: float, grid_dir: str) -> KoehlerGrid:
+    """
+    Load a saved grid, memory mapped
+
+    :return: the KoehlerGrid, or None if there is no (usable) saved grid for these conditions
+    """
+    (grid_filename, meta_filename) = get_grid_filenames(temp_k, surface_tension_n_per_m, grid_dir)
+    try:
+        with open(meta_filename) as f:
+            meta = json.load(f)
+        if meta.get("format_version") != GRID_FORMAT_VERSION or \
+                meta.get("temp_k") != temp_k or meta.get("surface_tension_n_per_m") != surface_tension_n_per_m:
+            return None
+        gf3 = np.load(grid_filename, mmap_mode="r")
+        return KoehlerGrid(temp_k, surface_tension_n_per_m, gf3=gf3, max_error=meta["max_error"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_koehler_grid(grid: KoehlerGrid, grid_dir: str):
+    """
+    Save a grid, so it can be memory mapped later (see load_koehler_grid)
+    """
+    os.makedirs(grid_dir, exist_ok=True)
+    (grid_filename, meta_filename) = get_grid_filenames(grid.temp_k, grid.surface_tension_n_per_m, grid_dir)
+
+    # Write to temporary files and rename them, so a half written grid is never loaded
+    tmp_grid_filename = grid_filename + ".tmp.npy"
+    np.save(tmp_grid_filename, np.ascontiguousarray(grid.gf3, dtype=np.float64))
+    os.replace(tmp_grid_filename, grid_filename)
+    meta = {"format_version": GRID_FORMAT_VERSION,
+            "temp_k": grid.temp_k,
+            "surface_tension_n_per_m": grid.surface_tension_n_per_m,
+            "max_error": grid.max_error}
+    with open(meta_filename + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(meta_filename + ".tmp", meta_filename)
+
+
+@lru_cache(maxsize=MAX_CACHED_GRIDS)
+def get_koehler_grid(temp_k: float, surface_tension_n_per_m: float = DEFAULT_SURFACE_TENSION_N_PER_M,
+                     grid_dir: str = DEFAULT_GRID_DIR) -> KoehlerGrid:
+    """
+    Get the KoehlerGrid for a temperature and surface tension. It is loaded from grid_dir if it
+    was saved there before, otherwise built and saved. The most recently used MAX_CACHED_GRIDS
+    are kept in memory.
+
+    :param temp_k: the temperature (K)
+    :param surface_tension_n_per_m: the surface tension of the droplets (N/m)
+    :param grid_dir: the directory the grids are saved in
+    :return: the KoehlerGrid
+    """
+    temp_k = float(temp_k)
+    surface_tension_n_per_m = float(surface_tension_n_per_m)
+    grid = load_koehler_grid(temp_k, surface_tension_n_per_m, grid_dir)
+    if grid is None:
+        grid = KoehlerGrid(temp_k, surface_tension_n_per_m)
+        try:
+            save_koehler_grid(grid, grid_dir)
+        except OSError:
+            # e.g. a read only cache directory. The grid still works, it's just built again next time
+            pass
+    return grid
@@ -0,0 +1,208 @@
+"""
+mobility - converting between electrical mobility (Zp) and particle diameter (Dp)
+"""
+import math
+from functools import lru_cache
+
+import numpy as np
+from scipy.interpolate import PchipInterpolator
+
+# ELEM_CHARGE is the elementary charge of a particle in Columb.
+# Coulumb is in m-kg-sec, so multiply by 1e5 to get in our cm-g-sec
+# THEN, 1 Columb = 10^-1 statcoulumb, so multiply by 10
+#ELEM_CHARGE = 1.602e-19 * 1e5
+ELEM_CHARGE = 1.602e-19 * 1e5 * 1e1
+#ELEM_CHARGE = 1.602176634e-19 * 10e5
+
+# From wikipedia - proper value for cgs.... statcoulumbs?!?!
+#ELEM_CHARGE = 4.80320425e-10
+
+#TODO ERROR! Verify ELEM_CHARGE value. Something seems incorrect
+
+# Convergence settings for zp_to_dp. The Newton steps converge quadratically, so
+# the iteration limit is only a safety net
+ZP_TO_DP_RTOL = 1e-10
+ZP_TO_DP_MAX_ITERATIONS = 100
+
+# Sanity limits on a computed dp (nm)
+MIN_DP_CHECK = 1
+MAX_DP_CHECK = 15000
+
+# Converts the dp computed from the mobility equation (cgs) to nm
+# TODO ERROR! This is not the correct conversion! (cm to nm is 1e7)
+DP_CM_TO_NM = 1e7 * 1e1
+
+
+def cunningham_slip_correction(dp_nm, mean_free_path_nm):
+    """
+    Compute the Cunningham slip correction factor for a particle diameter, or an
+    array of them
+
+    :param dp_nm: particle diameter(s) in nanometers
+    :param mean_free_path_nm: mean free path of the gas in nanometers
+    :return: Cs, same shape as dp_nm
+    """
+    return 1 + (mean_free_path_nm / dp_nm) * \
+        (2.34 + 1.05 * np.exp(-0.39 * (dp_nm / mean_free_path_nm)))
+
+
+def zp_to_dp(Zp, mu_gas_viscosity_poise: float, mean_free_path_nm: float, n_ch: int = 1,
+             rtol: float = ZP_TO_DP_RTOL, max_iterations: int = ZP_TO_DP_MAX_ITERATIONS):
+    """
+    Compute the particle diameter Dp in nanometers from electrical mobility Zp, for a
+    single Zp or for a whole array of them in one call.
+
+    Dp is the root of
+        f(dp) = dp * Zp - K * Cs(dp),  with K = n_ch * e / (3 pi mu)
+    Cs decreases with dp, so f is increasing and concave, and has exactly one root.
+    Newton steps started from the Cs = 1 diameter (which is always left of the root) climb
+    to the root monotonically without overshooting. Each element stops iterating as soon
+    as its own relative step is below rtol.
+
+    :param Zp: center of electrical mobility, a float or an array
+    :param mu_gas_viscosity_poise: gas viscosity in Poise
+    :param mean_free_path_nm: mean free path of the gas in nanometers
+    :param n_ch: number of elementary charges on the particle
+    :param rtol: relative tolerance on dp
+    :param max_iterations: maximum number of Newton steps
+    :return: Dp in nanometers, a float for a scalar Zp or an array the shape of Zp
+    """
+    Zp_array = np.asarray(Zp, dtype=float)
+    zp = Zp_array.ravel()
+    k = n_ch * ELEM_CHARGE * DP_CM_TO_NM / (3 * math.pi * mu_gas_viscosity_poise)
+    lam = mean_free_path_nm
+
+    # Start with Cs = 1, the smallest it can be
+    dp = k / zp
+    active = np.flatnonzero(np.isfinite(dp) & (dp > 0))
+    for _ in range(max_iterations):
+        if active.size == 0:
+            break
+        d = dp[active]
+        e = 1.05 * np.exp(-0.39 * d / lam)
+        slip = lam * (2.34 + e)
+        f = d * zp[active] - k * (1 + slip / d)
+        df = zp[active] + k * (slip / d ** 2 + 0.39 * e / d)
+        step = f / df
+        dp[active] = d - step
+        active = active[np.abs(step) > rtol * dp[active]]
+
+    if active.size > 0:
+        raise ValueError("Zp_to_dp: too many iterations!")
+
+    dp = dp.reshape(Zp_array.shape)
+    if dp.ndim == 0:
+        return float(dp)
+    return dp
+
+
+# Number of log spaced dp values in each table
+NUM_TABLE_POINTS = 4000
+
+# Number of tables (i.e. different gas conditions / charges) kept around
+MAX_CACHED_TABLES = 32
+
+
+class MobilityTable:
+    """
+    MobilityTable answers Zp -> Dp (and Dp -> Zp) queries for one set of gas conditions
+    and number of charges, without solving for the Cunningham slip correction every time.
+
+    Going from Dp to Zp is explicit, Zp = K * Cs(dp) / dp. So the table is built by
+    evaluating that on a dense log spaced grid of dp values, and queries go the other way
+    by monotone (PCHIP) interpolation of log(dp) against log(Zp). The interpolation error
+    is measured against the exact solver at the midpoints of the grid when the table is built.
+
+    Queries outside the table fall back to the exact solver, zp_to_dp.
+
+    Attributes:
+        * mean_free_path_nm - mean free path of the gas the table was built for
+        * mu_gas_viscosity_poise - gas viscosity the table was built for
+        * n_ch - number of elementary charges on the particle
+        * dp_table - numpy array of the dp values (nm) in the table, increasing
+        * zp_table - numpy array of the Zp values matching dp_table, decreasing
+        * max_rel_error - largest relative error in dp found at the grid midpoints
+    """
+    def __init__(self, mean_free_path_nm: float, mu_gas_viscosity_poise: float, n_ch: int = 1,
+                 dp_min_nm: float = MIN_DP_CHECK, dp_max_nm: float = MAX_DP_CHECK,
+                 num_points: int = NUM_TABLE_POINTS):
+        if mean_free_path_nm <= 0 or mu_gas_viscosity_poise <= 0:
+            raise ValueError("MobilityTable: gas mean free path and viscosity must be > 0")
+        if n_ch < 1:
+            raise ValueError("MobilityTable: number of charges must be >= 1")
+
+        self.mean_free_path_nm = mean_free_path_nm
+        self.mu_gas_viscosity_poise = mu_gas_viscosity_poise
+        self.n_ch = n_ch
+
+        self.dp_table = np.geomspace(dp_min_nm, dp_max_nm, num_points)
+        self.zp_table = self.Dp_to_Zp(self.dp_table)
+
+        # PCHIP needs increasing x, and Zp decreases with dp, so flip the table around
+        log_zp = np.log(self.zp_table[::-1])
+        log_dp = np.log(self.dp_table[::-1])
+        self._log_dp_of_log_zp = PchipInterpolator(log_zp, log_dp, extrapolate=False)
+        self._log_zp_min = log_zp[0]
+        self._log_zp_max = log_zp[-1]
+
+        # Measure how far off the interpolation is where it should be the worst
+        dp_mid = np.sqrt(self.dp_table[1:] * self.dp_table[:-1])
+        dp_interp = self.Zp_to_Dp(self.Dp_to_Zp(dp_mid))
+        self.max_rel_error = float(np.max(np.abs(dp_interp - dp_mid) / dp_mid))
+
+    def __repr__(self):
+        s = "MobilityTable:\n"
+        s += "  mean free path: {:.3f} nm\n".format(self.mean_free_path_nm)
+        s += "  gas viscosity: {:.7f} Poise\n".format(self.mu_gas_viscosity_poise)
+        s += "  charges: {}\n".format(self.n_ch)
+        s += "  dp: {:.1f} - {:.1f} nm ({} points)\n".format(self.dp_table[0], self.dp_table[-1],
+                                                           self.dp_table.shape[0])
+        s += "  max rel error: {:.2e}\n".format(self.max_rel_error)
+        return s
+
+    def Dp_to_Zp(self, dp):
+        """
+        Compute the electrical mobility Zp of particles of diameter dp. This is exact.
+
+        :param dp: particle diameter(s) in nanometers, a float or a numpy array
+        :return: Zp, same shape as dp
+        """
+        k = self.n_ch * ELEM_CHARGE * DP_CM_TO_NM / (3 * math.pi * self.mu_gas_viscosity_poise)
+        return k * cunningham_slip_correction(dp, self.mean_free_path_nm) / dp
+
+    def Zp_to_Dp(self, Zp):
+        """
+        Look up the particle diameter Dp in nanometers for electrical mobility Zp
+
+        :param Zp: center of electrical mobility, a float or a numpy array
+        :return: Dp, a float for a scalar Zp or an array the shape of Zp
+        """
+        Zp_array = np.asarray(Zp, dtype=float)
+        log_zp = np.log(Zp_array)
+        dp = np.exp(self._log_dp_of_log_zp(log_zp))
+
+        # Anything off the table gets solved exactly
+        is_outside = ~((log_zp >= self._log_zp_min) & (log_zp <= self._log_zp_max))
+        if np.any(is_outside):
+            dp = np.array(dp, dtype=float)
+            dp[is_outside] = zp_to_dp(Zp_array[is_outside], self.mu_gas_viscosity_poise,
+                                      self.mean_free_path_nm, n_ch=self.n_ch)
+
+        if dp.ndim == 0:
+            return float(dp)
+        return dp
+
+
+@lru_cache(maxsize=MAX_CACHED_TABLES)
+def get_mobility_table(mean_free_path_nm: float, mu_gas_viscosity_poise: float, n_ch: int = 1) -> MobilityTable:
+    """
+    Get the MobilityTable for a set of gas conditions and number of charges. Tables are
+    only built the first time they are asked for, and the most recently used
+    MAX_CACHED_TABLES are kept (across runs).
+
+    :param mean_free_path_nm: mean free path of the gas in nanometers
+    :param mu_gas_viscosity_poise: gas viscosity in Poise
+    :param n_ch: number of elementary charges on particle
+    :return: the MobilityTable
+    """
+    return MobilityTable(mean_free_path_nm, mu_gas_viscosity_poise, n_ch=n_ch)
@@ -1,11 +1,21 @@
 """
 Model
 """
+import numpy as np
+
+import htdma_code.model.files.run_cache as run_cache
+from htdma_code.model.files.run_tail import RunFileTail
 from htdma_code.model.setupmods.setup import Setup
 from htdma_code.model.dma1 import DMA_1
 from htdma_code.model.scan import Scan
 from htdma_code.model.scans import Scans
-from htdma_code.model.results_table import ResultsTableModel
+from htdma_code.model.result_columns import ResultColumns
+from htdma_code.model.fit_result_set import FitResultSet
+from htdma_code.model.hygroscopicity import RunHygroscopicity, compute_run_hygroscopicity
+from htdma_code.model.charge_correction import get_run_charge_correction
+from htdma_code.model.inversion import InversionResult, DEFAULT_INVERSION_METHOD, concat_inversion_results, \
+    get_run_inversion_kernel
+from htdma_code.model.setupmods.scan_params import ScanParams
 
 class Model:
     """
@@ -15,6 +25,10 @@ class Model:
         setup - an instance of the Setup class
         scans - an instance of Scans, which represents all of the scans of a given run
         dma1 - an instance of DMA_1, which represents the configuation of DMA_1
+        total_results - a ResultColumns with the fitted peaks of all scans fitted so far
+        run_tail - the RunFileTail of the file being followed (see follow_file), or None
+        use_charge_correction - True to correct the scans of the files read in from now on for
+                                multiply charged particles (unless the instrument already did)
     """
     def __init__(self):
         self.setup = Setup()
@@ -23,7 +37,12 @@ class Model:
 
         self.current_scan: Scan = None
         self.current_scan_index: int = None
-        self.total_results_table = None
+        self.total_results: ResultColumns = None
+        self.run_tail: RunFileTail = None
+        self.use_charge_correction = False
+
+        # Called as listener(first_scan_index, num_new_scans, fit_result_set) whenever scans are added
+        self._scans_added_listeners = []
 
         # Graphing parameters for autoscaling the y axis.
         self.scan_graph_auto_scale_y = True
@@ -33,14 +52,136 @@ class Model:
         """
         This handles the initialization of everything needed to start analyzing a new file of scans.
         """
-        self.setup.read_file(filename)
-        self.scans.read_file(filename)
+        # Read the file once (through its binary sidecar), and share it between the setup and the scans
+        run_data = run_cache.read_run_file_cached(filename)
+        self.setup.read_run_data(run_data)
+        self.scans.read_run_data(run_data, charge_correction=self._get_charge_correction(run_data))
 
         # Now, initialize various setup structures
         self.dma1 = DMA_1(self.setup)
         self.current_scan_index = 0
         self._update_selected_scan_in_model()
-        self.total_results_table = ResultsTableModel()
+        self.total_results = ResultColumns()
+        self.run_tail = None
+
+    def follow_file(self, filename, num_peaks_desired: int = None, workers: int = 1) -> int:
+        """
+        Start analyzing a run file that is still being written. The scans written so far are
+        read in right away, and poll_followed_file picks up the ones added after that.
+
+        :param filename: The run file
+        :param num_peaks_desired: [Optional] if given, fit the scans with this many peaks as they come in
+        :param workers: The number of worker processes to fit the new scans with (see Scans.fit_all)
+        :return: the number of scans read in
+        """
+        self.run_tail = RunFileTail(filename)
+        run_data = self.run_tail.poll()
+        if run_data is None:
+            raise ValueError("follow_file - {} does not have any complete scans yet".format(filename))
+
+        self.setup.read_run_data(run_data)
+        self.scans.read_run_data(run_data, charge_correction=self._get_charge_correction(run_data))
+        self.dma1 = DMA_1(self.setup)
+        self.current_scan_index = 0
+        self._update_selected_scan_in_model()
+        self.total_results = ResultColumns()
+
+        self._notify_scans_added(0, run_data.get_num_scans(), num_peaks_desired, workers)
+        return run_data.get_num_scans()
+
+    def poll_followed_file(self, num_peaks_desired: int = None, workers: int = 1) -> int:
+        """
+        Read any scans added to the followed file (see follow_file) since the last poll,
+        append them to the scans, and fit just the new ones
+
+        :param num_peaks_desired: [Optional] if given, fit the new scans with this many peaks
+        :param workers: The number of worker processes to fit the new scans with (see Scans.fit_all)
+        :return: the number of new scans
+        """
+        if self.run_tail is None:
+            raise ValueError("poll_followed_file - no file is being followed")
+        run_data = self.run_tail.poll()
+        if run_data is None:
+            return 0
+        self.setup.append_run_data(run_data)
+        first_scan_index = self.scans.append_run_data(run_data)
+        self._notify_scans_added(first_scan_index, run_data.get_num_scans(), num_peaks_desired, workers)
+        return run_data.get_num_scans()
+
+    def _get_charge_correction(self, run_data):
+        """
+        Internal helper to get the ChargeCorrection for a run just read into the setup
+
+        :return: the ChargeCorrection, or None if it is not wanted or the scans were already corrected
+        """
+        if not self.use_charge_correction or self.setup.run_params.is_charge_corrected:
+            return None
+        return get_run_charge_correction(self.setup, run_data.dp)
+
+    def add_scans_added_listener(self, listener):
+        """
+        Register a function to call whenever scans are added by follow_file or poll_followed_file.
+        It is called as listener(first_scan_index, num_new_scans, fit_result_set), where
+        fit_result_set is the FitResultSet of the new scans (None if they were not fitted)
+        """
+        self._scans_added_listeners.append(listener)
+
+    def remove_scans_added_listener(self, listener):
+        self._scans_added_listeners.remove(listener)
+
+    def _notify_scans_added(self, first_scan_index: int, num_new_scans: int, num_peaks_desired: int, workers: int):
+        """
+        Internal helper to fit the new scans (if asked to), then tell the listeners about them
+        """
+        fit_result_set: FitResultSet = None
+        if num_peaks_desired is not None and num_new_scans > 0:
+            fit_result_set = self.scans.fit_all(num_peaks_desired, workers=workers,
+                                                first_scan_index=first_scan_index)
+        for listener in list(self._scans_added_listeners):
+            listener(first_scan_index, num_new_scans, fit_result_set)
+
+    def compute_hygroscopicity(self, peak_fit_results: list = None, first_scan_index: int = 0) -> RunHygroscopicity:
+        """
+        Compute the growth factor and kappa of fitted peaks, relative to the dp selected by DMA 1
+        and at the RH and temperature of the run. The PeakFitResults are updated too.
+
+        :param peak_fit_results: [Optional] the PeakFitResult list of each scan (e.g. from a
+                                 FitResultSet). Defaults to the current fits of every scan
+        :param first_scan_index: the index of the scan of peak_fit_results[0]
+        :return: a RunHygroscopicity with one entry per peak
+        """
+        if self.dma1 is None:
+            raise ValueError("compute_hygroscopicity - no file loaded")
+        if peak_fit_results is None:
+            peak_fit_results = [self.scans.get_scan(i).peak_fit_results for i in range(self.scans.get_num_scans())]
+            first_scan_index = 0
+        run_params = self.setup.run_params
+        return compute_run_hygroscopicity(peak_fit_results, self.dma1.get_dp(), run_params.rh, run_params.temp_k,
+                                          first_scan_index=first_scan_index)
+
+    def invert_scans(self, method: str = DEFAULT_INVERSION_METHOD, **kwargs) -> InversionResult:
+        """
+        Invert every scan to its growth factor distribution, relative to the dp selected by DMA 1 at
+        its current voltage (see inversion). This is the alternative to fitting peaks. The scans are
+        grouped by their flows (Setup.scan_flows), and each group is inverted in one batch against
+        its own (cached) InversionKernel.
+
+        :param method: "twomey" or "nnls"
+        :param kwargs: gf_range, num_gf, is_diffusing or regularization (see InversionKernel)
+        :return: an InversionResult with every scan, in scan order
+        """
+        if self.dma1 is None:
+            raise ValueError("invert_scans - no file loaded")
+        (_, i_first_scans, group_of_scan) = np.unique(self.setup.scan_flows[:self.scans.get_num_scans()], axis=0,
+                                                      return_index=True, return_inverse=True)
+        group_of_scan = group_of_scan.ravel()
+        results = []
+        for (i_group, i_first_scan) in enumerate(i_first_scans):
+            # Every scan of the group has the same flows, so the parameters of its first scan will do
+            scan_params = ScanParams(self.setup.df_raw_scan_data, int(i_first_scan), self.setup.data_file_version)
+            kernel = get_run_inversion_kernel(self.setup, self.dma1, self.scans.dp_range, scan_params, **kwargs)
+            results.append(self.scans.invert_all(kernel, method, np.flatnonzero(group_of_scan == i_group)))
+        return concat_inversion_results(results)
 
     def select_scan(self, scan_index: int) -> bool:
         """
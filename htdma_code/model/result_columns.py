@@ -0,0 +1,152 @@
+"""
+ResultColumns - the peak fit results of a run, stored column by column
+"""
+from typing import List, Tuple
+
+import numpy as np
+
+from htdma_code.model.scan import Scan, PeakFitResult
+
+# Column names and types, in the order they are displayed
+COLUMN_NAMES = ["scan", "peak", "dp", "height", "fwhh"]
+COLUMN_DTYPES = [np.int32, np.int32, np.float64, np.float64, np.float64]
+
+# Number of rows allocated up front. The arrays double in size whenever they fill up
+INITIAL_CAPACITY = 256
+
+
+class ResultColumns:
+    """
+    ResultColumns holds one row per fitted peak, in preallocated typed numpy arrays (one
+    per column). Appending is amortized O(1): the arrays double in size when they run out
+    of room, rather than being reallocated on every row.
+
+    Attributes:
+        * columns - list of numpy arrays, one per entry of COLUMN_NAMES. Only the first
+                    get_num_rows() entries of each are valid
+    """
+    def __init__(self, capacity: int = INITIAL_CAPACITY):
+        self.columns = [np.zeros(capacity, dtype=dtype) for dtype in COLUMN_DTYPES]
+        self._num_rows = 0
+
+        # The DataFrame export is only rebuilt after rows have been added
+        self._df = None
+
+    def __repr__(self):
+        s = "ResultColumns:\n"
+        s += "  Num rows: {}\n".format(self._num_rows)
+        s += "  Capacity: {}\n".format(self.get_capacity())
+        return s
+
+    def __len__(self):
+        return self._num_rows
+
+    def get_num_rows(self) -> int:
+        """
+        :return: the number of rows (i.e. fitted peaks) stored
+        """
+        return self._num_rows
+
+    def get_num_columns(self) -> int:
+        """
+        :return: the number of columns
+        """
+        return len(COLUMN_NAMES)
+
+    def get_capacity(self) -> int:
+        """
+        :return: the number of rows that fit before the arrays have to grow
+        """
+        return self.columns[0].shape[0]
+
+    def get_value(self, row: int, column: int):
+        """
+        :return: the value stored in a cell
+        """
+        return self.columns[column][row]
+
+    def get_column(self, column: int) -> np.ndarray:
+        """
+        :return: a view of the valid part of a column
+        """
+        return self.columns[column][:self._num_rows]
+
+    def append_rows(self, scan, peak, dp, height, fwhh) -> Tuple[int, int]:
+        """
+        Append a block of rows. Each argument is a sequence with one value per row
+        (or a single value to use for every row).
+
+        :return: (first, last) - the indices of the first and last rows added. last is
+        first - 1 if nothing was added
+        """
+        values = np.broadcast_arrays(scan, peak, dp, height, fwhh)
+        num_new_rows = values[0].size
+        first = self._num_rows
+        if num_new_rows == 0:
+            return first, first - 1
+
+        self._reserve(first + num_new_rows)
+        for column, value in zip(self.columns, values):
+            column[first:first+num_new_rows] = value.ravel()
+        self._num_rows += num_new_rows
+        self._df = None
+        return first, self._num_rows - 1
+
+    def append_peaks(self, scan_index: int, peak_fit_results: List[PeakFitResult]) -> Tuple[int, int]:
+        """
+        Append one row per fitted peak of a scan
+
+        :param scan_index: The (0 based) index of the scan the peaks are from
+        :param peak_fit_results: The PeakFitResult list of the scan
+        :return: (first, last) - see append_rows
+        """
+        if not peak_fit_results:
+            return self._num_rows, self._num_rows - 1
+        return self.append_rows(scan_index + 1,
+                                [peak.index + 1 for peak in peak_fit_results],
+                                [peak.dp for peak in peak_fit_results],
+                                [peak.height for peak in peak_fit_results],
+                                [peak.fwhh for peak in peak_fit_results])
+
+    def add_scan_results(self, scan: Scan) -> Tuple[int, int]:
+        """
+        Append one row per fitted peak of a Scan
+
+        :return: (first, last) - see append_rows
+        """
+        return self.append_peaks(scan.scan_index, scan.peak_fit_results)
+
+    def clear(self):
+        """
+        Remove all rows. The allocated arrays are kept
+        """
+        self._num_rows = 0
+        self._df = None
+
+    def to_dataframe(self):
+        """
+        Export the rows as a pandas DataFrame, with the columns in COLUMN_NAMES. The
+        DataFrame is built on demand and kept until more rows are added.
+
+        :return: a pandas DataFrame
+        """
+        if self._df is None:
+            import pandas as pd
+            self._df = pd.DataFrame({name: self.get_column(i).copy()
+                                     for i, name in enumerate(COLUMN_NAMES)},
+                                    columns=COLUMN_NAMES)
+        return self._df
+
+    def _reserve(self, num_rows: int):
+        """
+        Internal helper to grow the arrays (by doubling) until num_rows fit
+        """
+        capacity = self.get_capacity()
+        if num_rows <= capacity:
+            return
+        while capacity < num_rows:
+            capacity = max(2 * capacity, 1)
+        for i, column in enumerate(self.columns):
+            new_column = np.zeros(capacity, dtype=column.dtype)
+            new_column[:self._num_rows] = column[:self._num_rows]
+            self.columns[i] = new_column
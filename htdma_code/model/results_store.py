@@ -0,0 +1,133 @@
+"""
+ResultsStore - a persistent store of the fitted peaks and summaries of processed run files
+"""
+import os
+import sqlite3
+
+import pandas as pd
+
+# How long to wait for another process to finish writing to the store (sec)
+SQLITE_TIMEOUT_SEC = 30.0
+
+# Columns of the peaks table and of the runs table, in the order they are exported
+PEAK_COLUMNS = ["file", "scan", "scan_id", "time_stamp", "peak", "dp", "height", "fwhh"]
+RUN_COLUMNS = ["file", "source_size", "source_mtime_ns", "num_scans", "num_peaks", "num_failed",
+               "processed_at", "process_sec"]
+
+
+class ResultsStore:
+    """
+    ResultsStore keeps the fitted peaks of every processed run file, plus one summary row per
+    file, in an SQLite database. Each file is stored once: processing a file again (e.g. because
+    it was exported again with more scans) replaces everything stored for it.
+
+    The summary remembers the size and mtime of the file that was processed, so is_up_to_date
+    can tell whether a file needs processing again (e.g. after a restart).
+
+    Attributes:
+        * path - the SQLite database file
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+
+    def __repr__(self):
+        s = "ResultsStore:\n"
+        s += "  path: {}\n".format(self.path)
+        s += "  Num runs: {}\n".format(self.get_num_runs())
+        s += "  Num peaks: {}\n".format(self.get_num_peaks())
+        return s
+
+    def __getstate__(self):
+        # Connections can't be pickled. The copy opens its own
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._conn = None
+
+    def put_run(self, filename: str, peaks: pd.DataFrame, source_size: int, source_mtime_ns: int,
+                num_scans: int, num_failed: int, processed_at: float, process_sec: float):
+        """
+        Store the results of processing a file, replacing anything stored for it before
+
+        :param filename: The run file
+        :param peaks: a DataFrame with the PEAK_COLUMNS (see batch.process_file), one row per fitted peak
+        :param source_size: The size of the file that was processed
+        :param source_mtime_ns: The mtime of the file that was processed
+        :param num_scans: The number of scans in the file
+        :param num_failed: The number of scans that failed to fit
+        :param processed_at: When the processing finished (unix time)
+        :param process_sec: How long the processing took
+        """
+        rows = list(zip(*(peaks[column].astype(str).tolist() if column == "time_stamp" else peaks[column].tolist()
+                          for column in PEAK_COLUMNS[1:])))
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM peaks WHERE file = ?", (filename,))
+            conn.executemany("INSERT INTO peaks ({}) VALUES (?, {})".format(
+                                 ", ".join(PEAK_COLUMNS), ", ".join("?" * (len(PEAK_COLUMNS) - 1))),
+                             ((filename,) + row for row in rows))
+            conn.execute("INSERT OR REPLACE INTO runs ({}) VALUES ({})".format(
+                             ", ".join(RUN_COLUMNS), ", ".join("?" * len(RUN_COLUMNS))),
+                         (filename, source_size, source_mtime_ns, num_scans, len(rows), num_failed,
+                          processed_at, process_sec))
+
+    def is_up_to_date(self, filename: str, source_size: int, source_mtime_ns: int) -> bool:
+        """
+        :return: True if the file was already processed, with this size and mtime
+        """
+        row = self._connect().execute("SELECT source_size, source_mtime_ns FROM runs WHERE file = ?",
+                                      (filename,)).fetchone()
+        return row is not None and tuple(row) == (source_size, source_mtime_ns)
+
+    def get_num_runs(self) -> int:
+        """
+        :return: the number of files stored
+        """
+        return self._connect().execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+
+    def get_num_peaks(self) -> int:
+        """
+        :return: the number of fitted peaks stored, over all files
+        """
+        return self._connect().execute("SELECT COUNT(*) FROM peaks").fetchone()[0]
+
+    def peaks_to_dataframe(self) -> pd.DataFrame:
+        """
+        :return: every stored peak as a DataFrame with the PEAK_COLUMNS
+        """
+        return pd.read_sql_query("SELECT {} FROM peaks ORDER BY file, scan, peak".format(", ".join(PEAK_COLUMNS)),
+                                 self._connect())
+
+    def runs_to_dataframe(self) -> pd.DataFrame:
+        """
+        :return: the summary of every stored file as a DataFrame with the RUN_COLUMNS
+        """
+        return pd.read_sql_query("SELECT {} FROM runs ORDER BY file".format(", ".join(RUN_COLUMNS)),
+                                 self._connect())
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Internal helper to open (and if needed, create) the database
+        """
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT_SEC)
+            with self._conn:
+                self._conn.execute("CREATE TABLE IF NOT EXISTS runs ("
+                                   "file TEXT PRIMARY KEY, source_size INTEGER, source_mtime_ns INTEGER, "
+                                   "num_scans INTEGER, num_peaks INTEGER, num_failed INTEGER, "
+                                   "processed_at REAL, process_sec REAL)")
+                self._conn.execute("CREATE TABLE IF NOT EXISTS peaks ("
+                                   "file TEXT NOT NULL, scan INTEGER, scan_id INTEGER, time_stamp TEXT, "
+                                   "peak INTEGER, dp REAL, height REAL, fwhh REAL)")
+                self._conn.execute("CREATE INDEX IF NOT EXISTS peaks_file ON peaks (file)")
+        return self._conn
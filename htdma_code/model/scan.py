@@ -17,62 +17,114 @@ I'm following lots of ideas online of basic gaussian curve fits
 from typing import List
 
 import numpy as np
-import pandas as pd
 from scipy.signal import peak_widths
-from statsmodels.stats.stattools import durbin_watson
 import scipy
 import scipy.signal
 import scipy.optimize
 
-from PySide2.QtGui import QStandardItemModel, QStandardItem
+from htdma_code.model.fit_cache import FitCache, fit_cache_key
+from htdma_code.model.inversion import InversionKernel, InversionResult, DEFAULT_INVERSION_METHOD
+import htdma_code.model.gaussian_kernels as gaussian_kernels
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
+def durbin_watson(residuals: np.ndarray) -> float:
+    """
+    The Durbin-Watson statistic of the residuals, same as statsmodels.stats.stattools.durbin_watson.
+    It's only a couple of numpy calls, and statsmodels takes far longer to import than
+    all of our fitting code
+
+    :return: sum of the squared differences of successive residuals / sum of the squared residuals
+    """
+    diff = np.diff(residuals)
+    return np.dot(diff, diff) / np.dot(residuals, residuals)
+
+def information_criteria(rss: float, num_points: int, num_params: int) -> tuple:
+    """
+    The Akaike and Bayesian information criteria of a least squares fit with gaussian errors
+    (up to a constant, which is the same for every fit of the same data):
+
+        AIC = n ln(RSS / n) + 2 k
+        BIC = n ln(RSS / n) + k ln(n)
+
+    :param rss: the residual sum of squares
+    :param num_points: n, the number of data points the rss is summed over
+    :param num_params: k, the number of fitted parameters
+    :return: (aic, bic). Lower is better
+    """
+    if num_points <= 0:
+        return np.inf, np.inf
+    log_likelihood_term = num_points * np.log(max(rss, np.finfo(float).tiny) / num_points)
+    return log_likelihood_term + 2 * num_params, log_likelihood_term + num_params * np.log(num_points)
 
 ##### Our fit functions
 
 def _1gaussian(x, amp1,mu1,sigma1):
     return amp1*(1/(sigma1*(np.sqrt(2*np.pi))))*(np.exp((-1.0/2.0)*(((x-mu1)/sigma1)**2)))
 
-def _2gaussian(x, amp1, mu1, sigma1, amp2, mu2, sigma2):
-    return _1gaussian(x,amp1,mu1,sigma1) + _1gaussian(x,amp2,mu2,sigma2)
-        # return amp1*(1/(sigma1*(np.sqrt(2*np.pi))))*(np.exp((-1.0/2.0)*(((x-mu1)/sigma1)**2))) +  \
-        #        amp2*(1/(sigma2*(np.sqrt(2*np.pi))))*(np.exp((-1.0/2.0)*(((x-mu2)/sigma2)**2)))
-
-def _3gaussian(x, amp1, mu1, sigma1, amp2, mu2, sigma2, amp3, mu3, sigma3):
-    return _1gaussian(x,amp1,mu1,sigma1) + \
-           _1gaussian(x,amp2,mu2,sigma2) + \
-           _1gaussian(x,amp3,mu3,sigma3)
-
-def _4gaussian(x, amp1, mu1, sigma1, amp2, mu2, sigma2, amp3, mu3, sigma3, amp4, mu4, sigma4):
-    return _1gaussian(x,amp1,mu1,sigma1) + \
-           _1gaussian(x,amp2,mu2,sigma2) + \
-           _1gaussian(x,amp3,mu3,sigma3) + \
-           _1gaussian(x,amp4,mu4,sigma4)
-
-def _5gaussian(x, amp1, mu1, sigma1, amp2, mu2, sigma2, amp3, mu3, sigma3, amp4, mu4, sigma4, amp5, mu5, sigma5):
-    return _1gaussian(x,amp1,mu1,sigma1) + \
-           _1gaussian(x,amp2,mu2,sigma2) + \
-           _1gaussian(x,amp3,mu3,sigma3) + \
-           _1gaussian(x,amp4,mu4,sigma4) + \
-           _1gaussian(x,amp5,mu5,sigma5)
-
-# fit_functions - this is the array of possible functions to fit the data to, depending on the
-# number of peaks specified in the data
-fit_functions = [_1gaussian,
-                 _2gaussian,
-                 _3gaussian,
-                 _4gaussian,
-                 _5gaussian]
+def _ngaussian(x, *params):
+    """
+    The sum of any number of gaussians, evaluated for all peaks at once.
+
+    :param x: the x value(s) to evaluate at (the log dp values)
+    :param params: amp, mu, sigma for the first peak, then for the second, and so on. This is
+                   the flattened version of an (n_peaks, 3) array
+    :return: the summed gaussians, the same shape as x
+    """
+    amp, mu, sigma = np.reshape(params, (-1, 3)).T
+    z = (np.asarray(x, dtype=float)[..., np.newaxis] - mu) / sigma
+    g = np.exp(-0.5 * z * z) / (sigma * SQRT_2_PI)
+    return g @ amp
+
+def _ngaussian_jac(x, *params):
+    """
+    The closed form Jacobian of _ngaussian, for handing to curve_fit as jac= so it does not
+    need to estimate it with finite differences.
+
+    :return: an array of shape (len(x), 3 * n_peaks). Column k is the derivative with respect
+             to params[k]
+    """
+    amp, mu, sigma = np.reshape(params, (-1, 3)).T
+    z = (np.asarray(x, dtype=float)[..., np.newaxis] - mu) / sigma
+    g = np.exp(-0.5 * z * z) / (sigma * SQRT_2_PI)
+    d_amp = g
+    d_mu = amp * g * z / sigma
+    d_sigma = amp * g * (z * z - 1) / sigma
+    return np.stack((d_amp, d_mu, d_sigma), axis=-1).reshape(z.shape[:-1] + (-1,))
+
+def _fit_model() -> tuple:
+    """
+    INTERNAL FUNCTION -
+    :return: (model, jacobian) to hand to curve_fit. These are the compiled kernels of
+             gaussian_kernels when numba is in use, otherwise _ngaussian and _ngaussian_jac
+    """
+    if gaussian_kernels.get_backend() == gaussian_kernels.BACKEND_NUMBA:
+        return gaussian_kernels.ngaussian, gaussian_kernels.ngaussian_jac
+    return _ngaussian, _ngaussian_jac
 
 # Constants
-MAX_PEAKS_TO_FIT = 5
+MAX_PEAKS_TO_FIT = 10
+
+# Bump this whenever a change to the fitting code changes its results, so that
+# fits stored in a FitCache by the old code are not used anymore
+FITTER_VERSION = 2
+SQRT_2_PI = np.sqrt(2 * np.pi)
 MIN_GOOD_WINDOW_SIZE = 5
 NUM_FIT_PASSES = 1
 
+# Automatic choice of the number of peaks (see Scan.fit_auto). Candidates stop once the score
+# has not improved for AUTO_PATIENCE extra peaks in a row
+AUTO_MAX_PEAKS = 4
+AUTO_CRITERIA = ("aic", "bic")
+DEFAULT_AUTO_CRITERION = "bic"
+AUTO_PATIENCE = 1
+
 # How close to the edges of the signal do we allow peaks?
 INDEX_OF_PEAK_BOUNDS = 3
 
+# A warm started fit is rejected if its nrmse grows past this multiple of the reference fit's,
+# or if its Durbin-Watson moves this much further away from the ideal value of 2
+WARM_START_MAX_NRMSE_RATIO = 1.5
+WARM_START_MAX_DW_CHANGE = 0.5
+
 class PeakFitResult:
     """
     Encapsulate results from each peak identified in the scan
@@ -119,7 +171,12 @@ class TotalFitResult:
         residual_peak_indices = the indices of the peaks identified in the residual curve
         residuals_mean = the mean of the residuals (should be ~0)
         rmse = the root mean square error of the fit
+        nrmse = the rmse divided by the root sum of squares of the good data, for comparing scans
         durbin_watson = statistic to assess independence of residual values [0-4, 2 is best]
+        aic = Akaike information criterion of the fit (see information_criteria) [lower is better]
+        bic = Bayesian information criterion of the fit [lower is better]
+        candidate_scores = for Scan.fit_auto, a list with the num_peaks, aic, bic, rmse and
+                           durbin_watson of every candidate tried. None otherwise
     """
     def __init__(self):
         self.predicted_peak_indices = None
@@ -130,7 +187,11 @@ class TotalFitResult:
         self.residuals_smoothed = None
         self.residuals_mean = None
         self.rmse = None
+        self.nrmse = None
         self.durbin_watson = None
+        self.aic = None
+        self.bic = None
+        self.candidate_scores = None
 
 
     def __repr__(self):
@@ -145,31 +206,33 @@ class Scan:
     Attributes:
         -
     """
-    def __init__(self, scan_index: int, df: pd.DataFrame, num_dp_values: int):
+    def __init__(self, scan_index: int, values: np.ndarray, dp_range: np.ndarray, log_dp_range: np.ndarray = None,
+                 y_filtered: np.ndarray = None, y_sel_good: np.ndarray = None):
         """
-        This function is passed a single scan column from the time
-        stamp right through the end of the column
+        A Scan does not own its data. It is handed its row of the concentration matrix
+        held by Scans, along with the dp values that are shared by all scans of the run.
 
         :param scan_index: Index of this scan in the run
-        :param df: A data frame representing all row data for this scan
-        :param num_dp_values: number of dp values in the scan
+        :param values: The concentration values of this scan, one per dp value
+        :param dp_range: The dp values of the run
+        :param log_dp_range: np.log(dp_range), if it was already computed
+        :param y_filtered: the values returned by filter_bad_values, if it was already run on the whole run
+        :param y_sel_good: the selection array returned by filter_bad_values, if it was already run
         """
 
-        self.num_scan_rows = num_dp_values
+        self.num_scan_rows = dp_range.shape[0]
         self.scan_index = scan_index
 
-        # Let's keep an internal dataframe of the data, for now...
-        self._df_data = df.iloc[1:1+self.num_scan_rows, [0]].copy()
-        self._df_data.index = self._df_data.index.astype(float)
-        self._df_data = self._df_data.astype(float)
-
-        # Extract out numpy arrays of the data for speed
-        self.dp_range = self._df_data.index.to_numpy()
-        self.log_dp_range = np.log(self.dp_range)
-        self.raw_values = self._df_data.iloc[:,0].to_numpy()
+        # These are views of the data held by Scans, not copies
+        self.dp_range = dp_range
+        self.log_dp_range = log_dp_range if log_dp_range is not None else np.log(dp_range)
+        self.raw_values = values
 
         # Preprocess / clean data to prepare for curve fit
-        self._y_filtered, self._y_sel_good = self._filter_bad_values()
+        if y_filtered is not None and y_sel_good is not None:
+            self._y_filtered, self._y_sel_good = y_filtered, y_sel_good
+        else:
+            self._y_filtered, self._y_sel_good = self._filter_bad_values()
         self._yfit = None
         self._y_weights = None
 
@@ -179,6 +242,9 @@ class Scan:
         self.total_fit_result: TotalFitResult = None
         self.peak_fit_results: List[PeakFitResult] = None
 
+        # Set by the invert function
+        self.inversion_result: InversionResult = None
+
         # self.peaks_item_model = QStandardItemModel()
         # x = self.peaks_item_model.item(2,3)
 
@@ -194,50 +260,7 @@ class Scan:
         where the values are good
         """
 
-        # Start with selecting all data
-        y_sel_good = np.array([True for i in range(self.raw_values.shape[0])])
-
-        # We know off the bat that we can eliminate the first and last channel values
-        y_sel_good[0] = False
-        y_sel_good[-1] = False
-
-        # Now, carefully iterate through the ordered data. Look for small windows surrounded by zero values.
-        # These should be eliminated
-        is_in_good_window = False
-        count_good_channels = 0
-        i_good_channel_start = None
-        for i in range(1,self.raw_values.shape[0]-1):
-            # Is this a good channel?
-            if self.raw_values[i] > 0:
-                # Were we in a good window? Then keep counting it..
-                if is_in_good_window:
-                    count_good_channels += 1
-
-                # We were NOT in a good window, so start one!
-                else:
-                    is_in_good_window = True
-                    i_good_channel_start = i
-                    count_good_channels = 1
-
-            # DOH! This is a shit channel. If we had a small window, flatten the data
-            else:
-                # Did we have a streak of good channels?
-                if is_in_good_window:
-                    # Was our window of good channels too small to count it?
-                    if count_good_channels < MIN_GOOD_WINDOW_SIZE:
-                        # Yes? Then eliminate these points
-                        for j in range(i_good_channel_start,i):
-                            y_sel_good[j] = False
-                    count_good_channels = 0
-                    is_in_good_window = False
-                y_sel_good[i] = False
-
-        # We're done! Flatten the bad channels
-        y_filtered = np.copy(self.raw_values)
-        y_filtered[np.logical_not(y_sel_good)] = 0.0
-
-        # Return the filtered data, and the selection array indicating where the good values are
-        return y_filtered, y_sel_good
+        return filter_bad_values(self.raw_values)
 
     def __repr__(self):
         s = "dp range: {}\n".format(repr(self.dp_range))
@@ -274,7 +297,8 @@ class Scan:
         """
         return self.raw_values.max()
 
-    def fit(self, num_peaks_desired, verbose = False, plot_steps = False, plot_func = None):
+    def fit(self, num_peaks_desired, verbose = False, plot_steps = False, plot_func = None, cache: FitCache = None,
+            i_peaks_predicted = None):
         """
         This is the mother function that performs the curve fit. The results of the fit
         are stored in two separate classes:
@@ -291,6 +315,10 @@ class Scan:
         :param plot_steps: plot the fit after each step?
         :param plot_func: Sadly necessary to prevent circular import
         #TODO Remove the plot_func once fully tested!
+        :param cache: [Optional] a FitCache. If this scan was fitted before with the same number of
+                      peaks, the stored results are used instead of fitting again. New fits are stored
+        :param i_peaks_predicted: [Optional] the peaks of this scan, if predict_peaks_batch already found them
+                                  for the whole run. Otherwise predict_peaks is called
 
         :return: Nothing. All values are stored in this object
         """
@@ -298,6 +326,15 @@ class Scan:
         if num_peaks_desired > MAX_PEAKS_TO_FIT:
             raise ValueError("fit - num_peaks_desired = {} exceeds max allowed {}".format(num_peaks_desired, MAX_PEAKS_TO_FIT))
 
+        # If this exact scan was fitted before, we're done
+        cache_key = None
+        if cache is not None and not plot_steps:
+            cache_key = fit_cache_key(self.raw_values, self.dp_range, num_peaks_desired, FITTER_VERSION)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                (self.num_peaks_predicted, self.peak_fit_results, self.total_fit_result) = cached
+                return
+
         # The x values (i.e. predictors are the log dp values
         # The y values are the *filtered* clean concentration values
         xdata = self.get_log_dp_range()
@@ -315,7 +352,10 @@ class Scan:
             print("xdata_width = {}".format(xdata_width))
 
         # Obtain a list of the indices of the peaks we expect to find in the data
-        i_peaks = predict_peaks(ydata_smoothed, is_scan=True, verbose=verbose)
+        if i_peaks_predicted is not None:
+            i_peaks = list(i_peaks_predicted)
+        else:
+            i_peaks = predict_peaks(ydata_smoothed, is_scan=True, verbose=verbose)
         self.num_peaks_predicted = len(i_peaks)
 
         # Now, go through each identified peak and use it to identify some good starting points for curve fitting the
@@ -324,21 +364,10 @@ class Scan:
         min_bounds = []
         max_bounds = []
         for i in range(len(i_peaks)):
-            init_amp = ydata[i_peaks[i]]
-            min_amp = init_amp * 0.1
-            max_amp = init_amp * 1.5
-
-            init_mu = xdata[i_peaks[i]]
-            min_mu = init_mu - xdata_width * 0.05
-            max_mu = init_mu + xdata_width * 0.05
-
-            init_sd = xdata_width * 0.05
-            min_sd = xdata_width * 0.01
-            max_sd = xdata_width * 0.20
-
-            p0_init = p0_init + [init_amp,init_mu,init_sd]
-            min_bounds = min_bounds + [min_amp, min_mu, min_sd]
-            max_bounds = max_bounds + [max_amp, max_mu, max_sd]
+            (p0_peak, min_bounds_peak, max_bounds_peak) = self._predicted_peak_seed(i_peaks[i], xdata_width)
+            p0_init = p0_init + p0_peak
+            min_bounds = min_bounds + min_bounds_peak
+            max_bounds = max_bounds + max_bounds_peak
             if i + 1 == num_peaks_desired:
                 break
         bounds = (min_bounds, max_bounds)
@@ -355,8 +384,6 @@ class Scan:
         is_done = False
         while not is_done:
 
-            fit_func = get_gaussian_fit_func(num_peaks_predicting)
-
             if verbose:
                 for peak in range(num_peaks_predicting):
                     print("p0_init = {}".format(p0_init[peak * 3:(peak + 1) * 3]))
@@ -364,61 +391,27 @@ class Scan:
                     print("max bounds = {}".format(bounds[1][peak * 3:(peak + 1) * 3]))
 
             # Fit the desired number of peaks for this pass
+            (fit_func, fit_jac) = _fit_model()
             popt, pcov = scipy.optimize.curve_fit(
                 fit_func,
                 xdata[sel],
                 ydata_smoothed[sel],
                 p0=p0_init,
-                bounds=bounds
+                bounds=bounds,
+                jac=fit_jac
             )
             # perr_gauss = np.sqrt(np.diag(pcov_gauss))
 
-            # Create the peak results object
-            if verbose:
-                print("Predicting {} : parameters:".format(num_peaks_predicting))
-
-            self.peak_fit_results = list()
-            for i_peak in range(num_peaks_predicting):
-                peak_fit_result = PeakFitResult()
-                params = popt[i_peak * 3:(i_peak + 1) * 3]
-                peak_fit_result.fit_params = params
-                peak_fit_result.index = i_peak
-                peak_fit_result.dp = np.exp(params[1])
-                peak_fit_result.height = params[0]
-                peak_fit_result.sd = np.exp(params[1] + params[2]) - peak_fit_result.dp  #TODO Verify this - this may not be right
-                peak_fit_result.fwhh = peak_fit_result.sd * 2.3548 #TODO - Verify this - it may not be right
-                peak_fit_result.growth_factor = 0 #TODO Finish growth factor calculation!
-                peak_fit_result.kappa = 0 #TODO Finish kappa calculation!
-                self.peak_fit_results.append(peak_fit_result)
-                if verbose:
-                    print(repr(peak_fit_result))
-
-            self.total_fit_result = TotalFitResult()
-            self.total_fit_result.predicted_peak_indices = i_peaks
-            self.total_fit_result.num_peaks = num_peaks_desired
-            self.total_fit_result.fit_params = popt
-            self.total_fit_result.fit_values = list(map(lambda x: fit_func(x, *popt), xdata))
-            self.total_fit_result.residuals = ydata - self.total_fit_result.fit_values
-            self.total_fit_result.residuals_smoothed = calc_moving_ave(self.total_fit_result.residuals,3)
-            # The indices of residual peaks is a lag value from the previous pass!
-            self.total_fit_result.rmse = np.sqrt(np.sum(self.total_fit_result.residuals[self._y_sel_good] *
-                                                        self.total_fit_result.residuals[self._y_sel_good]))
-            # Durbin-Watson - a good test of fitness, measures the independence of the
-            # residuals, or more specifically, there is no serial correlation.
-            # Range is 0-4. A value of 2 is ideal
-            self.total_fit_result.durbin_watson = durbin_watson(self.total_fit_result.residuals)
-
-            # Compute E(residuals) i.e. the mean should be 0
-            self.total_fit_result.residuals_mean = np.mean(self.total_fit_result.residuals)
-
-            if verbose:
-                print(repr(self.total_fit_result))
+            self._set_fit_results(popt, i_peaks, num_peaks_desired, verbose=verbose)
 
             if plot_steps:
                 if verbose:
                     print("Generating plot...")
                 # if ax_data is None:
 
+                # Only pull in matplotlib when we actually plot, so headless fitting never loads it
+                import matplotlib.pyplot as plt
+
                 # Yeah, making the fig and gridspec part of the class, not a great idea, but good enough
                 self.fig = plt.figure(figsize=(6, 4), dpi=100)
                 self.gridspec = self.fig.add_gridspec(4, 1)
@@ -436,56 +429,17 @@ class Scan:
             if num_peaks_predicting < num_peaks_desired:
                 # If the user actually wants more peaks than were identified, then
                 # lets use the residual curve to determine ideal locations
-                i_residual_peaks = predict_peaks(self.total_fit_result.residuals_smoothed,
-                                                 is_scan=False,
-                                                 verbose=verbose)
-
-                # Sometimes the residual can measure a large at the tails of
-                # the gaussian, when the acutal data is zero
-                is_good_peak = False
-                for i_pk in i_residual_peaks:
-                    if ydata[i_pk] > 0:
-                        is_good_peak = True
-                        break
-
-                # IF there were peaks identified, let's use them!
-                if is_good_peak:
-                    init_amp = ydata[i_pk]
-                    min_amp = init_amp * 0.1
-                    max_amp = init_amp * 1.5
-
-                    init_mu = xdata[i_pk]
-                    min_mu = init_mu - xdata_width * 0.25
-                    max_mu = init_mu + xdata_width * 0.25
-
-                    init_sd = xdata_width * 0.05
-                    min_sd = xdata_width * 0.01
-                    max_sd = xdata_width * 0.20
-
-                    p0_init = p0_init + [init_amp, init_mu, init_sd]
-                    min_bounds = min_bounds + [min_amp, min_mu, min_sd]
-                    max_bounds = max_bounds + [max_amp, max_mu, max_sd]
-                    bounds = (min_bounds, max_bounds)
-
-                else:
-                    print("CRAP! Sorry! Could not find additional peaks!")
-                    init_amp = ydata[i_peaks[0]]
-                    min_amp = ydata.max() * 0.005
-                    max_amp = ydata.max() * 1.25
-
-                    init_mu = xdata[i_peaks[0]]
-                    # TODO - Need to figure out the appropriate peak range in this case
-                    min_mu = xdata[INDEX_OF_PEAK_BOUNDS]
-                    max_mu = xdata[-(INDEX_OF_PEAK_BOUNDS+1)]
-
-                    init_sd = xdata_width * 0.05
-                    min_sd = xdata_width * 0.01
-                    max_sd = xdata_width * 0.25
-
-                    p0_init = p0_init + [init_amp, init_mu, init_sd]
-                    min_bounds = min_bounds + [min_amp, min_mu, min_sd]
-                    max_bounds = max_bounds + [max_amp, max_mu, max_sd]
-                    bounds = (min_bounds, max_bounds)
+                seed = self._residual_peak_seed(xdata_width, verbose=verbose)
+                if seed is None:
+                    if verbose:
+                        print("Could not find additional peaks in the residual, using the fallback seed")
+                    seed = self._fallback_peak_seed(i_peaks[0], xdata_width)
+
+                (p0_peak, min_bounds_peak, max_bounds_peak) = seed
+                p0_init = p0_init + p0_peak
+                min_bounds = min_bounds + min_bounds_peak
+                max_bounds = max_bounds + max_bounds_peak
+                bounds = (min_bounds, max_bounds)
 
                 num_peaks_predicting = num_peaks_predicting + 1
             else:
@@ -533,9 +487,346 @@ class Scan:
         # return popt, pcov
         # TODO - Temporary - add the fit results from the current scan...
 
+        if cache_key is not None:
+            cache.put(cache_key, self.num_peaks_predicted, self.peak_fit_results, self.total_fit_result)
+
         return
 
 
+    def fit_auto(self, max_peaks: int = AUTO_MAX_PEAKS, criterion: str = DEFAULT_AUTO_CRITERION,
+                 verbose=False, cache: FitCache = None, i_peaks_predicted=None) -> int:
+        """
+        Fit the scan without being told how many peaks it has. Candidate fits with 1, 2, ...
+        max_peaks peaks are tried in turn, each is scored with an information criterion
+        (TotalFitResult.aic or bic), and the one with the lowest score is kept.
+
+        The first candidates are seeded with the peaks found by predict_peaks, which is only
+        run once for all of them, strongest peak first. Once those run out, each extra peak
+        is seeded from the residuals of the previous candidate, just like fit() does. If the
+        residuals show no more peaks, no more candidates are tried (fit() would guess instead).
+
+        Candidates stop as soon as AUTO_PATIENCE extra peaks in a row have not lowered the score.
+
+        The score, rmse and Durbin-Watson of every candidate tried are kept in
+        total_fit_result.candidate_scores.
+
+        :param max_peaks: The most peaks to try
+        :param criterion: "aic" or "bic" (see AUTO_CRITERIA)
+        :param verbose: print out info while doing the fit?
+        :param cache: [Optional] a FitCache (see fit)
+        :param i_peaks_predicted: [Optional] the peaks of this scan, if predict_peaks_batch already found them
+        :return: the number of peaks chosen
+        """
+        if criterion not in AUTO_CRITERIA:
+            raise ValueError("fit_auto - criterion must be one of {}".format(", ".join(AUTO_CRITERIA)))
+        if max_peaks < 1 or max_peaks > MAX_PEAKS_TO_FIT:
+            raise ValueError("fit_auto - max_peaks must be between 1 and {}".format(MAX_PEAKS_TO_FIT))
+
+        cache_key = None
+        if cache is not None:
+            cache_key = fit_cache_key(self.raw_values, self.dp_range, max_peaks, FITTER_VERSION,
+                                      variant="auto-" + criterion)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                (self.num_peaks_predicted, self.peak_fit_results, self.total_fit_result) = cached
+                return len(self.peak_fit_results)
+
+        xdata = self.get_log_dp_range()
+        ydata = self._y_filtered
+        ydata_smoothed = calc_moving_ave(ydata,3)
+        xdata_width = xdata.max() - xdata.min()
+
+        if i_peaks_predicted is not None:
+            i_peaks = list(i_peaks_predicted)
+        else:
+            i_peaks = predict_peaks(ydata_smoothed, is_scan=True, verbose=verbose)
+        self.num_peaks_predicted = len(i_peaks)
+
+        p0_init = []
+        min_bounds = []
+        max_bounds = []
+        candidate_scores = []
+        best = None     # (score, peak_fit_results, total_fit_result) of the best candidate so far
+        for num_peaks in range(1, max_peaks + 1):
+            if num_peaks <= len(i_peaks):
+                seed = self._predicted_peak_seed(i_peaks[num_peaks - 1], xdata_width)
+            elif num_peaks == 1:
+                # Nothing stood out enough for predict_peaks, so start from the highest point
+                i_max = INDEX_OF_PEAK_BOUNDS + np.argmax(ydata_smoothed[INDEX_OF_PEAK_BOUNDS:-INDEX_OF_PEAK_BOUNDS])
+                seed = self._fallback_peak_seed(i_max, xdata_width)
+            else:
+                seed = self._residual_peak_seed(xdata_width, verbose=verbose)
+                if seed is None:
+                    break
+
+            (p0_peak, min_bounds_peak, max_bounds_peak) = seed
+            p0_init = p0_init + p0_peak
+            min_bounds = min_bounds + min_bounds_peak
+            max_bounds = max_bounds + max_bounds_peak
+
+            try:
+                (fit_func, fit_jac) = _fit_model()
+                popt, pcov = scipy.optimize.curve_fit(
+                    fit_func,
+                    xdata,
+                    ydata_smoothed,
+                    p0=p0_init,
+                    bounds=(min_bounds, max_bounds),
+                    jac=fit_jac
+                )
+            except (RuntimeError, ValueError) as e:
+                if verbose:
+                    print("Fit with {} peaks failed: {}".format(num_peaks, e))
+                break
+
+            self._set_fit_results(popt, i_peaks, num_peaks, verbose=verbose)
+            score = getattr(self.total_fit_result, criterion)
+            candidate_scores.append({"num_peaks": num_peaks,
+                                     "aic": self.total_fit_result.aic,
+                                     "bic": self.total_fit_result.bic,
+                                     "rmse": self.total_fit_result.rmse,
+                                     "durbin_watson": self.total_fit_result.durbin_watson})
+            if verbose:
+                print("{} peaks: {} = {:.3f}".format(num_peaks, criterion, score))
+
+            if best is None or score < best[0]:
+                best = (score, self.peak_fit_results, self.total_fit_result)
+            elif num_peaks - len(best[1]) >= AUTO_PATIENCE:
+                break
+
+        if best is None:
+            raise RuntimeError("fit_auto - none of the candidate fits worked")
+
+        (_, self.peak_fit_results, self.total_fit_result) = best
+        self.total_fit_result.candidate_scores = candidate_scores
+
+        if cache_key is not None:
+            cache.put(cache_key, self.num_peaks_predicted, self.peak_fit_results, self.total_fit_result)
+
+        return len(self.peak_fit_results)
+
+    def invert(self, kernel: InversionKernel, method: str = DEFAULT_INVERSION_METHOD) -> InversionResult:
+        """
+        The alternative to fitting peaks: invert the scan to its growth factor distribution, taking
+        the transfer functions of both DMAs into account (see inversion). The bad values are left
+        out the same way as for the fit.
+
+        :param kernel: the InversionKernel of the run (see inversion.get_run_inversion_kernel)
+        :param method: "twomey" or "nnls"
+        :return: the InversionResult, with this one scan. Also stored in self.inversion_result
+        """
+        self.inversion_result = kernel.invert(self._y_filtered, method, scan_index=np.array([self.scan_index]))
+        return self.inversion_result
+
+    def _predicted_peak_seed(self, i_peak: int, xdata_width: float) -> tuple:
+        """
+        Internal helper to build the starting point and bounds of a peak found by predict_peaks
+
+        :return: (p0, min_bounds, max_bounds), each a list of amp, mu, sd
+        """
+        xdata = self.get_log_dp_range()
+        ydata = self._y_filtered
+
+        init_amp = ydata[i_peak]
+        min_amp = init_amp * 0.1
+        max_amp = init_amp * 1.5
+
+        init_mu = xdata[i_peak]
+        min_mu = init_mu - xdata_width * 0.05
+        max_mu = init_mu + xdata_width * 0.05
+
+        init_sd = xdata_width * 0.05
+        min_sd = xdata_width * 0.01
+        max_sd = xdata_width * 0.20
+
+        return [init_amp, init_mu, init_sd], [min_amp, min_mu, min_sd], [max_amp, max_mu, max_sd]
+
+    def _residual_peak_seed(self, xdata_width: float, verbose=False) -> tuple:
+        """
+        Internal helper to build the starting point and bounds of an extra peak, from the largest
+        peak in the residuals of the current fit
+
+        :return: (p0, min_bounds, max_bounds), each a list of amp, mu, sd. None if the residuals
+        have no usable peak
+        """
+        xdata = self.get_log_dp_range()
+        ydata = self._y_filtered
+
+        i_residual_peaks = predict_peaks(self.total_fit_result.residuals_smoothed,
+                                         is_scan=False,
+                                         verbose=verbose)
+
+        # Sometimes the residual can measure a large at the tails of
+        # the gaussian, when the acutal data is zero
+        i_pk = next((i for i in i_residual_peaks if ydata[i] > 0), None)
+        if i_pk is None:
+            return None
+
+        init_amp = ydata[i_pk]
+        min_amp = init_amp * 0.1
+        max_amp = init_amp * 1.5
+
+        init_mu = xdata[i_pk]
+        min_mu = init_mu - xdata_width * 0.25
+        max_mu = init_mu + xdata_width * 0.25
+
+        init_sd = xdata_width * 0.05
+        min_sd = xdata_width * 0.01
+        max_sd = xdata_width * 0.20
+
+        return [init_amp, init_mu, init_sd], [min_amp, min_mu, min_sd], [max_amp, max_mu, max_sd]
+
+    def _fallback_peak_seed(self, i_peak: int, xdata_width: float) -> tuple:
+        """
+        Internal helper to build the starting point and bounds of a peak when there is nothing
+        better to go on. The peak may end up anywhere within the peak bounds of the scan
+
+        :return: (p0, min_bounds, max_bounds), each a list of amp, mu, sd
+        """
+        xdata = self.get_log_dp_range()
+        ydata = self._y_filtered
+
+        init_amp = ydata[i_peak]
+        min_amp = ydata.max() * 0.005
+        max_amp = ydata.max() * 1.25
+
+        init_mu = xdata[i_peak]
+        # TODO - Need to figure out the appropriate peak range in this case
+        min_mu = xdata[INDEX_OF_PEAK_BOUNDS]
+        max_mu = xdata[-(INDEX_OF_PEAK_BOUNDS+1)]
+
+        init_sd = xdata_width * 0.05
+        min_sd = xdata_width * 0.01
+        max_sd = xdata_width * 0.25
+
+        return [init_amp, init_mu, init_sd], [min_amp, min_mu, min_sd], [max_amp, max_mu, max_sd]
+
+    def fit_warm_start(self, init_params, reference_fit: TotalFitResult, verbose=False) -> bool:
+        """
+        Fit this scan starting from the converged parameters of another fit, usually the
+        previous scan in the run. Consecutive scans barely move, so this skips the peak
+        prediction and the passes over the residuals that fit() goes through.
+
+        The fit is only kept if it is about as good as reference_fit (see WARM_START_MAX_NRMSE_RATIO
+        and WARM_START_MAX_DW_CHANGE). Otherwise, nothing is stored and the caller should fall
+        back to fit().
+
+        :param init_params: the fit_params of the fit to start from, 3 per peak
+        :param reference_fit: the TotalFitResult to compare the quality of the fit against
+        :param verbose: print out info while doing the fit?
+        :return: True if the fit was kept, False if it was rejected
+        """
+        xdata = self.get_log_dp_range()
+        ydata = self._y_filtered
+        ydata_smoothed = calc_moving_ave(ydata,3)
+        xdata_width = xdata.max() - xdata.min()
+
+        # Let each peak move around its previous location just like fit() does, but let the
+        # amplitude go wherever it needs to
+        init_params = np.reshape(init_params, (-1, 3))
+        num_peaks = init_params.shape[0]
+        min_bounds = np.column_stack((np.zeros(num_peaks),
+                                      init_params[:, 1] - xdata_width * 0.05,
+                                      np.full(num_peaks, xdata_width * 0.01)))
+        max_bounds = np.column_stack((np.full(num_peaks, np.inf),
+                                      init_params[:, 1] + xdata_width * 0.05,
+                                      np.full(num_peaks, xdata_width * 0.20)))
+        p0_init = np.clip(init_params, min_bounds, max_bounds)
+
+        try:
+            (fit_func, fit_jac) = _fit_model()
+            popt, pcov = scipy.optimize.curve_fit(
+                fit_func,
+                xdata,
+                ydata_smoothed,
+                p0=p0_init.ravel(),
+                bounds=(min_bounds.ravel(), max_bounds.ravel()),
+                jac=fit_jac
+            )
+        except (RuntimeError, ValueError) as e:
+            if verbose:
+                print("Warm start fit failed: {}".format(e))
+            return False
+
+        self._set_fit_results(popt, [], num_peaks, verbose=verbose)
+
+        is_good_fit = self.total_fit_result.nrmse <= reference_fit.nrmse * WARM_START_MAX_NRMSE_RATIO and \
+                      abs(self.total_fit_result.durbin_watson - 2) <= \
+                      abs(reference_fit.durbin_watson - 2) + WARM_START_MAX_DW_CHANGE
+        if not is_good_fit:
+            if verbose:
+                print("Warm start fit rejected:\n{}".format(repr(self.total_fit_result)))
+            self.peak_fit_results = None
+            self.total_fit_result = None
+            return False
+
+        self.num_peaks_predicted = None
+        return True
+
+    def _set_fit_results(self, popt, i_peaks, num_peaks_desired, verbose=False):
+        """
+        Internal helper function to build self.peak_fit_results and self.total_fit_result
+        from the parameters returned by curve_fit
+
+        :param popt: the optimized parameters, 3 per peak
+        :param i_peaks: the indices of the peaks predicted before fitting
+        :param num_peaks_desired: the number of peaks the user asked for
+        :param verbose: print out info while doing the fit?
+        """
+        xdata = self.get_log_dp_range()
+        ydata = self._y_filtered
+        num_peaks_fitted = len(popt) // 3
+
+        # Create the peak results object
+        if verbose:
+            print("Predicting {} : parameters:".format(num_peaks_fitted))
+
+        self.peak_fit_results = list()
+        for i_peak in range(num_peaks_fitted):
+            peak_fit_result = PeakFitResult()
+            params = popt[i_peak * 3:(i_peak + 1) * 3]
+            peak_fit_result.fit_params = params
+            peak_fit_result.index = i_peak
+            peak_fit_result.dp = np.exp(params[1])
+            peak_fit_result.height = params[0]
+            peak_fit_result.sd = np.exp(params[1] + params[2]) - peak_fit_result.dp  #TODO Verify this - this may not be right
+            peak_fit_result.fwhh = peak_fit_result.sd * 2.3548 #TODO - Verify this - it may not be right
+            # These need DMA 1's dp and the RH, see hygroscopicity.compute_run_hygroscopicity
+            peak_fit_result.growth_factor = np.nan
+            peak_fit_result.kappa = np.nan
+            self.peak_fit_results.append(peak_fit_result)
+            if verbose:
+                print(repr(peak_fit_result))
+
+        self.total_fit_result = TotalFitResult()
+        self.total_fit_result.predicted_peak_indices = i_peaks
+        self.total_fit_result.num_peaks = num_peaks_desired
+        self.total_fit_result.fit_params = popt
+        self.total_fit_result.fit_values = _fit_model()[0](xdata, *popt)
+        self.total_fit_result.residuals = ydata - self.total_fit_result.fit_values
+        self.total_fit_result.residuals_smoothed = calc_moving_ave(self.total_fit_result.residuals,3)
+        # The indices of residual peaks is a lag value from the previous pass!
+        self.total_fit_result.rmse = np.sqrt(np.sum(self.total_fit_result.residuals[self._y_sel_good] *
+                                                    self.total_fit_result.residuals[self._y_sel_good]))
+        # Durbin-Watson - a good test of fitness, measures the independence of the
+        # residuals, or more specifically, there is no serial correlation.
+        # Range is 0-4. A value of 2 is ideal
+        self.total_fit_result.durbin_watson = durbin_watson(self.total_fit_result.residuals)
+
+        # The rmse relative to the size of the signal, so it can be compared between scans
+        y_good_norm = np.sqrt(np.sum(ydata[self._y_sel_good] * ydata[self._y_sel_good]))
+        self.total_fit_result.nrmse = self.total_fit_result.rmse / y_good_norm if y_good_norm > 0 else np.inf
+
+        # How well the fit is worth its number of parameters, for picking the number of peaks
+        (self.total_fit_result.aic, self.total_fit_result.bic) = information_criteria(
+            self.total_fit_result.rmse ** 2, np.count_nonzero(self._y_sel_good), len(popt))
+
+        # Compute E(residuals) i.e. the mean should be 0
+        self.total_fit_result.residuals_mean = np.mean(self.total_fit_result.residuals)
+
+        if verbose:
+            print(repr(self.total_fit_result))
+
     # def get_fit_peak_dp(self):
     #     """
     #     :return:         Return a list of the fitted dp values
@@ -545,30 +836,61 @@ class Scan:
     #     return x
 
 
-def get_gaussian_fit_func(num_peaks):
+def filter_bad_values(values: np.ndarray):
     """
-    Return the correct fit function depending on the number of gaussians you
-    are trying to fit
+    Identify the points that should NOT be used in the curve fit, and flatten them
+
+    #1) If < MIN_GOOD_WINDOW_SIZE sequential points are surrounded by 0 values, flatten them
+    #2) Ignore the first and last channel values
+
+    A streak of good channels that runs right up to the last channel is never flattened.
+
+    This works on a single scan, or on a whole (n_scans, n_dp) matrix of scans at once. The
+    streaks are found with a diff over the good channel mask, and the short ones are
+    flattened with a cumsum, so there are no Python loops over the channels.
+
+    :param values: the raw concentration values, shape (n_dp,) or (n_scans, n_dp)
+    :return: The filtered values, and the boolean selection array indicating
+    where the values are good. Both are the same shape as values
     """
-    if num_peaks == 1:
-        fit_func = _1gaussian
-    elif num_peaks == 2:
-        fit_func = _2gaussian
-    elif num_peaks == 3:
-        fit_func = _3gaussian
-    elif num_peaks == 4:
-        fit_func = _4gaussian
-    elif num_peaks == 5:
-        fit_func = _5gaussian
-    else:
-        fit_func = None
-    return fit_func
+    values = np.asarray(values, dtype=float)
+    values_2d = np.atleast_2d(values)
+    (num_scans, num_dp) = values_2d.shape
+
+    # Good channels are anything > 0, except the first and last channel values
+    y_sel_good = values_2d > 0
+    y_sel_good[:, 0] = False
+    y_sel_good[:, -1] = False
+
+    # Find where each streak of good channels starts and ends (exclusive). Padding with zeros
+    # on each side means every start has a matching end, and np.nonzero returns them in order
+    edges = np.diff(y_sel_good.astype(np.int8), axis=1, prepend=0, append=0)
+    (rows, starts) = np.nonzero(edges == 1)
+    ends = np.nonzero(edges == -1)[1]
+
+    # Flatten the short streaks that are closed off by a bad channel
+    is_short = (ends - starts < MIN_GOOD_WINDOW_SIZE) & (ends < num_dp - 1)
+    marks = np.zeros((num_scans, num_dp + 1), dtype=np.int32)
+    marks[rows[is_short], starts[is_short]] = 1
+    marks[rows[is_short], ends[is_short]] = -1
+    y_sel_good &= np.cumsum(marks, axis=1)[:, :num_dp] == 0
+
+    # We're done! Flatten the bad channels
+    y_filtered = np.where(y_sel_good, values_2d, 0.0)
+
+    if values.ndim == 1:
+        return y_filtered[0], y_sel_good[0]
+    return y_filtered, y_sel_good
 
 
 def calc_moving_ave(x, w: int):
     """
     Compute the moving average of a series
 
+    This works on a single series, or along the last axis of a whole (n_scans, n_dp) matrix
+    at once. The window is summed with shifted slices into the one output array, which gives
+    the same values as np.convolve(x, np.ones(w), 'valid'), bit for bit.
+
     :param x: The data
     :param w: The window size for computing the average
 
@@ -579,11 +901,50 @@ def calc_moving_ave(x, w: int):
     if w % 2 == 0:
         raise ValueError("calc_moving_ave parameter w must be odd")
 
-    x = np.convolve(x, np.ones(w), 'valid') / w
+    x = np.asarray(x, dtype=float)
+    n = x.shape[-1]
     pad = (w-1) // 2
-    x = np.append(np.zeros(pad), x)
-    x = np.append(x, np.zeros(pad))
-    return x
+    smoothed = np.zeros(x.shape)
+    if n < w:
+        return smoothed
+    window_sum = smoothed[..., pad:n - pad]
+    window_sum[...] = x[..., :n - w + 1]
+    for k in range(1, w):
+        window_sum += x[..., k:n - w + 1 + k]
+    window_sum /= w
+    return smoothed
+
+
+def _peak_search_settings(is_scan: bool) -> dict:
+    """
+    INTERNAL FUNCTION -
+    The find_peaks settings shared by predict_peaks and predict_peaks_batch. The threshold and
+    prominence limits are the range (max - min) of the signal divided by these values
+    """
+    settings = {
+        # Vertical distance of the peak to neighbor samples
+        # NOTE - changed 20221021 - it was threshold = (0, (x.max() - x.min()) / 4)
+        # But for very thin tall peaks with very few points, the threshold was too tight.
+        "threshold_divisor": 2,
+        # distance to neighbor peaks in samples
+        "distance": 10,
+        # width of the peak in samples
+        "width": 1,
+        # Relative height at which width is measured as a percentage of
+        # its prominence
+        "rel_height": 0.2,
+        # prominence of the peak
+        # - how much a peak stands out from the surrounding baseline
+        #   of the signal and is defined as the vertical distance between
+        #   the peak and its lowest contour line
+        "prominence_divisor": 10,
+    }
+    if not is_scan:
+        #settings["distance"] = 5
+        settings["width"] = 3
+        settings["rel_height"] = 0.25
+        settings["prominence_divisor"] = 20
+    return settings
 
 
 def predict_peaks(data, is_scan: bool, verbose=False):
@@ -602,39 +963,19 @@ def predict_peaks(data, is_scan: bool, verbose=False):
     # data = np.append([0], data)
     # data = np.append(data, [0])
 
+    settings = _peak_search_settings(is_scan)
     x = data
-
-    # Vertical distance of the peak to neighbor samples
-    # NOTE - changed 20221021 - it was threshold = (0, (x.max() - x.min()) / 4)
-    # But for very thin tall peaks with very few points, the threshold was too tight.
-    threshold = (0, (x.max() - x.min()) / 2)
-    # distance to neighbor peaks in samples
-    distance = 10
-    # width of the peak in samples
-    width = 1
-    # Relative height at which width is measured as a percentage of
-    # its prominence
-    rel_height = 0.2
-    # prominence of the peak
-    # - how much a peak stands out from the surrounding baseline
-    #   of the signal and is defined as the vertical distance between
-    #   the peak and its lowest contour line
-    prominence = ((x.max() - x.min()) / 10,
-                  (x.max() - x.min()))
     if not is_scan:
+        # Residual peaks are the dips
         x = np.multiply(x, -1.0)
-        #distance=5
-        width=3
-        rel_height= 0.25
-        prominence = ((x.max() - x.min()) / 20,
-                      (x.max() - x.min()))
+    x_range = x.max() - x.min()
 
     i_pk, other = scipy.signal.find_peaks(x,
-                                          threshold=threshold,
-                                          distance=distance,
-                                          width=width,
-                                          rel_height=rel_height,
-                                          prominence=prominence
+                                          threshold=(0, x_range / settings["threshold_divisor"]),
+                                          distance=settings["distance"],
+                                          width=settings["width"],
+                                          rel_height=settings["rel_height"],
+                                          prominence=(x_range / settings["prominence_divisor"], x_range)
                                           )
 
     if verbose:
@@ -652,4 +993,156 @@ def predict_peaks(data, is_scan: bool, verbose=False):
     else:
         return []
 
-    return i_pk
+
+def predict_peaks_batch(matrix: np.ndarray, is_scan: bool = True, smooth_window: int = 3):
+    """
+    predict_peaks for every row of a (n_scans, n_dp) matrix at once.
+
+    The rows are smoothed with calc_moving_ave(matrix, smooth_window) (use 1 to not smooth),
+    which is what Scan.fit does before predict_peaks. Then the steps of scipy.signal.find_peaks
+    (local maxima, threshold, distance, prominence, width) are done with array operations over
+    all the rows together, so there is no Python call per scan. The only loops are over the
+    rank of a peak within its row, for the distance step.
+
+    The peaks of row i are indices[indptr[i]:indptr[i + 1]], as in a scipy.sparse CSR matrix.
+    They are the same as predict_peaks(calc_moving_ave(matrix[i], smooth_window), is_scan),
+    including the order (strongest first) and the INDEX_OF_PEAK_BOUNDS filter.
+
+    :param matrix: the signals, one per row (either scans or residuals)
+    :param is_scan: Is this scan data or residual data?
+    :param smooth_window: the window size of the moving average applied first
+    :return: (indptr, indices)
+    """
+    settings = _peak_search_settings(is_scan)
+    x = calc_moving_ave(np.atleast_2d(matrix), smooth_window)
+    if not is_scan:
+        # Residual peaks are the dips
+        x = np.multiply(x, -1.0)
+    (num_rows, n) = x.shape
+    if num_rows == 0 or n < 3:
+        return np.zeros(num_rows + 1, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    x_range = x.max(axis=1) - x.min(axis=1)
+    cols = np.arange(n)
+
+    # Local maxima. Ignoring the flat steps, a peak is a rise followed by a fall. The peak of a
+    # plateau is its middle (rounded down), the same as find_peaks
+    diffs = np.diff(x, axis=1)
+    (step_rows, step_cols) = np.nonzero(diffs)
+    rising = diffs[step_rows, step_cols] > 0
+    sel = (step_rows[:-1] == step_rows[1:]) & rising[:-1] & ~rising[1:]
+    rows = step_rows[:-1][sel]
+    peaks = (step_cols[:-1][sel] + 1 + step_cols[1:][sel]) // 2
+
+    # Threshold - the vertical distance to both neighbors
+    heights = x[rows, peaks]
+    left_drop = heights - x[rows, peaks - 1]
+    right_drop = heights - x[rows, peaks + 1]
+    sel = (np.minimum(left_drop, right_drop) >= 0) & \
+          (np.maximum(left_drop, right_drop) <= x_range[rows] / settings["threshold_divisor"])
+    (rows, peaks, heights) = (rows[sel], peaks[sel], heights[sel])
+
+    (rows, peaks, heights) = _select_peaks_by_distance(num_rows, rows, peaks, heights, settings["distance"])
+
+    # Prominence. Each side is searched up to the nearest higher point (or the end of the
+    # signal), and the base on that side is its lowest point
+    x_rows = x[rows]
+    higher = x_rows > heights[:, None]
+    before = cols < peaks[:, None]
+    after = cols > peaks[:, None]
+    left_end = np.where(higher & before, cols, -1).max(axis=1) + 1
+    right_end = np.where(higher & after, cols, n).min(axis=1) - 1
+    left_side = np.where((cols >= left_end[:, None]) & ~after, x_rows, np.inf)
+    right_side = np.where((cols <= right_end[:, None]) & ~before, x_rows, np.inf)
+    # find_peaks keeps the lowest point nearest the peak, if there are several
+    left_base = n - 1 - np.argmin(left_side[:, ::-1], axis=1)
+    right_base = np.argmin(right_side, axis=1)
+    i_peaks = np.arange(len(rows))
+    prominences = heights - np.maximum(left_side[i_peaks, left_base], right_side[i_peaks, right_base])
+    sel = (prominences >= x_range[rows] / settings["prominence_divisor"]) & (prominences <= x_range[rows])
+    (rows, peaks, heights, prominences, left_base, right_base, x_rows) = \
+        (rows[sel], peaks[sel], heights[sel], prominences[sel], left_base[sel], right_base[sel], x_rows[sel])
+
+    # Width, at rel_height of the prominence below the peak, with linear interpolation
+    i_peaks = np.arange(len(rows))
+    width_height = heights - prominences * settings["rel_height"]
+    below = x_rows <= width_height[:, None]
+    i_left = np.where(below & (cols >= left_base[:, None]) & (cols <= peaks[:, None]), cols, -1).max(axis=1)
+    i_left = np.where(i_left < 0, left_base, i_left)
+    i_right = np.where(below & (cols <= right_base[:, None]) & (cols >= peaks[:, None]), cols, n).min(axis=1)
+    i_right = np.where(i_right >= n, right_base, i_right)
+    x_left = x_rows[i_peaks, i_left]
+    x_right = x_rows[i_peaks, i_right]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        left_ip = np.where(x_left < width_height,
+                           i_left + (width_height - x_left) / (x_rows[i_peaks, np.minimum(i_left + 1, n - 1)] - x_left),
+                           i_left)
+        right_ip = np.where(x_right < width_height,
+                            i_right - (width_height - x_right) / (x_rows[i_peaks, np.maximum(i_right - 1, 0)] - x_right),
+                            i_right)
+    sel = right_ip - left_ip >= settings["width"]
+    (rows, peaks, heights) = (rows[sel], peaks[sel], heights[sel])
+
+    # Sort each row from the highest/strongest peak to the lowest/weakest, and drop the
+    # peaks too close to the edges
+    order = np.lexsort((peaks, -heights, rows))
+    (rows, peaks) = (rows[order], peaks[order])
+    sel = (peaks >= INDEX_OF_PEAK_BOUNDS) & (peaks <= n - 1 - INDEX_OF_PEAK_BOUNDS)
+    (rows, peaks) = (rows[sel], peaks[sel])
+
+    indptr = np.zeros(num_rows + 1, dtype=np.intp)
+    np.cumsum(np.bincount(rows, minlength=num_rows), out=indptr[1:])
+    return indptr, peaks.astype(np.intp)
+
+
+def _select_peaks_by_distance(num_rows: int, rows: np.ndarray, peaks: np.ndarray, heights: np.ndarray,
+                              distance: int):
+    """
+    INTERNAL FUNCTION -
+    The distance step of find_peaks, for the peaks of many rows at once. In each row, the
+    highest peak is kept and every other peak closer than distance to it is dropped, then the
+    next highest peak that is left, and so on.
+
+    :param num_rows: the number of rows
+    :param rows: the row of each peak, in order
+    :param peaks: the index of each peak in its row, in order within each row
+    :param heights: the height of each peak
+    :param distance: the smallest distance allowed between peaks, in samples
+    :return: (rows, peaks, heights) of the peaks that are kept
+    """
+    if len(rows) == 0:
+        return rows, peaks, heights
+
+    # Lay the peaks out as (num_rows, max peaks per row), padded on the right
+    counts = np.bincount(rows, minlength=num_rows)
+    starts = np.cumsum(counts) - counts
+    slots = np.arange(len(rows)) - starts[rows]
+    max_count = counts.max()
+    padded_peaks = np.zeros((num_rows, max_count), dtype=peaks.dtype)
+    padded_heights = np.full((num_rows, max_count), -np.inf)
+    padded_peaks[rows, slots] = peaks
+    padded_heights[rows, slots] = heights
+    is_peak = np.arange(max_count)[None, :] < counts[:, None]
+
+    # too_close[r, i, j] - peaks i and j of row r are too close to both be kept
+    too_close = np.abs(padded_peaks[:, :, None] - padded_peaks[:, None, :]) < int(np.ceil(distance))
+    too_close &= is_peak[:, :, None] & is_peak[:, None, :]
+    too_close[:, np.arange(max_count), np.arange(max_count)] = False
+
+    # Visit the peaks from the highest down. Which of two equally high peaks find_peaks visits
+    # first depends on how np.argsort (not a stable sort) orders the heights of that row, so the
+    # few rows with ties are sorted again the same way
+    order = np.argsort(padded_heights, axis=1, kind="stable")
+    sorted_heights = np.take_along_axis(padded_heights, order, axis=1)
+    tied = (sorted_heights[:, 1:] == sorted_heights[:, :-1]) & np.isfinite(sorted_heights[:, 1:])
+    for row in np.nonzero(tied.any(axis=1))[0]:
+        order[row, max_count - counts[row]:] = np.argsort(heights[starts[row]:starts[row] + counts[row]])
+    order = order[:, ::-1]
+    keep = is_peak.copy()
+    all_rows = np.arange(num_rows)
+    for rank in range(max_count):
+        i_slot = order[:, rank]
+        visiting = is_peak[all_rows, i_slot] & keep[all_rows, i_slot]
+        keep[visiting] &= ~too_close[all_rows[visiting], i_slot[visiting]]
+
+    sel = keep[rows, slots]
+    return rows[sel], peaks[sel], heights[sel]
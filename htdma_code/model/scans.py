@@ -1,62 +1,245 @@
 
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
 import numpy as np
-import pandas as pd
 
 import htdma_code.model.files.read_file_utils as read_file_utils
-from htdma_code.model.scan import Scan
+import htdma_code.model.files.run_cache as run_cache
+from htdma_code.model.files.run_data import RunData
+from htdma_code.model.charge_correction import ChargeCorrection
+from htdma_code.model.fit_result_set import FitResultSet
+from htdma_code.model.fit_cache import FitCache
+from htdma_code.model.inversion import InversionKernel, InversionResult, DEFAULT_INVERSION_METHOD
+from htdma_code.model.scan import Scan, MAX_PEAKS_TO_FIT, AUTO_MAX_PEAKS, DEFAULT_AUTO_CRITERION, filter_bad_values, \
+    predict_peaks_batch
+
+# When fitting in parallel, how many chunks of scans to split the run into for each worker.
+# More chunks means finer progress updates and quicker cancelling, at the cost of more overhead
+CHUNKS_PER_WORKER = 4
+
+# How long to wait for a chunk to finish before checking again whether we were cancelled (sec)
+CANCEL_POLL_SEC = 0.25
+
+
+def _fit_scan_chunk(first_scan_index: int, values: np.ndarray, dp_range: np.ndarray,
+                    log_dp_range: np.ndarray, num_peaks_desired: int, warm_start: bool = False,
+                    cache: FitCache = None, auto_max_peaks: int = AUTO_MAX_PEAKS,
+                    criterion: str = DEFAULT_AUTO_CRITERION) -> list:
+    """
+    INTERNAL FUNCTION -
+    Fit a contiguous chunk of scans. This runs in a worker process, so it only gets
+    handed plain numpy arrays. The values of the whole chunk are filtered, and their peaks
+    predicted, with one call each instead of once per scan.
+
+    :param first_scan_index: the index of the first scan in the chunk
+    :param values: the rows of the concentration matrix for the chunk
+    :param dp_range: the dp values of the run
+    :param log_dp_range: np.log(dp_range)
+    :param num_peaks_desired: the number of peaks to fit, or None to pick it for each scan (see Scan.fit_auto)
+    :param warm_start: if True, start each scan from the previous scan's fit (see Scan.fit_warm_start).
+                       The first scan of the chunk is always fitted from scratch
+    :param cache: [Optional] a FitCache to look up (and store) the fits from scratch in
+    :param auto_max_peaks: the most peaks to try, if num_peaks_desired is None
+    :param criterion: the information criterion to pick the number of peaks with, if num_peaks_desired is None
+    :return: a list with one (scan_index, num_peaks_predicted, peak_fit_results, total_fit_result,
+             was_warm_started, error) tuple per scan. error is None if the fit worked, otherwise the
+             error message
+    """
+    (y_filtered, y_sel_good) = filter_bad_values(values)
+    (peaks_indptr, peaks_indices) = predict_peaks_batch(y_filtered, is_scan=True)
+
+    chunk_results = []
+    prev_fit_params = None   # the last fit in this chunk, to warm start from
+    reference_fit = None     # the last fit from scratch, to judge the warm started fits against
+    for i in range(values.shape[0]):
+        scan = Scan(scan_index=first_scan_index + i,
+                    values=values[i],
+                    dp_range=dp_range,
+                    log_dp_range=log_dp_range,
+                    y_filtered=y_filtered[i],
+                    y_sel_good=y_sel_good[i])
+        i_peaks_predicted = peaks_indices[peaks_indptr[i]:peaks_indptr[i + 1]]
+        try:
+            was_warm_started = warm_start and prev_fit_params is not None and \
+                               scan.fit_warm_start(prev_fit_params, reference_fit)
+            if not was_warm_started:
+                if num_peaks_desired is None:
+                    scan.fit_auto(max_peaks=auto_max_peaks, criterion=criterion, cache=cache,
+                                  i_peaks_predicted=i_peaks_predicted)
+                else:
+                    scan.fit(num_peaks_desired=num_peaks_desired, cache=cache, i_peaks_predicted=i_peaks_predicted)
+                reference_fit = scan.total_fit_result
+            prev_fit_params = scan.total_fit_result.fit_params
+            chunk_results.append((scan.scan_index, scan.num_peaks_predicted,
+                                  scan.peak_fit_results, scan.total_fit_result, was_warm_started, None))
+        except Exception as e:
+            prev_fit_params = None
+            chunk_results.append((scan.scan_index, None, None, None, False, "{}: {}".format(type(e).__name__, e)))
+    if cache is not None:
+        cache.flush()
+    return chunk_results
+
 
 class Scans:
     """
     The Scans class
 
     This class encapsulates all scans in a given run. All scans are processed right from the raw data file
-    and managed as a pandas DataFrame.
+    and managed as a single numpy matrix, one row per scan. Each Scan object is just a view into its row.
 
     Attributes:
-        * df - internal Pandas dataframe storing the file contents read in
+        * conc - numpy float64 array of the concentrations of every scan, shape (n_scans, n_dp).
+                 Corrected for multiply charged particles if charge_correction is set
+        * conc_filtered - conc with the bad values flattened to 0 (see scan.filter_bad_values)
+        * sel_good - boolean array, True where conc is good enough to use in the fit
+        * dp_range - numpy array of the dp values, shared by all scans
+        * log_dp_range - np.log of dp_range, shared by all scans
         * list_of_scans - a Python list of Scan objects
         * num_dp_values - a convenience variable that stores the numnber of channels / dp values
+        * charge_correction - the ChargeCorrection applied to the scans as they were read in, or None
     """
     def __init__(self):
-        self.df = None
+        self.conc = None
+        self.conc_filtered = None
+        self.sel_good = None
+        self.dp_range = None
+        self.log_dp_range = None
         self.list_of_scans = None
         self.num_dp_values = 0
+        self.charge_correction: ChargeCorrection = None
+
+        # Preallocated rows for the matrices when scans get appended (see append_run_data).
+        # conc, conc_filtered and sel_good are then views of the first get_num_scans() rows
+        self._conc_buffer = None
+        self._conc_filtered_buffer = None
+        self._sel_good_buffer = None
 
     def __repr__(self):
         s = "Scans:\n"
-        if self.df is not None:
-            s += "  Index: {}\n".format(repr(self.df.index))
-            s += "  Columns: {}\n".format(repr(self.df.columns))
-            s += "  Num Rows: {}\n".format(repr(self.df.shape[0]))
-            s += "  Num Cols: {}\n".format(repr(self.df.shape[1]))
+        if self.conc is not None:
+            s += "  dp range: {}\n".format(repr(self.dp_range))
+            s += "  Num scans: {}\n".format(self.conc.shape[0])
             s += "  Num dp values: {}\n".format(self.num_dp_values)
         else:
             s += "  NOT INITIALIZED"
 
         return s
 
-    def read_file(self, filename):
+    def read_file(self, filename, use_cache: bool = True):
         """
-        Read in all the scans, and store them internally as a Pandas dataframe
+        Read in all the scans, and store them internally as a numpy matrix
         AND as a list of scan objects
+
+        :param filename: the run file to read
+        :param use_cache: True to read (and write) the binary sidecar of the file (see run_cache)
+        """
+        if use_cache:
+            self.read_run_data(run_cache.read_run_file_cached(filename))
+        else:
+            self.read_run_data(read_file_utils.read_run_file(filename))
+
+    def read_run_data(self, run_data: RunData, charge_correction: ChargeCorrection = None):
+        """
+        Set up all the scans from a run that has already been read in
+
+        :param run_data: a RunData object returned by read_file_utils.read_run_file
+        :param charge_correction: [Optional] correct every scan for multiply charged particles with
+                                  this (see charge_correction.get_run_charge_correction), with a single
+                                  matrix product. Scans appended later are corrected too
+        """
+        self.charge_correction = charge_correction
+        if charge_correction is not None:
+            self.conc = charge_correction.apply(run_data.conc)
+        else:
+            self.conc = np.ascontiguousarray(run_data.conc, dtype=np.float64)
+        self.dp_range = run_data.dp
+        self.log_dp_range = np.log(self.dp_range)
+        self.num_dp_values = run_data.get_num_dp_values()
+        self._conc_buffer = None
+        self._conc_filtered_buffer = None
+        self._sel_good_buffer = None
+
+        # Clean up the bad values of every scan in one go
+        (self.conc_filtered, self.sel_good) = filter_bad_values(self.conc)
+
+        # Now, wrap each row of the matrices in a Scan object. These share the data, nothing is copied
+        self.list_of_scans = [Scan(scan_index=i,
+                                   values=self.conc[i],
+                                   dp_range=self.dp_range,
+                                   log_dp_range=self.log_dp_range,
+                                   y_filtered=self.conc_filtered[i],
+                                   y_sel_good=self.sel_good[i])
+                              for i in range(self.conc.shape[0])]
+
+    def append_run_data(self, run_data: RunData) -> int:
+        """
+        Append more scans of the same run (e.g. from RunFileTail.poll) after the scans already
+        read in. Only the new scans are filtered, and the Scan objects of the existing scans
+        (along with their fit results) are kept.
+
+        The matrices grow by doubling, so appending one scan at a time is amortized O(1) per scan.
+        Existing Scan objects may still be views of the previous (identical) rows.
+
+        :param run_data: a RunData with the new scans
+        :return: the index of the first new scan
+        """
+        if self.conc is None:
+            self.read_run_data(run_data)
+            return 0
+        if run_data.get_num_dp_values() != self.num_dp_values or not np.allclose(run_data.dp, self.dp_range):
+            raise ValueError("append_run_data - the dp values of the new scans do not match the run")
+
+        first = self.get_num_scans()
+        num_scans = first + run_data.get_num_scans()
+        new_conc = run_data.conc
+        if self.charge_correction is not None:
+            new_conc = self.charge_correction.apply(new_conc)
+        (new_conc_filtered, new_sel_good) = filter_bad_values(new_conc)
+
+        self._reserve(num_scans)
+        self._conc_buffer[first:num_scans] = new_conc
+        self._conc_filtered_buffer[first:num_scans] = new_conc_filtered
+        self._sel_good_buffer[first:num_scans] = new_sel_good
+        self.conc = self._conc_buffer[:num_scans]
+        self.conc_filtered = self._conc_filtered_buffer[:num_scans]
+        self.sel_good = self._sel_good_buffer[:num_scans]
+
+        self.list_of_scans.extend(Scan(scan_index=i,
+                                       values=self.conc[i],
+                                       dp_range=self.dp_range,
+                                       log_dp_range=self.log_dp_range,
+                                       y_filtered=self.conc_filtered[i],
+                                       y_sel_good=self.sel_good[i])
+                                  for i in range(first, num_scans))
+        return first
+
+    def _reserve(self, num_scans: int):
+        """
+        Internal helper to grow the matrix buffers (by doubling) until num_scans rows fit
         """
-        (self.df, self.num_dp_values) = read_file_utils.read_scans_into_dataframe(filename)
+        capacity = self._conc_buffer.shape[0] if self._conc_buffer is not None else 0
+        if num_scans <= capacity:
+            return
+        capacity = max(num_scans, 2 * capacity, 2 * self.get_num_scans())
+        num_rows = self.get_num_scans()
+
+        def _grow(matrix):
+            buffer = np.zeros((capacity, self.num_dp_values), dtype=matrix.dtype)
+            buffer[:num_rows] = matrix
+            return buffer
 
-        # Now, process all scan data into Scan objects. Scans are stored as columns
-        # in the data
-        self.list_of_scans = []
-        for col in range(self.df.shape[1]):
-            scan = Scan(scan_index=col,
-                        df=self.df.iloc[:, [col]].copy(),
-                        num_dp_values=self.num_dp_values)
-            self.list_of_scans.append(scan)
+        self._conc_buffer = _grow(self.conc)
+        self._conc_filtered_buffer = _grow(self.conc_filtered)
+        self._sel_good_buffer = _grow(self.sel_good)
 
     def get_num_scans(self) -> int:
         """
         Simple helper function to obtain the number of scans in this run
         """
-        if self.df is not None:
-            return self.df.shape[1]
+        if self.conc is not None:
+            return self.conc.shape[0]
         else:
             return 0
 
@@ -64,7 +247,7 @@ class Scans:
         """
         This retrieves one scan, based on the scan number
 
-        :param scan_index: The column of the scan in the data frame. NOTE: this is not likely the
+        :param scan_index: The row of the scan in the concentration matrix. NOTE: this is not likely the
         same as the recorded scan number. Usually, it'll be one off (i.e. we start
         with 0. They start with 1.)
 
@@ -72,3 +255,134 @@ class Scans:
         """
         return self.list_of_scans[scan_index]
 
+    def invert_all(self, kernel: InversionKernel, method: str = DEFAULT_INVERSION_METHOD,
+                   scan_indices: np.ndarray = None) -> InversionResult:
+        """
+        Invert every scan in the run (or the ones in scan_indices) to its growth factor distribution
+        (see Scan.invert). They are solved as one batch, sharing the kernel's factorization, so the
+        scans should all have the flows the kernel was built for.
+
+        :param kernel: the InversionKernel of the scans (see inversion.get_run_inversion_kernel)
+        :param method: "twomey" or "nnls"
+        :param scan_indices: [Optional] the scans to invert. Defaults to all of them
+        :return: an InversionResult with the scans in the order given
+        """
+        if scan_indices is None:
+            scan_indices = np.arange(self.get_num_scans())
+        scan_indices = np.asarray(scan_indices, dtype=np.intp)
+        return kernel.invert(self.conc_filtered[scan_indices], method, scan_index=scan_indices)
+
+    def fit_all(self, num_peaks_desired: int, workers: int = None, chunk_size: int = None,
+                progress_callback=None, cancel_event=None, warm_start: bool = False,
+                cache: FitCache = None, first_scan_index: int = 0, auto_max_peaks: int = AUTO_MAX_PEAKS,
+                criterion: str = DEFAULT_AUTO_CRITERION) -> FitResultSet:
+        """
+        Fit every scan in the run (or every scan from first_scan_index on), spreading the scans over a pool of worker processes.
+        The results are also stored on each Scan object, just as if Scan.fit had been
+        called on it.
+
+        :param num_peaks_desired: the number of peaks to fit in every scan, or None to pick the number
+                                  of peaks for each scan on its own (see Scan.fit_auto)
+        :param workers: the number of worker processes. Defaults to the number of CPUs.
+                        With 1 worker, the scans are fitted in this process
+        :param chunk_size: the number of scans handed to a worker at a time. Defaults to
+                           splitting the run into CHUNKS_PER_WORKER chunks per worker
+        :param progress_callback: [Optional] called as progress_callback(num_done, num_to_fit)
+                                  each time a chunk of scans is finished
+        :param cancel_event: [Optional] a threading.Event. If it gets set, no more chunks are
+                             started. The chunks already being fitted are finished, and all of the
+                             results fitted so far are returned
+        :param warm_start: [Optional, default=False] fit the scans of each chunk in order, starting
+                           each one from the previous scan's fit. A scan is only fitted from scratch
+                           if the warm started fit is noticeably worse. Best used with large chunks
+                           on long, steady runs
+        :param cache: [Optional] a FitCache. Scans that were fitted before (from scratch, with the same
+                      number of peaks) are looked up instead of fitted, and new fits from scratch are
+                      stored. Each worker process opens its own connection to it
+        :param first_scan_index: [Optional, default=0] only fit the scans from this one on (e.g. the
+                                 scans just added with append_run_data). The earlier scans are left
+                                 as they are, and have no results in the returned FitResultSet
+        :param auto_max_peaks: [Optional] the most peaks to try, if num_peaks_desired is None
+        :param criterion: [Optional] "aic" or "bic", to pick the number of peaks with if num_peaks_desired is None
+        :return: a FitResultSet with the results in scan order
+        """
+        if num_peaks_desired is not None and num_peaks_desired > MAX_PEAKS_TO_FIT:
+            raise ValueError("fit_all - num_peaks_desired = {} exceeds max allowed {}".format(num_peaks_desired, MAX_PEAKS_TO_FIT))
+
+        num_scans = self.get_num_scans()
+        if first_scan_index < 0 or first_scan_index > num_scans:
+            raise ValueError("fit_all - first_scan_index = {} is out of range".format(first_scan_index))
+        num_to_fit = num_scans - first_scan_index
+        result_set = FitResultSet(num_scans, num_peaks_desired)
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if chunk_size is None:
+            chunk_size = max(1, math.ceil(num_to_fit / (workers * CHUNKS_PER_WORKER)))
+        chunks = [(start, min(start + chunk_size, num_scans))
+                  for start in range(first_scan_index, num_scans, chunk_size)]
+
+        num_done = 0
+
+        def _is_cancelled():
+            return cancel_event is not None and cancel_event.is_set()
+
+        def _store_chunk_results(chunk_results):
+            nonlocal num_done
+            for (scan_index, num_peaks_predicted, peak_fit_results, total_fit_result, was_warm_started, error) in chunk_results:
+                if error is None:
+                    result_set.set_scan_result(scan_index, num_peaks_predicted, peak_fit_results, total_fit_result,
+                                               was_warm_started)
+                    scan = self.list_of_scans[scan_index]
+                    scan.num_peaks_predicted = num_peaks_predicted
+                    scan.peak_fit_results = peak_fit_results
+                    scan.total_fit_result = total_fit_result
+                else:
+                    result_set.set_scan_error(scan_index, error)
+            num_done += len(chunk_results)
+            if progress_callback:
+                progress_callback(num_done, num_to_fit)
+
+        def _chunk_args(chunk):
+            (start, end) = chunk
+            return (start, self.conc[start:end], self.dp_range, self.log_dp_range, num_peaks_desired, warm_start,
+                    cache, auto_max_peaks, criterion)
+
+        # No need for the overhead of a pool with only one worker
+        if workers == 1:
+            for chunk in chunks:
+                if _is_cancelled():
+                    result_set.is_cancelled = True
+                    break
+                _store_chunk_results(_fit_scan_chunk(*_chunk_args(chunk)))
+            return result_set
+
+        executor = ProcessPoolExecutor(max_workers=workers)
+        try:
+            pending = set()
+            i_next_chunk = 0
+            while i_next_chunk < len(chunks) or pending:
+                # Only keep a couple of chunks queued per worker, so a cancel takes effect quickly
+                while i_next_chunk < len(chunks) and len(pending) < workers * 2 and not _is_cancelled():
+                    pending.add(executor.submit(_fit_scan_chunk, *_chunk_args(chunks[i_next_chunk])))
+                    i_next_chunk += 1
+
+                if _is_cancelled():
+                    result_set.is_cancelled = True
+                    # Drop the chunks no worker has picked up yet. The others still get fitted
+                    for future in pending:
+                        future.cancel()
+                    break
+
+                done, pending = wait(pending, timeout=CANCEL_POLL_SEC, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _store_chunk_results(future.result())
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        # After a cancel, keep the chunks that were already being fitted
+        for future in pending:
+            if not future.cancelled():
+                _store_chunk_results(future.result())
+        return result_set
+
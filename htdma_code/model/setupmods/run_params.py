@@ -15,6 +15,8 @@ class RunParams:
         * temp_k
         * pres_kPa
         * rh
+        * is_charge_corrected - True if the instrument already corrected the scans for multiply
+                                charged particles (its "Multiple Charge Correction" setting)
 
     """
     def __init__(self,
@@ -23,13 +25,15 @@ class RunParams:
                  mean_free_path_m=0.0,
                  temp_k=20+273.15,
                  pres_kPa=101.3,
-                 rh=DEFAULT_DMA2_RH):
+                 rh=DEFAULT_DMA2_RH,
+                 is_charge_corrected=False):
         self.mu_gas_viscosity_Pa_sec = mu_gas_viscosity_Pa_sec
         self.gas_density = gas_density
         self.mean_free_path_m = mean_free_path_m
         self.temp_k = temp_k
         self.pres_kPa = pres_kPa
         self.rh = rh
+        self.is_charge_corrected = is_charge_corrected
         if mu_gas_viscosity_Pa_sec == 0.0 or gas_density == 0.0 or mean_free_path_m == 0.0:
             self._is_initialized_ = False
         else:
@@ -61,4 +65,5 @@ class RunParams:
             s += "  temp (K): {}\n".format(self.temp_k)
             s += "  pres (kPa): {}\n".format(self.pres_kPa)
             s += "  rh (%): {}\n".format(self.rh)
+            s += "  charge corrected: {}\n".format(self.is_charge_corrected)
         return s
@@ -1,12 +1,11 @@
 
 import numpy as np
-import pandas as pd
 
-from htdma_code.model.files.read_file_utils import extract_scan_params
+from htdma_code.model.files.read_file_utils import extract_scan_params, DATA_FILE_VERSION_1
 
 class ScanParams:
 
-    def __init__(self, df: pd.DataFrame, scan_index: int) -> None:
+    def __init__(self, df, scan_index: int, data_file_version: int = DATA_FILE_VERSION_1) -> None:
         """
         Constructor for a ScanParams. It takes a single columb from the time stamp
         right through the end of the column and extracts out all of the parameters
@@ -14,13 +13,14 @@ class ScanParams:
 
         :param df: A pandas DataFrame representing all scans from a given run
         :param scan_index: An integer index value used to select the scan of interest
+        :param data_file_version: The version of the file the scans were read from
         """
 
         self.scan_id_from_data = int(df.columns[scan_index])
         self.time_stamp = df.iat[0,scan_index]
 
         # Extract out the other parameters
-        d_params = extract_scan_params(df,scan_num=scan_index)
+        d_params = extract_scan_params(df,scan_num=scan_index,data_file_version=data_file_version)
 
         # Store them from the returned dictionary
         self.scan_up_time = d_params["SCAN_UP_TIME"]
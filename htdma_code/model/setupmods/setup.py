@@ -1,8 +1,10 @@
 
 import os
-import pandas as pd
+import numpy as np
 
 import htdma_code.model.files.read_file_utils as read_file_utils
+import htdma_code.model.files.run_cache as run_cache
+from htdma_code.model.files.run_data import RunData
 from htdma_code.model.setupmods.dma_params import DMAParams
 from htdma_code.model.setupmods.run_params import RunParams
 from htdma_code.model.setupmods.scan_params import ScanParams
@@ -19,7 +21,10 @@ class Setup:
         self.dma_1_params: DMAParams = None
         self.run_params: RunParams = None
         self.num_dp_values: int = 0
-        self.df_raw_scan_data:pd.DataFrame = None
+        self.df_raw_scan_data = None
+        self.data_file_version: int = None
+        # The flows of every scan, see read_file_utils.get_scan_flows
+        self.scan_flows: np.ndarray = None
 
         # Individual scan selected parameters
         self.scan_params: ScanParams = None
@@ -30,22 +35,38 @@ class Setup:
                repr(self.run_params) + \
                repr(self.scan_params)
 
-    def read_file(self, filename: str) -> None:
+    def read_file(self, filename: str, use_cache: bool = True) -> None:
         """
         Read in the data from the specified file
 
         :param filename: a string representing the file to read in. Must be in a
                          readable text format
+        :param use_cache: True to read (and write) the binary sidecar of the file (see run_cache)
+        """
+
+        if use_cache:
+            self.read_run_data(run_cache.read_run_file_cached(filename))
+        else:
+            self.read_run_data(read_file_utils.read_run_file(filename))
+
+    def read_run_data(self, run_data: RunData) -> None:
+        """
+        Set up everything from a run that has already been read in
+
+        :param run_data: a RunData object returned by read_file_utils.read_run_file
         """
 
         # Get the name of the run
-        self.basefilename = os.path.basename(filename)
+        self.basefilename = os.path.basename(run_data.filename)
 
-        # read in the general setup info for the run
-        dict_setup_info = read_file_utils.read_setup(filename)
+        # The general setup info for the run
+        dict_setup_info = run_data.setup
 
-        # Read in the scan data
-        (self.df_raw_scan_data, self.num_dp_values) = read_file_utils.read_scans_into_dataframe(filename)
+        # The scan data
+        self.df_raw_scan_data = run_data.to_dataframe()
+        self.scan_flows = read_file_utils.get_scan_flows(run_data)
+        self.num_dp_values = run_data.get_num_dp_values()
+        self.data_file_version = run_data.data_file_version
 
         self.dma_1_params = DMAParams(length_cm=dict_setup_info["DMA_1_LENGTH_CM"],
                                       radius_in_cm=dict_setup_info["DMA_1_RADIUS_IN_CM"],
@@ -57,13 +78,25 @@ class Setup:
                                    gas_density=dict_setup_info["GAS_DENSITY"],
                                    mean_free_path_m=dict_setup_info["MEAN_FREE_PATH_M"],
                                    temp_k=dict_setup_info["REF_TEMP_K"],
-                                   pres_kPa=dict_setup_info["REF_PRES_kPa"]
+                                   pres_kPa=dict_setup_info["REF_PRES_kPa"],
+                                   is_charge_corrected=dict_setup_info.get("MULT_CHARGE_CORRECTION", False)
                                    )
 
         # Always reset the current scan index back to 0 if we're reading in a new file
         self._current_scan_index = 0
         self.scan_params = ScanParams(self.df_raw_scan_data,
-                                      self._current_scan_index)
+                                      self._current_scan_index,
+                                      self.data_file_version)
+
+    def append_run_data(self, run_data: RunData) -> None:
+        """
+        Add the raw scan data of more scans of the same run (e.g. from RunFileTail.poll)
+
+        :param run_data: a RunData with the new scans
+        """
+        import pandas as pd
+        self.df_raw_scan_data = pd.concat([self.df_raw_scan_data, run_data.to_dataframe()], axis=1)
+        self.scan_flows = np.concatenate([self.scan_flows, read_file_utils.get_scan_flows(run_data)])
 
     def update_scan_params(self,new_scan_index):
         """
@@ -72,4 +105,4 @@ class Setup:
         :param new_scan_index: Index
         """
         self._current_scan_index = new_scan_index
-        self.scan_params = ScanParams(self.df_raw_scan_data, self._current_scan_index)
+        self.scan_params = ScanParams(self.df_raw_scan_data, self._current_scan_index, self.data_file_version)
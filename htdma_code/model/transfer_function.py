@@ -0,0 +1,302 @@
+"""
+transfer_function - the transfer function of a cylindrical DMA
+
+The transfer function Omega(Z) of a DMA is the fraction of the particles of mobility Z
+entering with the aerosol flow that leave with the sample flow. Without diffusion it is the
+trapezoid of Knutson and Whitby (1975, https://doi.org/10.1016/0021-8502(75)90060-9), in
+terms of the mobility relative to the centroid mobility Z* the DMA is set to, zeta = Z / Z*:
+
+    Omega(zeta) = 1 / (2 beta (1 - delta)) * (|zeta - (1 + beta)| + |zeta - (1 - beta)|
+                                              - |zeta - (1 + beta delta)| - |zeta - (1 - beta delta)|)
+
+with beta = (Qa + Qs) / (Qsh + Qm) and delta = (Qs - Qa) / (Qs + Qa), where Qa, Qs, Qsh and Qm
+are the aerosol in, sample (aerosol out), sheath and excess flows. With balanced flows
+(delta = 0) it is the triangle from 1 - beta to 1 + beta.
+
+Small particles also diffuse while they cross the DMA, which smears the trapezoid out. Following
+Stolzenburg (1988), the diffusing transfer function replaces each |x| above by
+sqrt(2) sigma eps(x / (sqrt(2) sigma)), with eps(x) = x erf(x) + exp(-x^2) / sqrt(pi). sigma,
+the spread in zeta, is
+
+    sigma^2 = G kT / (n e V),   G = 2 ln(R2 / R1) (R2^2 + R1^2) / (R2^2 - R1^2) + ln(R2 / R1) (R2^2 - R1^2) / L^2
+
+for n charges at voltage V. G is for plug flow through the annulus (the first term is the radial
+diffusion, the second the axial). It does not depend on the flows, and for TSI 3081 sized
+columns is about 2.3, so diffusion matters below a few hundred volts.
+
+TransferKernel evaluates the transfer function of a whole set of voltages (e.g. every channel
+of a scan) on a dp grid at once, averaged over each dp bin, so distributions on that grid can
+be convolved with it by a matrix product. get_transfer_kernel caches them.
+"""
+import math
+from functools import lru_cache
+
+import numpy as np
+from scipy.special import erf
+
+from htdma_code.model.mobility import get_mobility_table
+
+# Physical constants (SI units)
+ELEMENTARY_CHARGE_C = 1.602176634e-19
+BOLTZMANN_J_PER_K = 1.380649e-23
+
+# Number of points each dp bin is averaged over
+NUM_BIN_POINTS = 8
+
+# Number of kernels (i.e. different dp grids / voltages / flows / gas conditions) kept around
+MAX_CACHED_KERNELS = 32
+
+
+def lpm_to_cm3_per_sec(lpm):
+    """
+    Convert liters per minute to cubic cm per second
+
+    :param lpm: A flow specified in liters per minute
+    :return: The same flow in cubic cm per second
+    """
+    return lpm * 1000 / 60
+
+
+def flow_parameters(q_sh_lpm: float, q_aIn_lpm: float, q_aOut_lpm: float, q_excess_lpm: float) -> tuple:
+    """
+    :param q_sh_lpm: the sheath flow
+    :param q_aIn_lpm: the aerosol (polydisperse) flow in
+    :param q_aOut_lpm: the sample (monodisperse) flow out
+    :param q_excess_lpm: the excess flow
+    :return: (beta, delta) of the transfer function
+    """
+    if q_sh_lpm + q_excess_lpm <= 0 or q_aIn_lpm + q_aOut_lpm <= 0:
+        raise ValueError("flow_parameters - the sheath and aerosol flows must be > 0")
+    beta = (q_aIn_lpm + q_aOut_lpm) / (q_sh_lpm + q_excess_lpm)
+    delta = (q_aOut_lpm - q_aIn_lpm) / (q_aOut_lpm + q_aIn_lpm)
+    return beta, delta
+
+
+def centroid_mobility(voltage, q_sh_lpm: float, q_excess_lpm: float, length_cm: float,
+                      radius_in_cm: float, radius_out_cm: float):
+    """
+    The centroid mobility Z* of a cylindrical DMA
+
+    :param voltage: the voltage(s), a float or a numpy array
+    :param q_sh_lpm: the sheath flow
+    :param q_excess_lpm: the excess flow
+    :param length_cm: the length of the DMA
+    :param radius_in_cm: the radius of the inner electrode
+    :param radius_out_cm: the radius of the outer electrode
+    :return: Z* in cm^2 / (V s), the same shape as voltage
+    """
+    return lpm_to_cm3_per_sec(q_sh_lpm + q_excess_lpm) * np.log(radius_out_cm / radius_in_cm) / \
+        (4 * math.pi * length_cm * np.asarray(voltage, dtype=float))
+
+
+def voltage_for_mobility(zp, q_sh_lpm: float, q_excess_lpm: float, length_cm: float,
+                         radius_in_cm: float, radius_out_cm: float):
+    """
+    The voltage that sets a cylindrical DMA's centroid mobility to zp. Z* V is a constant, so this
+    is the same formula as centroid_mobility
+
+    :return: the voltage(s), the same shape as zp
+    """
+    return centroid_mobility(zp, q_sh_lpm, q_excess_lpm, length_cm, radius_in_cm, radius_out_cm)
+
+
+def diffusion_sigma(voltage, temp_k: float, length_cm: float, radius_in_cm: float, radius_out_cm: float,
+                    n_ch: int = 1):
+    """
+    The spread in zeta from diffusion (see the top of this file)
+
+    :param voltage: the voltage(s), a float or a numpy array
+    :param temp_k: the temperature (K)
+    :param length_cm: the length of the DMA
+    :param radius_in_cm: the radius of the inner electrode
+    :param radius_out_cm: the radius of the outer electrode
+    :param n_ch: the number of charges on the particles
+    :return: sigma, the same shape as voltage
+    """
+    log_ratio = np.log(radius_out_cm / radius_in_cm)
+    (r_in_2, r_out_2) = (radius_in_cm ** 2, radius_out_cm ** 2)
+    g = 2 * log_ratio * (r_out_2 + r_in_2) / (r_out_2 - r_in_2) + log_ratio * (r_out_2 - r_in_2) / length_cm ** 2
+    kt_over_e = BOLTZMANN_J_PER_K * temp_k / ELEMENTARY_CHARGE_C
+    return np.sqrt(g * kt_over_e / (n_ch * np.abs(np.asarray(voltage, dtype=float))))
+
+
+def nondiffusing_transfer(zeta, beta: float, delta: float = 0.0):
+    """
+    The transfer function without diffusion (see the top of this file)
+
+    :param zeta: the particle mobility relative to the centroid mobility, a float or a numpy array
+    :param beta: the flow ratio (see flow_parameters)
+    :param delta: the flow imbalance (see flow_parameters), 0 for balanced flows
+    :return: Omega, the same shape as zeta. 0 outside of 1 - beta < zeta < 1 + beta
+    """
+    zeta = np.asarray(zeta, dtype=float)
+    omega = (np.abs(zeta - (1 + beta)) + np.abs(zeta - (1 - beta))
+             - np.abs(zeta - (1 + beta * delta)) - np.abs(zeta - (1 - beta * delta))) / (2 * beta * (1 - delta))
+    return np.maximum(omega, 0.0)
+
+
+def diffusing_transfer(zeta, beta: float, delta: float, sigma):
+    """
+    The transfer function with diffusion (see the top of this file). It tends to
+    nondiffusing_transfer as sigma goes to 0
+
+    :param zeta: the particle mobility relative to the centroid mobility, a float or a numpy array
+    :param beta: the flow ratio (see flow_parameters)
+    :param delta: the flow imbalance (see flow_parameters)
+    :param sigma: the spread from diffusion (see diffusion_sigma), broadcast against zeta
+    :return: Omega, the same shape as zeta broadcast against sigma
+    """
+    zeta = np.asarray(zeta, dtype=float)
+    scale = np.sqrt(2) * np.asarray(sigma, dtype=float)
+
+    def _eps(x):
+        x = x / scale
+        return scale * (x * erf(x) + np.exp(-x ** 2) / np.sqrt(np.pi))
+
+    omega = (_eps(zeta - (1 + beta)) + _eps(zeta - (1 - beta))
+             - _eps(zeta - (1 + beta * delta)) - _eps(zeta - (1 - beta * delta))) / (2 * beta * (1 - delta))
+    return np.maximum(omega, 0.0)
+
+
+def log_bin_edges(dp_range: np.ndarray) -> np.ndarray:
+    """
+    :param dp_range: the dp grid (nm), increasing
+    :return: the log of the edges of the dp bin around each grid point, halfway (in log dp)
+             to its neighbours. One more than there are grid points
+    """
+    log_dp = np.log(np.asarray(dp_range, dtype=float))
+    mid = (log_dp[1:] + log_dp[:-1]) / 2
+    return np.concatenate(([2 * log_dp[0] - mid[0]], mid, [2 * log_dp[-1] - mid[-1]]))
+
+
+class TransferKernel:
+    """
+    TransferKernel holds the transfer function of a DMA at a set of voltages, on a dp grid
+
+    Attributes:
+        * dp_range - the dp grid (nm), increasing
+        * log_dp_widths - the width in log dp of the bin around each grid point
+        * voltages - the voltages of the DMA
+        * zp_centers - the centroid mobility at each voltage
+        * n_ch - the number of charges on the particles
+        * is_diffusing - True if diffusion is included
+        * values - the transfer function averaged over each dp bin, shape (n_voltages, n_dp)
+    """
+    def __init__(self, dp_range: np.ndarray, voltages: np.ndarray, q_sh_lpm: float, q_aIn_lpm: float,
+                 q_aOut_lpm: float, q_excess_lpm: float, length_cm: float, radius_in_cm: float,
+                 radius_out_cm: float, mean_free_path_nm: float, mu_gas_viscosity_poise: float, temp_k: float,
+                 n_ch: int = 1, is_diffusing: bool = True):
+        """
+        :param dp_range: the dp grid (nm), increasing
+        :param voltages: the voltages of the DMA, e.g. one per channel of a scan (see channel_voltages)
+        :param q_sh_lpm: the sheath flow
+        :param q_aIn_lpm: the aerosol flow in
+        :param q_aOut_lpm: the sample flow out
+        :param q_excess_lpm: the excess flow
+        :param length_cm: the length of the DMA
+        :param radius_in_cm: the radius of the inner electrode
+        :param radius_out_cm: the radius of the outer electrode
+        :param mean_free_path_nm: mean free path of the gas in nanometers
+        :param mu_gas_viscosity_poise: gas viscosity in Poise
+        :param temp_k: the temperature (K)
+        :param n_ch: the number of charges on the particles
+        :param is_diffusing: True to include diffusion
+        """
+        dp_range = np.asarray(dp_range, dtype=float)
+        if dp_range.ndim != 1 or dp_range.shape[0] < 2 or np.any(np.diff(dp_range) <= 0):
+            raise ValueError("TransferKernel: the dp values must be increasing")
+        voltages = np.atleast_1d(np.asarray(voltages, dtype=float))
+        if np.any(voltages <= 0):
+            raise ValueError("TransferKernel: the voltages must be > 0")
+        self.dp_range = dp_range
+        self.voltages = voltages
+        self.n_ch = n_ch
+        self.is_diffusing = is_diffusing
+        self.zp_centers = centroid_mobility(voltages, q_sh_lpm, q_excess_lpm, length_cm, radius_in_cm,
+                                            radius_out_cm)
+
+        edges = log_bin_edges(dp_range)
+        self.log_dp_widths = np.diff(edges)
+
+        # NUM_BIN_POINTS evenly spaced points in the middle of each slice of each bin
+        offsets = (np.arange(NUM_BIN_POINTS) + 0.5) / NUM_BIN_POINTS
+        log_dp_points = edges[:-1, np.newaxis] + self.log_dp_widths[:, np.newaxis] * offsets[np.newaxis, :]
+        zp_points = get_mobility_table(mean_free_path_nm, mu_gas_viscosity_poise, n_ch).Dp_to_Zp(
+            np.exp(log_dp_points))
+
+        (beta, delta) = flow_parameters(q_sh_lpm, q_aIn_lpm, q_aOut_lpm, q_excess_lpm)
+        zeta = zp_points[np.newaxis, :, :] / self.zp_centers[:, np.newaxis, np.newaxis]
+        if is_diffusing:
+            sigma = diffusion_sigma(voltages, temp_k, length_cm, radius_in_cm, radius_out_cm, n_ch)
+            omega = diffusing_transfer(zeta, beta, delta, sigma[:, np.newaxis, np.newaxis])
+        else:
+            omega = nondiffusing_transfer(zeta, beta, delta)
+        self.values = omega.mean(axis=2)
+
+    def __repr__(self):
+        s = "TransferKernel:\n"
+        s += "  dp: {:.1f} - {:.1f} nm ({} points)\n".format(self.dp_range[0], self.dp_range[-1],
+                                                           self.dp_range.shape[0])
+        s += "  voltages: {:.1f} - {:.1f} V ({})\n".format(self.voltages.min(), self.voltages.max(),
+                                                         self.voltages.shape[0])
+        s += "  charges: {}, diffusing: {}\n".format(self.n_ch, self.is_diffusing)
+        return s
+
+    def convolve(self, distribution: np.ndarray) -> np.ndarray:
+        """
+        The DMA's output at each voltage for a distribution (dN/dlogDp) on the dp grid
+
+        :param distribution: one distribution, or a (n_distributions, n_dp) matrix of them
+        :return: the concentration passed at each voltage, shape (n_voltages,) or (n_distributions, n_voltages)
+        """
+        distribution = np.asarray(distribution, dtype=float)
+        if distribution.shape[-1] != self.dp_range.shape[0]:
+            raise ValueError("TransferKernel.convolve - expected {} dp values, got {}".format(
+                self.dp_range.shape[0], distribution.shape[-1]))
+        return (distribution * self.log_dp_widths) @ self.values.T
+
+
+def channel_voltages(dp_range: np.ndarray, q_sh_lpm: float, q_excess_lpm: float, length_cm: float,
+                     radius_in_cm: float, radius_out_cm: float, mean_free_path_nm: float,
+                     mu_gas_viscosity_poise: float) -> np.ndarray:
+    """
+    The voltage of each channel of a scan, i.e. the voltage where the DMA's centroid is a singly
+    charged particle of each dp
+
+    :return: the voltages, the same shape as dp_range
+    """
+    zp = get_mobility_table(mean_free_path_nm, mu_gas_viscosity_poise, 1).Dp_to_Zp(np.asarray(dp_range, dtype=float))
+    return voltage_for_mobility(zp, q_sh_lpm, q_excess_lpm, length_cm, radius_in_cm, radius_out_cm)
+
+
+@lru_cache(maxsize=MAX_CACHED_KERNELS)
+def _get_transfer_kernel(dp_range: tuple, voltages: tuple, flows: tuple, geometry: tuple, mean_free_path_nm: float,
+                         mu_gas_viscosity_poise: float, temp_k: float, n_ch: int,
+                         is_diffusing: bool) -> TransferKernel:
+    """
+    INTERNAL FUNCTION -
+    The cached part of get_transfer_kernel. The arrays are tuples, so they can be hashed
+    """
+    return TransferKernel(np.array(dp_range), np.array(voltages), *flows, *geometry, mean_free_path_nm,
+                          mu_gas_viscosity_poise, temp_k, n_ch=n_ch, is_diffusing=is_diffusing)
+
+
+def get_transfer_kernel(dp_range: np.ndarray, voltages: np.ndarray, q_sh_lpm: float, q_aIn_lpm: float,
+                        q_aOut_lpm: float, q_excess_lpm: float, length_cm: float, radius_in_cm: float,
+                        radius_out_cm: float, mean_free_path_nm: float, mu_gas_viscosity_poise: float,
+                        temp_k: float, n_ch: int = 1, is_diffusing: bool = True) -> TransferKernel:
+    """
+    Get the TransferKernel for a dp grid, set of voltages, flows, DMA and gas conditions. Kernels
+    are only built the first time they are asked for, and the most recently used
+    MAX_CACHED_KERNELS are kept (across runs).
+
+    See TransferKernel for the arguments.
+
+    :return: the TransferKernel
+    """
+    flows = (float(q_sh_lpm), float(q_aIn_lpm), float(q_aOut_lpm), float(q_excess_lpm))
+    geometry = (float(length_cm), float(radius_in_cm), float(radius_out_cm))
+    return _get_transfer_kernel(tuple(np.asarray(dp_range, dtype=float).tolist()),
+                                tuple(np.atleast_1d(np.asarray(voltages, dtype=float)).tolist()), flows, geometry,
+                                float(mean_free_path_nm), float(mu_gas_viscosity_poise), float(temp_k), int(n_ch),
+                                bool(is_diffusing))
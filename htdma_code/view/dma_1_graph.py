@@ -11,6 +11,7 @@ mpl.use('Qt5Agg')
 #from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg
 from htdma_code.model.model import Model
+from htdma_code.view.plot_utils import plot_dma_1
 
 class DMA_1_Graph_Widget(FigureCanvasQTAgg):
 
@@ -32,7 +33,7 @@ class DMA_1_Graph_Widget(FigureCanvasQTAgg):
 
         # Update it from the model, as long as we have a complete model!
         if self.model.dma1:
-            self.model.dma1.plot(self.axes)
+            plot_dma_1(self.model.dma1, self.axes)
 
         # TODO - Not sure which if any of these draw methods are needed
         # self.draw_idle()
@@ -17,6 +17,7 @@ import htdma_code.model.model as model_pkg
 from htdma_code.view.dma_1_center_widget import DMA_1_Center_Frame
 from htdma_code.view.dma_1_dock_form import DMA_1_Form
 from htdma_code.view.results_center_widget import Total_Results_Center_Frame
+from htdma_code.view.results_table import ResultsTableModel
 from htdma_code.view.scan_dock_form import Scan_Form
 from htdma_code.view.scan_center_widget import Scan_Data_Center_Frame
 
@@ -45,6 +46,10 @@ class MainWindow(QMainWindow):
         dockWidget.setFloating(False)
         self.addDockWidget(Qt.LeftDockWidgetArea,dockWidget)
 
+        # The Qt adapter for the model's results table. The controller adds rows through it
+        # (so views are notified) and points it at the new rows whenever a file is read in
+        self.results_table_model = ResultsTableModel(self.model.total_results)
+
         self.update_center_widget()
 
     def create_tab_widget_for_dock(self) -> QTabWidget:
@@ -103,5 +108,6 @@ class MainWindow(QMainWindow):
             self.scan_data_center = Scan_Data_Center_Frame(parent=self, model=self.model)
             self.setCentralWidget(self.scan_data_center)
         elif self.docker_tabs.currentIndex() == 2:
-            self.results_data_center = Total_Results_Center_Frame(parent=self,model=self.model)
+            self.results_data_center = Total_Results_Center_Frame(parent=self,model=self.model,
+                                                                  table_model=self.results_table_model)
             self.setCentralWidget(self.results_data_center)
@@ -1,8 +1,10 @@
 import numpy as np
 import matplotlib as mpl
 from matplotlib import pyplot as plt
+from matplotlib.ticker import FormatStrFormatter
 
 from htdma_code.model.scan import Scan, _1gaussian, predict_peaks
+from htdma_code.model.dma1 import DMA_1
 
 
 def plot_scan_and_residuals(scan: Scan,
@@ -52,7 +54,7 @@ def plot_scan_and_residuals(scan: Scan,
         # Let's separate the peaks
         for peak in peak_fit_results:
             gauss_fit = _1gaussian(scan.get_log_dp_range(), *peak.fit_params)
-            color = "gbmcy"[peak.index]
+            color = "gbmcy"[peak.index % 5]
             ax_data.plot(xdata,gauss_fit,color)
 
         sel = scan._y_sel_good
@@ -81,3 +83,44 @@ def plot_scan_and_residuals(scan: Scan,
     #
     # return fig, ax
 
+
+def plot_dma_1(dma1: DMA_1, ax: plt.Axes):
+    """
+    Create the theoretical distribution plot for DMA 1
+
+    :param dma1: The DMA_1 to plot
+    :param ax: The Axes object to plot on
+
+    """
+
+    ax.set_xscale('log')
+    if dma1.dp_dist_center:
+        x_min = dma1.dp_dist_center // 100 * 100 - 100
+        if x_min <= 0:
+            x_min = 5
+        x_max = dma1.dp_dist_center // 100 * 100 + 200
+    else:
+        # Default values if dp has not been calculated
+        x_min = 300
+        x_max = 1000
+
+    if x_min > 300:
+        x_min = 300
+
+    if x_min >= 100:
+        x_ticks = 100
+    else:
+        x_ticks = 10
+
+    ax.set_xlim(x_min, x_max)
+    ax.set_xticks(np.arange(x_min, x_max, x_ticks))
+    ax.xaxis.set_major_formatter(FormatStrFormatter('%.0f'))
+
+    # TODO - Set "Dp" for x axis echo_label
+    ax.set_ylim(0, 1.05)
+    ax.set_title("DMA 1 theoretical distribution")
+    if dma1.dp_dist is not None:
+        # The transfer function with diffusion, and the triangle it would be without
+        ax.plot(dma1.dp_dist, dma1.transfer_dist)
+        ax.plot(dma1.dp_dist, dma1.transfer_dist_nondiffusing, linestyle='--', linewidth=0.8)
+    ax.grid(True)
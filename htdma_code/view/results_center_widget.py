@@ -2,16 +2,19 @@ import PySide2.QtWidgets as Qw
 from PySide2.QtWidgets import QFrame, QTableView
 
 from htdma_code.model.model import Model
+from htdma_code.view.results_table import ResultsTableModel
 
 
 class Total_Results_Center_Frame(QFrame):
-    def __init__(self, parent, model: Model):
+    def __init__(self, parent, model: Model, table_model: ResultsTableModel):
         super().__init__(parent)
 
         self.model = model
 
+        # The adapter outlives this frame (it is rebuilt on every tab change), so it is shared
+        self.total_results_table_model = table_model
         self.total_results_table = QTableView()
-        self.total_results_table.setModel(self.model.total_results_table)
+        self.total_results_table.setModel(self.total_results_table_model)
 
         layout = Qw.QVBoxLayout()
         layout.addWidget(self.total_results_table)
@@ -0,0 +1,132 @@
+"""
+ResultsTableModel - This is entirely based on some code found at:
+
+https://www.pythonguis.com/tutorials/qtableview-modelviews-numpy-pandas/
+
+When subclassing QAbstractTableModel , you must implement:
+ * rowCount()
+ * columnCount()
+ * data() .
+ Default implementations of the index() and parent() functions are provided by QAbstractTableModel .
+ Well behaved models will also implement headerData() .
+"""
+
+from PySide2.QtCore import QAbstractTableModel, QModelIndex, Qt
+
+import numpy as np
+import pandas as pd
+
+from htdma_code.model.scan import Scan
+from htdma_code.model.fit_result_set import FitResultSet
+from htdma_code.model.result_columns import ResultColumns, COLUMN_NAMES
+
+# When adding a whole batch of fit results, views are told about the new rows
+# in chunks of (at most) this many rows
+INSERT_CHUNK_ROWS = 1000
+
+
+class ResultsTableModel(QAbstractTableModel):
+    """
+    ResultsTableModel is the Qt adapter for the peak fit results. The rows themselves are
+    stored in a ResultColumns in the model (Model.total_results), so adding rows is cheap and
+    painting a cell is a plain numpy lookup. Rows added through this adapter are announced
+    to views with beginInsertRows/endInsertRows, and set_results switches to the rows of another
+    file with beginResetModel/endResetModel.
+
+    Attributes:
+        * results - the ResultColumns holding the rows
+    """
+    def __init__(self, results: ResultColumns = None):
+        """
+        :param results: The rows to show. If None, starts with an empty table
+        """
+        super(ResultsTableModel, self).__init__()
+        self.results = results if results is not None else ResultColumns()
+
+    @property
+    def df(self) -> pd.DataFrame:
+        """
+        The rows as a pandas DataFrame. This is built on demand, see ResultColumns.to_dataframe
+        """
+        return self.results.to_dataframe()
+
+    def data(self, index, role):
+        """
+        REQUIRED - provides the data
+        """
+        if role == Qt.DisplayRole:
+            value = self.results.get_value(index.row(), index.column())
+            if index.column() == 2:
+                return str(np.round(value))
+            if index.column() == 3 or index.column() == 4:
+                return str(np.round(value,decimals=1))
+            return str(value)
+
+    def rowCount(self, index):
+        return self.results.get_num_rows()
+
+    def columnCount(self, index):
+        return self.results.get_num_columns()
+
+    def headerData(self, section, orientation, role):
+        # section is the index of the column/row.
+        if role == Qt.DisplayRole:
+            if orientation == Qt.Horizontal:
+                return COLUMN_NAMES[section]
+
+            if orientation == Qt.Vertical:
+                return str(section)
+
+    def set_results(self, results: ResultColumns):
+        """
+        Show another set of rows (e.g. the Model.total_results of a file just loaded or
+        followed). Views are told to drop everything they showed before.
+
+        :param results: The rows to show from now on
+        """
+        self.beginResetModel()
+        self.results = results
+        self.endResetModel()
+
+    def add_scan_results(self, scan: Scan):
+        if not scan.peak_fit_results:
+            return
+
+        first = self.results.get_num_rows()
+        self.beginInsertRows(QModelIndex(), first, first + len(scan.peak_fit_results) - 1)
+        self.results.add_scan_results(scan)
+        self.endInsertRows()
+
+    def add_fit_result_set(self, fit_result_set: FitResultSet, chunk_rows: int = INSERT_CHUNK_ROWS):
+        """
+        Add the fitted peaks of every scan in a FitResultSet (e.g. from Scans.fit_all).
+        Views are notified once per chunk of rows, rather than once per scan.
+
+        :param fit_result_set: The results to add
+        :param chunk_rows: The (approximate) number of rows added per notification
+        """
+        pending = []
+        num_pending_rows = 0
+        for scan_index, peaks in enumerate(fit_result_set.peak_fit_results):
+            if not peaks:
+                continue
+            pending.append((scan_index, peaks))
+            num_pending_rows += len(peaks)
+            if num_pending_rows >= chunk_rows:
+                self._insert_pending(pending, num_pending_rows)
+                pending = []
+                num_pending_rows = 0
+        self._insert_pending(pending, num_pending_rows)
+
+    def _insert_pending(self, pending, num_pending_rows: int):
+        """
+        Internal helper to add a chunk of (scan_index, peak_fit_results) with a single
+        insert notification
+        """
+        if num_pending_rows == 0:
+            return
+        first = self.results.get_num_rows()
+        self.beginInsertRows(QModelIndex(), first, first + num_pending_rows - 1)
+        for (scan_index, peaks) in pending:
+            self.results.append_peaks(scan_index, peaks)
+        self.endInsertRows()
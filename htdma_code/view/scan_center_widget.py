@@ -1,3 +1,4 @@
+import numpy as np
 from PySide2.QtCore import Qt
 import PySide2.QtWidgets as Qw
 from PySide2.QtWidgets import QFrame, QTableWidget, QTableWidgetItem
@@ -53,5 +54,8 @@ class Scan_Data_Center_Frame(QFrame):
             self.scan_results_table.setItem(i_peak,2,QTableWidgetItem("{:.0f}".format(peak.height)))
             self.scan_results_table.setItem(i_peak,3,QTableWidgetItem("{:.1f}".format(peak.fwhh)))
             self.scan_results_table.setItem(i_peak,4,QTableWidgetItem("{:.1f}".format(peak.sd)))
+            if peak.growth_factor is not None and np.isfinite(peak.growth_factor):
+                self.scan_results_table.setItem(i_peak,5,QTableWidgetItem("{:.3f}".format(peak.growth_factor)))
+                self.scan_results_table.setItem(i_peak,6,QTableWidgetItem("{:.3f}".format(peak.kappa)))
 
 
@@ -44,7 +44,10 @@ class Scan_Form(QFormLayout):
         self.total_conc_label = QLabel()
 
         self.scan_fit_num_peaks_spinbox = Qw.QSpinBox()
-        self.scan_fit_num_peaks_spinbox.setRange(1,MAX_PEAKS_TO_FIT)
+        self.scan_fit_num_peaks_spinbox.setRange(0,MAX_PEAKS_TO_FIT)
+        # 0 means pick the number of peaks automatically (see Scan.fit_auto)
+        self.scan_fit_num_peaks_spinbox.setSpecialValueText("Auto")
+        self.scan_fit_num_peaks_spinbox.setValue(1)
 
         # Create the buttons to step through scans
         self.next_scan_button = Qw.QPushButton("Next")
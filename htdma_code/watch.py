@@ -0,0 +1,625 @@
+"""
+watch - a long running service that fits new AIM exports as they land in a directory
+
+Watches one or more directories (with inotify on Linux, otherwise by polling them). A new
+or changed file is only queued once it has stopped changing for a while, so files are not
+picked up half written. Queued files are fitted by a pool of worker processes, and the peaks
+and a summary of each file go to a ResultsStore. A file that is written again later is
+fitted again, and replaces its old results.
+
+Queue depth, throughput and per-stage latencies are printed every so often, and can be
+written to a JSON file for other tools to pick up.
+
+Usage (from the top of the repo):
+    python -m htdma_code.watch /shared/exports --peaks 2 --store results.sqlite
+"""
+import argparse
+import ctypes
+import ctypes.util
+import fnmatch
+import json
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, List, Set
+
+from htdma_code.batch import process_file, parse_num_peaks, DEFAULT_NUM_PEAKS, AUTO_NUM_PEAKS, \
+    FILES_IN_FLIGHT_PER_WORKER
+from htdma_code.model.scan import MAX_PEAKS_TO_FIT, AUTO_MAX_PEAKS, AUTO_CRITERIA, DEFAULT_AUTO_CRITERION
+from htdma_code.model.fit_cache import FitCache, DEFAULT_CACHE_DIR, FIT_CACHE_FILENAME
+import htdma_code.model.files.run_cache as run_cache
+from htdma_code.model.results_store import ResultsStore
+
+DEFAULT_PATTERN = "*.txt"
+DEFAULT_STORE_FILENAME = os.path.join(DEFAULT_CACHE_DIR, "watch_results.sqlite")
+
+# A file must not change for this long before it is queued (sec)
+DEFAULT_SETTLE_SEC = 5.0
+
+# How often to look at the directories when polling, and at the files waiting to settle (sec)
+DEFAULT_POLL_SEC = 1.0
+
+# How often to report the counters (sec)
+DEFAULT_STATS_INTERVAL_SEC = 60.0
+
+# inotify (see inotify(7)). Only the events that can mean a file was written or moved in
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+INOTIFY_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+INOTIFY_READ_SIZE = 64 * 1024
+
+
+class PollingWatcher:
+    """
+    PollingWatcher finds new and changed files by listing the directories every time it is asked.
+    It works everywhere, including on network shares where inotify sees nothing.
+
+    Attributes:
+        * directories - the directories being watched
+        * pattern - the fnmatch pattern of the files to watch
+    """
+    def __init__(self, directories: List[str], pattern: str = DEFAULT_PATTERN):
+        self.directories = directories
+        self.pattern = pattern
+        self._stats: Dict[str, tuple] = {}
+
+    def __repr__(self):
+        s = "PollingWatcher:\n"
+        s += "  directories: {}\n".format(", ".join(self.directories))
+        s += "  pattern: {}\n".format(self.pattern)
+        return s
+
+    def get_changed_files(self, timeout: float) -> Set[str]:
+        """
+        Wait for timeout, then list the directories
+
+        :return: the files that appeared or changed since the last call (every file, on the first call)
+        """
+        time.sleep(timeout)
+        changed = set()
+        stats = {}
+        for directory in self.directories:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if not entry.is_file() or not fnmatch.fnmatch(entry.name, self.pattern):
+                        continue
+                    stat = entry.stat()
+                    stats[entry.path] = (stat.st_size, stat.st_mtime_ns)
+                    if self._stats.get(entry.path) != stats[entry.path]:
+                        changed.add(entry.path)
+        self._stats = stats
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    InotifyWatcher gets told about new and changed files by the Linux kernel (inotify), through
+    libc, so it needs no extra packages. Use make_watcher, which falls back to a PollingWatcher
+    wherever inotify is not available.
+
+    Attributes:
+        * directories - the directories being watched
+        * pattern - the fnmatch pattern of the files to watch
+    """
+    def __init__(self, directories: List[str], pattern: str = DEFAULT_PATTERN):
+        self.directories = directories
+        self.pattern = pattern
+        self._first_call = True
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._wd_to_directory = {}
+        for directory in directories:
+            wd = libc.inotify_add_watch(self._fd, os.fsencode(directory), INOTIFY_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                os.close(self._fd)
+                raise OSError(errno, "inotify_add_watch failed", directory)
+            self._wd_to_directory[wd] = directory
+
+    def __repr__(self):
+        s = "InotifyWatcher:\n"
+        s += "  directories: {}\n".format(", ".join(self.directories))
+        s += "  pattern: {}\n".format(self.pattern)
+        return s
+
+    def get_changed_files(self, timeout: float) -> Set[str]:
+        """
+        Wait up to timeout for the directories to change
+
+        :return: the files that appeared or changed since the last call (every file, on the first call)
+        """
+        if self._first_call:
+            # Files that were there before we started watching
+            self._first_call = False
+            return PollingWatcher(self.directories, self.pattern).get_changed_files(0)
+
+        changed = set()
+        (readable, _, _) = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return changed
+        while True:
+            try:
+                data = os.read(self._fd, INOTIFY_READ_SIZE)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                (wd, _, _, name_len) = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+                offset += INOTIFY_EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + name_len].rstrip(b"\0"))
+                offset += name_len
+                if wd in self._wd_to_directory and fnmatch.fnmatch(name, self.pattern):
+                    changed.add(os.path.join(self._wd_to_directory[wd], name))
+        return changed
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def make_watcher(directories: List[str], pattern: str = DEFAULT_PATTERN, use_inotify: bool = True):
+    """
+    :return: an InotifyWatcher if use_inotify and inotify works here, otherwise a PollingWatcher
+    """
+    if use_inotify and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(directories, pattern)
+        except (OSError, AttributeError, TypeError):
+            # e.g. no libc found, or out of inotify watches
+            pass
+    return PollingWatcher(directories, pattern)
+
+
+class LatencyCounter:
+    """
+    LatencyCounter keeps simple statistics of how long one stage of the pipeline takes
+
+    Attributes:
+        * count - the number of times measured
+        * total_sec - the total of all the times
+        * max_sec - the longest time
+        * last_sec - the most recent time
+    """
+    def __init__(self):
+        self.count = 0
+        self.total_sec = 0.0
+        self.max_sec = 0.0
+        self.last_sec = 0.0
+
+    def __repr__(self):
+        return "n={} mean={:.3f}s max={:.3f}s".format(self.count, self.get_mean_sec(), self.max_sec)
+
+    def add(self, sec: float):
+        self.count += 1
+        self.total_sec += sec
+        self.max_sec = max(self.max_sec, sec)
+        self.last_sec = sec
+
+    def get_mean_sec(self) -> float:
+        return self.total_sec / self.count if self.count else 0.0
+
+    def to_dict(self) -> dict:
+        return {"count": self.count, "mean_sec": self.get_mean_sec(), "max_sec": self.max_sec,
+                "last_sec": self.last_sec}
+
+
+class WatchStats:
+    """
+    WatchStats holds the counters of a DirectoryWatchService
+
+    Attributes:
+        * started_at - when the service started (unix time)
+        * num_settling - the number of files waiting to stop changing
+        * num_queued - the number of files waiting for a worker
+        * num_running - the number of files being fitted
+        * num_files_done - the number of files fitted and stored
+        * num_files_failed - the number of files that could not be processed
+        * num_scans_done - the number of scans fitted, over all files
+        * latencies - dict of LatencyCounter, one per stage: "settle" (first change seen until
+                      queued), "queue" (queued until handed to a worker), "process" (reading and
+                      fitting the file) and "store" (writing the results)
+    """
+    STAGES = ["settle", "queue", "process", "store"]
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.num_settling = 0
+        self.num_queued = 0
+        self.num_running = 0
+        self.num_files_done = 0
+        self.num_files_failed = 0
+        self.num_scans_done = 0
+        self.latencies = {stage: LatencyCounter() for stage in self.STAGES}
+
+    def __repr__(self):
+        s = "WatchStats:\n"
+        s += "  Queue depth: {} ({} settling, {} queued, {} running)\n".format(
+            self.get_queue_depth(), self.num_settling, self.num_queued, self.num_running)
+        s += "  Done: {} files, {} scans ({} files failed)\n".format(
+            self.num_files_done, self.num_scans_done, self.num_files_failed)
+        s += "  Throughput: {:.2f} scans/sec\n".format(self.get_scans_per_sec())
+        for stage in self.STAGES:
+            s += "  {} latency: {}\n".format(stage, self.latencies[stage])
+        return s
+
+    def get_queue_depth(self) -> int:
+        """
+        :return: the number of files waiting to be processed, or being processed
+        """
+        return self.num_settling + self.num_queued + self.num_running
+
+    def get_scans_per_sec(self) -> float:
+        """
+        :return: the number of scans fitted per second, since the service started
+        """
+        elapsed = time.time() - self.started_at
+        return self.num_scans_done / elapsed if elapsed > 0 else 0.0
+
+    def to_dict(self) -> dict:
+        return {"uptime_sec": time.time() - self.started_at,
+                "queue_depth": self.get_queue_depth(),
+                "num_settling": self.num_settling,
+                "num_queued": self.num_queued,
+                "num_running": self.num_running,
+                "num_files_done": self.num_files_done,
+                "num_files_failed": self.num_files_failed,
+                "num_scans_done": self.num_scans_done,
+                "scans_per_sec": self.get_scans_per_sec(),
+                "latencies": {stage: counter.to_dict() for (stage, counter) in self.latencies.items()}}
+
+
+def _process_file_timed(filename: str, num_peaks_desired: int, warm_start: bool, cache: FitCache,
+                        auto_max_peaks: int, criterion: str, charge_correction: bool,
+                        use_run_cache: bool) -> tuple:
+    """
+    INTERNAL FUNCTION -
+    Run batch.process_file in a worker, and time it
+
+    :return: (started_at, process_sec, (results, num_scans, num_failed))
+    """
+    started_at = time.time()
+    start = time.perf_counter()
+    result = process_file(filename, num_peaks_desired, warm_start=warm_start, cache=cache,
+                          use_run_cache=use_run_cache, auto_max_peaks=auto_max_peaks, criterion=criterion,
+                          charge_correction=charge_correction)
+    return started_at, time.perf_counter() - start, result
+
+
+class DirectoryWatchService:
+    """
+    DirectoryWatchService watches directories for run files, and fits each one once it has
+    stopped changing. Files go through these stages:
+
+        settling - changed recently. Checked every poll_sec, and queued once its size and mtime
+                   have not changed for settle_sec
+        queued   - waiting for a worker. At most FILES_IN_FLIGHT_PER_WORKER files per worker are
+                   handed to the pool at once, so the queue itself stays in this process
+        running  - being read and fitted by a worker (see batch.process_file)
+        stored   - the results are in the ResultsStore
+
+    A file that changes again while it is running is not queued a second time. It waits until
+    the running job is stored, then goes back to settling, so the newest results are always
+    the ones stored last.
+
+    Files the store already has (with the same size and mtime) are skipped, so restarting the
+    service does not fit everything again.
+
+    Attributes:
+        * watcher - the InotifyWatcher or PollingWatcher finding the files
+        * store - the ResultsStore the results go to
+        * num_peaks_desired - the number of peaks to fit to each scan, or None to pick it for each scan
+        * auto_max_peaks - the most peaks to try, if num_peaks_desired is None
+        * criterion - "aic" or "bic", to pick the number of peaks with if num_peaks_desired is None
+        * charge_correction - True to correct the scans for multiply charged particles before fitting
+        * workers - the number of worker processes
+        * settle_sec - how long a file must not change before it is queued
+        * poll_sec - how often to check the directories and the settling files
+        * warm_start - True to start each fit from the previous scan's fit
+        * cache - [Optional] a FitCache to look fits up in
+        * use_run_cache - True to read (and write) the binary sidecars of the files (see run_cache).
+                          Off by default, so nothing is written to the watched directories
+        * stats - the WatchStats counters
+    """
+    def __init__(self, watcher, store: ResultsStore, num_peaks_desired: int = DEFAULT_NUM_PEAKS,
+                 workers: int = None, settle_sec: float = DEFAULT_SETTLE_SEC, poll_sec: float = DEFAULT_POLL_SEC,
+                 warm_start: bool = False, cache: FitCache = None, auto_max_peaks: int = AUTO_MAX_PEAKS,
+                 criterion: str = DEFAULT_AUTO_CRITERION, charge_correction: bool = False,
+                 use_run_cache: bool = False):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers < 1:
+            raise ValueError("Number of workers must be at least 1")
+        if num_peaks_desired is not None and (num_peaks_desired < 1 or num_peaks_desired > MAX_PEAKS_TO_FIT):
+            raise ValueError("Number of peaks must be between 1 and {}".format(MAX_PEAKS_TO_FIT))
+        if settle_sec < 0 or poll_sec <= 0:
+            raise ValueError("settle_sec must be >= 0 and poll_sec must be > 0")
+
+        self.watcher = watcher
+        self.store = store
+        self.num_peaks_desired = num_peaks_desired
+        self.workers = workers
+        self.settle_sec = settle_sec
+        self.poll_sec = poll_sec
+        self.warm_start = warm_start
+        self.cache = cache
+        self.auto_max_peaks = auto_max_peaks
+        self.criterion = criterion
+        self.charge_correction = charge_correction
+        self.use_run_cache = use_run_cache
+        self.stats = WatchStats()
+
+        # filename -> (size, mtime_ns, when first seen changing, when last seen changing)
+        self._settling: Dict[str, tuple] = {}
+        # (filename, size, mtime_ns, when queued), oldest first
+        self._queue = deque()
+        # future -> (filename, size, mtime_ns, when submitted)
+        self._running = {}
+        # filename -> (size, mtime_ns, when first seen changing, when last seen changing), for the
+        # files that changed again while running. They go back to settling once the run is stored
+        self._postponed: Dict[str, tuple] = {}
+
+    def __repr__(self):
+        s = "DirectoryWatchService:\n"
+        s += "  watching: {}\n".format(", ".join(self.watcher.directories))
+        s += "  store: {}\n".format(self.store.path)
+        s += "  peaks: {}, workers: {}\n".format(
+            AUTO_NUM_PEAKS if self.num_peaks_desired is None else self.num_peaks_desired, self.workers)
+        return s
+
+    def is_idle(self) -> bool:
+        """
+        :return: True if no file is settling, queued or being processed
+        """
+        return not self._settling and not self._queue and not self._running and not self._postponed
+
+    def run(self, stop_event: threading.Event = None, until_idle: bool = False,
+            stats_interval_sec: float = DEFAULT_STATS_INTERVAL_SEC, stats_filename: str = None,
+            verbose: bool = True):
+        """
+        Run the service until stop_event is set (or until interrupted)
+
+        :param stop_event: [Optional] a threading.Event to stop the service with
+        :param until_idle: True to stop as soon as every file found has been processed
+        :param stats_interval_sec: How often to report the counters
+        :param stats_filename: [Optional] a JSON file to write the counters to, every stats_interval_sec
+        :param verbose: True to print progress and the counters to stderr
+        """
+        next_stats_at = time.time() + stats_interval_sec
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                while stop_event is None or not stop_event.is_set():
+                    # Don't sit waiting on the directories while results are coming in
+                    timeout = min(self.poll_sec, 0.05) if self._running else self.poll_sec
+                    for filename in self.watcher.get_changed_files(timeout):
+                        self._file_changed(filename)
+                    self._check_settling()
+                    self._submit(executor)
+                    self._collect(verbose)
+                    self._update_counts()
+
+                    if time.time() >= next_stats_at:
+                        next_stats_at = time.time() + stats_interval_sec
+                        self._report_stats(stats_filename, verbose)
+                    if until_idle and self.is_idle():
+                        break
+            except KeyboardInterrupt:
+                pass
+            finally:
+                for future in self._running:
+                    future.cancel()
+                self._report_stats(stats_filename, verbose)
+                self.watcher.close()
+
+    def _file_changed(self, filename: str):
+        """
+        Internal helper to start (or restart) the settling of a file that changed
+        """
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            # Gone again (e.g. a temp file)
+            self._settling.pop(filename, None)
+            return
+        now = time.time()
+        (_, _, first_seen, _) = self._settling.get(filename, (None, None, now, None))
+        self._settling[filename] = (stat.st_size, stat.st_mtime_ns, first_seen, now)
+
+    def _check_settling(self):
+        """
+        Internal helper to queue the files that have not changed for settle_sec
+        """
+        now = time.time()
+        for filename in list(self._settling):
+            (size, mtime_ns, first_seen, last_changed) = self._settling[filename]
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                del self._settling[filename]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                self._settling[filename] = (stat.st_size, stat.st_mtime_ns, first_seen, now)
+                continue
+            if now - last_changed < self.settle_sec:
+                continue
+
+            del self._settling[filename]
+            if self._is_running(filename):
+                self._postponed[filename] = (size, mtime_ns, first_seen, last_changed)
+                continue
+            if stat.st_size == 0 or self.store.is_up_to_date(filename, size, mtime_ns):
+                continue
+            i_queued = next((i for (i, queued) in enumerate(self._queue) if queued[0] == filename), None)
+            if i_queued is not None:
+                # Already waiting for a worker, which will read the new contents
+                self._queue[i_queued] = (filename, size, mtime_ns, self._queue[i_queued][3])
+                continue
+            self.stats.latencies["settle"].add(now - first_seen)
+            self._queue.append((filename, size, mtime_ns, now))
+
+    def _is_running(self, filename: str) -> bool:
+        """
+        :return: True if a worker is processing the file
+        """
+        return any(running[0] == filename for running in self._running.values())
+
+    def _submit(self, executor: ProcessPoolExecutor):
+        """
+        Internal helper to hand queued files to the pool, keeping at most
+        FILES_IN_FLIGHT_PER_WORKER per worker outstanding
+        """
+        while self._queue and len(self._running) < self.workers * FILES_IN_FLIGHT_PER_WORKER:
+            (filename, size, mtime_ns, queued_at) = self._queue.popleft()
+            future = executor.submit(_process_file_timed, filename, self.num_peaks_desired,
+                                     self.warm_start, self.cache, self.auto_max_peaks, self.criterion,
+                                     self.charge_correction, self.use_run_cache)
+            self._running[future] = (filename, size, mtime_ns, queued_at)
+
+    def _collect(self, verbose: bool):
+        """
+        Internal helper to store the results of the files that are finished
+        """
+        if not self._running:
+            return
+        (done, _) = wait(list(self._running), timeout=0, return_when=FIRST_COMPLETED)
+        for future in done:
+            (filename, size, mtime_ns, queued_at) = self._running.pop(future)
+            self._store_result(future, filename, size, mtime_ns, queued_at, verbose)
+            if filename in self._postponed:
+                # It changed while running, so settle (and fit) it again now the old results are in
+                self._settling.setdefault(filename, self._postponed.pop(filename))
+
+    def _store_result(self, future, filename: str, size: int, mtime_ns: int, queued_at: float, verbose: bool):
+        """
+        Internal helper to store the results of one finished file
+        """
+        try:
+            (started_at, process_sec, (df, num_scans, num_failed)) = future.result()
+        except Exception as e:
+            self.stats.num_files_failed += 1
+            print("FAILED {}: {}".format(filename, e), file=sys.stderr)
+            return
+
+        self.stats.latencies["queue"].add(max(0.0, started_at - queued_at))
+        self.stats.latencies["process"].add(process_sec)
+
+        start = time.perf_counter()
+        self.store.put_run(filename, df, size, mtime_ns, num_scans, num_failed, time.time(), process_sec)
+        self.stats.latencies["store"].add(time.perf_counter() - start)
+
+        self.stats.num_files_done += 1
+        self.stats.num_scans_done += num_scans
+        if verbose:
+            print("{}: {} scans, {} peaks, {} failed fits, {:.2f} sec".format(
+                filename, num_scans, df.shape[0], num_failed, process_sec), file=sys.stderr)
+
+    def _update_counts(self):
+        self.stats.num_settling = len(self._settling) + len(self._postponed)
+        self.stats.num_queued = len(self._queue)
+        self.stats.num_running = len(self._running)
+
+    def _report_stats(self, stats_filename: str, verbose: bool):
+        """
+        Internal helper to print the counters, and write them to stats_filename
+        """
+        self._update_counts()
+        if verbose:
+            print(self.stats, file=sys.stderr, end="")
+        if stats_filename:
+            tmp_filename = stats_filename + ".tmp"
+            with open(tmp_filename, "w") as f:
+                json.dump(self.stats.to_dict(), f, indent=2)
+            os.replace(tmp_filename, stats_filename)
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m htdma_code.watch",
+                                     description="Watch directories for AIM export files, and fit every "
+                                                 "scan of each one as it lands")
+    parser.add_argument("directories", nargs="+", help="directories to watch")
+    parser.add_argument("--pattern", default=DEFAULT_PATTERN,
+                        help="files to process (default '{}')".format(DEFAULT_PATTERN))
+    parser.add_argument("-p", "--peaks", type=parse_num_peaks, default=DEFAULT_NUM_PEAKS,
+                        help="number of peaks to fit to each scan, or '{}' to pick it for each scan "
+                             "(default {})".format(AUTO_NUM_PEAKS, DEFAULT_NUM_PEAKS))
+    parser.add_argument("--max-peaks", type=int, default=AUTO_MAX_PEAKS,
+                        help="with --peaks {}, the most peaks to try (default {})".format(AUTO_NUM_PEAKS, AUTO_MAX_PEAKS))
+    parser.add_argument("--criterion", choices=AUTO_CRITERIA, default=DEFAULT_AUTO_CRITERION,
+                        help="with --peaks {}, how to score the candidates (default {})".format(
+                            AUTO_NUM_PEAKS, DEFAULT_AUTO_CRITERION))
+    parser.add_argument("--charge-correction", action="store_true",
+                        help="correct the scans for multiply charged particles before fitting "
+                             "(files the instrument already corrected are left as they are)")
+    parser.add_argument("-s", "--store", default=DEFAULT_STORE_FILENAME,
+                        help="results database (default {})".format(DEFAULT_STORE_FILENAME))
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--settle", type=float, default=DEFAULT_SETTLE_SEC,
+                        help="seconds a file must not change before it is processed (default {})".format(DEFAULT_SETTLE_SEC))
+    parser.add_argument("--poll", type=float, default=DEFAULT_POLL_SEC,
+                        help="seconds between checks of the directories (default {})".format(DEFAULT_POLL_SEC))
+    parser.add_argument("--no-inotify", action="store_true",
+                        help="poll the directories even where inotify is available (e.g. network shares)")
+    parser.add_argument("--warm-start", action="store_true",
+                        help="start each fit from the previous scan's fit")
+    parser.add_argument("--cache", default=None, metavar="PATH",
+                        help="fit cache database (default {})".format(os.path.join(DEFAULT_CACHE_DIR, FIT_CACHE_FILENAME)))
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always fit from scratch, and do not store the fits")
+    parser.add_argument("--sidecar", dest="use_sidecar", action="store_true", default=False,
+                        help="read and write {} sidecars next to the files, to skip parsing files "
+                             "that are fitted again".format(run_cache.SIDECAR_SUFFIX))
+    parser.add_argument("--no-sidecar", dest="use_sidecar", action="store_false",
+                        help="always parse the files, and do not write anything to the watched "
+                             "directories (the default)")
+    parser.add_argument("--stats-interval", type=float, default=DEFAULT_STATS_INTERVAL_SEC,
+                        help="seconds between reports of the counters (default {})".format(DEFAULT_STATS_INTERVAL_SEC))
+    parser.add_argument("--stats-file", default=None,
+                        help="JSON file to write the counters to")
+    parser.add_argument("--once", action="store_true",
+                        help="process the files that are there, then exit")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="do not print progress")
+    args = parser.parse_args(argv)
+
+    for directory in args.directories:
+        if not os.path.isdir(directory):
+            parser.error("{} is not a directory".format(directory))
+
+    service = DirectoryWatchService(make_watcher(args.directories, args.pattern, use_inotify=not args.no_inotify),
+                                    ResultsStore(args.store),
+                                    num_peaks_desired=args.peaks,
+                                    workers=args.workers,
+                                    settle_sec=args.settle,
+                                    poll_sec=args.poll,
+                                    warm_start=args.warm_start,
+                                    cache=None if args.no_cache else FitCache(args.cache),
+                                    auto_max_peaks=args.max_peaks,
+                                    criterion=args.criterion,
+                                    charge_correction=args.charge_correction,
+                                    use_run_cache=args.use_sidecar)
+    if not args.quiet:
+        print(service, file=sys.stderr, end="")
+    service.run(until_idle=args.once,
+                stats_interval_sec=args.stats_interval,
+                stats_filename=args.stats_file,
+                verbose=not args.quiet)
+    return 1 if service.stats.num_files_failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+"""
+Tests - scan.filter_bad_values against the per-channel loop it replaced
+
+reference_filter_bad_values is the loop Scan._filter_bad_values used to run, kept here as the
+reference. Random scans are built from runs of good and bad channels (zeros, NaN and negative
+values), with runs both shorter and longer than MIN_GOOD_WINDOW_SIZE, and every one of them has
+to filter the same way, one scan at a time and as a whole (n_scans, n_dp) matrix.
+
+Run from the top of the repo:
+    python -m pytest -q tests
+"""
+import numpy as np
+import pytest
+
+from htdma_code.model.scan import MIN_GOOD_WINDOW_SIZE, filter_bad_values
+
+NUM_SEEDS = 50
+NUM_SCANS = 200
+
+# Values a bad channel can have
+BAD_VALUES = (0.0, np.nan, -1.0, -1e-12)
+
+
+def reference_filter_bad_values(raw_values: np.ndarray):
+    """
+    The per-channel loop filter_bad_values replaced, for one scan
+    """
+    y_sel_good = np.array([True for i in range(raw_values.shape[0])])
+    y_sel_good[0] = False
+    y_sel_good[-1] = False
+
+    is_in_good_window = False
+    count_good_channels = 0
+    i_good_channel_start = None
+    for i in range(1, raw_values.shape[0] - 1):
+        if raw_values[i] > 0:
+            if is_in_good_window:
+                count_good_channels += 1
+            else:
+                is_in_good_window = True
+                i_good_channel_start = i
+                count_good_channels = 1
+        else:
+            if is_in_good_window:
+                if count_good_channels < MIN_GOOD_WINDOW_SIZE:
+                    for j in range(i_good_channel_start, i):
+                        y_sel_good[j] = False
+                count_good_channels = 0
+                is_in_good_window = False
+            y_sel_good[i] = False
+
+    y_filtered = np.copy(raw_values)
+    y_filtered[np.logical_not(y_sel_good)] = 0.0
+    return y_filtered, y_sel_good
+
+
+def random_scan(rng: np.random.Generator, num_dp: int) -> np.ndarray:
+    """
+    :return: a scan made of alternating runs of good and bad channels, 1 to 2 * MIN_GOOD_WINDOW_SIZE long
+    """
+    values = np.empty(num_dp)
+    i = 0
+    is_good = bool(rng.integers(2))
+    while i < num_dp:
+        run_length = int(rng.integers(1, 2 * MIN_GOOD_WINDOW_SIZE + 1))
+        if is_good:
+            values[i:i + run_length] = rng.uniform(1e-3, 1e6, run_length)[:num_dp - i]
+        else:
+            values[i:i + run_length] = rng.choice(BAD_VALUES, run_length)[:num_dp - i]
+        i += run_length
+        is_good = not is_good
+    return values
+
+
+def random_matrix(seed: int) -> np.ndarray:
+    """
+    :return: a (NUM_SCANS, n_dp) matrix of random scans, with all-zero and all-good rows among them
+    """
+    rng = np.random.default_rng(seed)
+    num_dp = int(rng.integers(2, 120))
+    matrix = np.array([random_scan(rng, num_dp) for _ in range(NUM_SCANS)])
+    matrix[0] = 0.0
+    matrix[1] = rng.uniform(1e-3, 1e6, num_dp)
+    matrix[2] = np.nan
+    return matrix
+
+
+def assert_same(result: tuple, expected: tuple):
+    (y_filtered, y_sel_good) = result
+    (expected_filtered, expected_sel_good) = expected
+    np.testing.assert_array_equal(y_sel_good, expected_sel_good)
+    np.testing.assert_array_equal(y_filtered, expected_filtered)
+
+
+@pytest.mark.parametrize("seed", range(NUM_SEEDS))
+def test_each_scan_matches_loop(seed):
+    matrix = random_matrix(seed)
+    for row in matrix:
+        assert_same(filter_bad_values(row), reference_filter_bad_values(row))
+
+
+@pytest.mark.parametrize("seed", range(NUM_SEEDS))
+def test_matrix_matches_loop(seed):
+    matrix = random_matrix(seed)
+    (y_filtered, y_sel_good) = filter_bad_values(matrix)
+    assert y_filtered.shape == matrix.shape and y_sel_good.shape == matrix.shape
+    expected = [reference_filter_bad_values(row) for row in matrix]
+    assert_same((y_filtered, y_sel_good), (np.array([e[0] for e in expected]), np.array([e[1] for e in expected])))
+
+
+@pytest.mark.parametrize("num_good", range(1, 2 * MIN_GOOD_WINDOW_SIZE + 2))
+@pytest.mark.parametrize("bad_value", BAD_VALUES)
+def test_runs_around_the_window_size(num_good, bad_value):
+    # A run of num_good good channels in the middle, at the start and at the end of a scan
+    for offset in (0, 1, 5):
+        scan = np.full(num_good + offset + 6, bad_value)
+        scan[offset:offset + num_good] = 1.0
+        for values in (scan, scan[::-1].copy()):
+            assert_same(filter_bad_values(values), reference_filter_bad_values(values))
+
+
+def test_does_not_change_input():
+    matrix = random_matrix(0)
+    original = matrix.copy()
+    filter_bad_values(matrix)
+    np.testing.assert_array_equal(matrix, original)
@@ -0,0 +1,186 @@
+"""
+Tests - FitCache: hits and misses, the running total size, LRU eviction and pickling
+
+The clock of fit_cache is replaced by a FakeClock, so the order the entries were used in
+(and so what gets evicted) does not depend on how fast the tests run.
+
+Run from the top of the repo:
+    python -m pytest -q tests
+"""
+import pickle
+import sqlite3
+
+import numpy as np
+import pytest
+
+import htdma_code.model.fit_cache as fit_cache
+from htdma_code.model.fit_cache import FitCache, fit_cache_key, TOUCH_MIN_INTERVAL_SEC, TOUCH_BATCH_SIZE
+
+# Number of float64 values in each stored result, so every entry has about the same size
+NUM_VALUES = 100
+
+
+class FakeClock:
+    """
+    Stands in for the time module in fit_cache. Every call moves it on by a second
+    """
+    def __init__(self):
+        self.now = 1e9
+
+    def time(self):
+        self.now += 1.0
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(fit_cache, "time", clock)
+    return clock
+
+
+def make_result(seed: int, num_values: int = NUM_VALUES) -> tuple:
+    """
+    :return: something shaped like the results of a fit, (num_peaks_predicted, peak_fit_results, total_fit_result)
+    """
+    return (seed % 3, [seed, seed + 1], np.random.default_rng(seed).random(num_values))
+
+
+def assert_same_result(result: tuple, expected: tuple):
+    assert result[0] == expected[0]
+    assert result[1] == expected[1]
+    np.testing.assert_array_equal(result[2], expected[2])
+
+
+def entry_size(result: tuple) -> int:
+    return len(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def stored(cache: FitCache) -> dict:
+    """
+    :return: key -> size of every entry, read straight from the database
+    """
+    with sqlite3.connect(cache.path) as conn:
+        return dict(conn.execute("SELECT key, size FROM fits").fetchall())
+
+
+def assert_total_size_matches(cache: FitCache):
+    assert cache.get_size_bytes() == sum(stored(cache).values())
+
+
+def test_hit_and_miss(tmp_path, clock):
+    cache = FitCache(str(tmp_path / "fits.sqlite"))
+    values = np.arange(10.0)
+    dp_range = np.geomspace(10, 500, 10)
+    key = fit_cache_key(values, dp_range, 2, 1)
+    assert cache.get(key) is None
+
+    result = make_result(1)
+    cache.put(key, *result)
+    assert_same_result(cache.get(key), result)
+    assert cache.get_num_entries() == 1
+
+    # Anything the fit depends on gives another key
+    for other_key in (fit_cache_key(values + 1, dp_range, 2, 1), fit_cache_key(values, dp_range * 2, 2, 1),
+                      fit_cache_key(values, dp_range, 3, 1), fit_cache_key(values, dp_range, 2, 2),
+                      fit_cache_key(values, dp_range, 2, 1, variant="auto")):
+        assert other_key != key
+        assert cache.get(other_key) is None
+
+
+def test_replacing_an_entry_keeps_the_total_size(tmp_path, clock):
+    cache = FitCache(str(tmp_path / "fits.sqlite"))
+    cache.put("other", *make_result(0))
+    for num_values in (NUM_VALUES, 10 * NUM_VALUES, 1, NUM_VALUES):
+        result = make_result(num_values, num_values)
+        cache.put("key", *result)
+        assert_same_result(cache.get("key"), result)
+        assert cache.get_num_entries() == 2
+        assert cache.get_size_bytes() == entry_size(make_result(0)) + entry_size(result)
+        assert_total_size_matches(cache)
+
+    cache.clear()
+    assert cache.get_num_entries() == 0
+    assert cache.get_size_bytes() == 0
+
+
+def test_eviction_drops_the_oldest_entries(tmp_path, clock):
+    size = entry_size(make_result(0))
+    cache = FitCache(str(tmp_path / "fits.sqlite"), max_size_bytes=int(3.5 * size))
+    for i in range(10):
+        cache.put("key{}".format(i), *make_result(i))
+        assert cache.get_size_bytes() <= cache.max_size_bytes
+        assert_total_size_matches(cache)
+    assert sorted(stored(cache)) == ["key7", "key8", "key9"]
+
+
+def test_hits_keep_entries_from_being_evicted(tmp_path, clock):
+    size = entry_size(make_result(0))
+    cache = FitCache(str(tmp_path / "fits.sqlite"), max_size_bytes=int(3.5 * size))
+    for i in range(3):
+        cache.put("key{}".format(i), *make_result(i))
+
+    # Recent enough hits are not worth writing
+    cache.get("key0")
+    assert not cache._pending_touches
+
+    # key0 is used again a while later, so key1 is now the oldest
+    clock.now += 2 * TOUCH_MIN_INTERVAL_SEC
+    cache.get("key0")
+    cache.put("key3", *make_result(3))
+    assert sorted(stored(cache)) == ["key0", "key2", "key3"]
+
+
+def test_hits_are_written_in_batches(tmp_path, clock):
+    cache = FitCache(str(tmp_path / "fits.sqlite"))
+    keys = ["key{}".format(i) for i in range(TOUCH_BATCH_SIZE + 1)]
+    for key in keys:
+        cache.put(key, *make_result(0, 1))
+
+    def _last_used():
+        with sqlite3.connect(cache.path) as conn:
+            return dict(conn.execute("SELECT key, last_used FROM fits").fetchall())
+    before = _last_used()
+
+    clock.now += 2 * TOUCH_MIN_INTERVAL_SEC
+    for key in keys[:-1]:
+        cache.get(key)
+    # A full batch has been written, the next hit waits for the next flush
+    assert all(_last_used()[key] > before[key] for key in keys[:-1])
+    cache.get(keys[-1])
+    assert _last_used()[keys[-1]] == before[keys[-1]]
+    cache.flush()
+    assert _last_used()[keys[-1]] > before[keys[-1]]
+
+
+def test_pickled_copy_reads_the_entries(tmp_path, clock):
+    cache = FitCache(str(tmp_path / "fits.sqlite"), max_size_bytes=12345678)
+    result = make_result(1)
+    cache.put("key", *result)
+
+    copy = pickle.loads(pickle.dumps(cache))
+    assert copy.path == cache.path and copy.max_size_bytes == cache.max_size_bytes
+    assert_same_result(copy.get("key"), result)
+
+    # ...and what the copy stores, the original sees
+    copy.put("new", *make_result(2))
+    copy.close()
+    assert_same_result(cache.get("new"), make_result(2))
+    assert cache.get_num_entries() == 2
+    assert_total_size_matches(cache)
+
+
+def test_database_without_total_size_is_added_up(tmp_path, clock):
+    path = str(tmp_path / "fits.sqlite")
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE fits (key TEXT PRIMARY KEY, data BLOB NOT NULL, "
+                     "size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        for i in range(3):
+            data = pickle.dumps(make_result(i), protocol=pickle.HIGHEST_PROTOCOL)
+            conn.execute("INSERT INTO fits VALUES (?, ?, ?, ?)", ("key{}".format(i), data, len(data), i))
+    conn.close()
+
+    cache = FitCache(path)
+    assert cache.get_num_entries() == 3
+    assert_total_size_matches(cache)
+    assert_same_result(cache.get("key1"), make_result(1))
@@ -0,0 +1,153 @@
+"""
+Tests - run_cache: when a sidecar is used, and that what it loads is what was parsed
+
+Every export in data/ is copied to a temporary directory first, so the sidecars written by
+the tests never end up next to the real files.
+
+Run from the top of the repo:
+    python -m pytest -q tests
+"""
+import glob
+import json
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+import htdma_code.model.files.run_cache as run_cache
+from htdma_code.model.files.read_file_utils import read_run_file
+from htdma_code.model.files.run_data import RunData
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+DATA_FILES = sorted(glob.glob(os.path.join(DATA_DIR, "*.txt")))
+
+# How far to move the mtime of a file that is touched but not changed (ns)
+MTIME_STEP_NS = 10 ** 9
+
+
+@pytest.fixture(params=DATA_FILES, ids=os.path.basename)
+def run_file(request, tmp_path) -> str:
+    """
+    :return: a copy of one of the exports in data/
+    """
+    filename = str(tmp_path / os.path.basename(request.param))
+    shutil.copyfile(request.param, filename)
+    return filename
+
+
+def assert_same_run_data(run_data: RunData, expected: RunData):
+    assert run_data.filename == expected.filename
+    assert run_data.data_file_version == expected.data_file_version
+    assert run_data.setup == expected.setup
+    np.testing.assert_array_equal(run_data.scan_ids, expected.scan_ids)
+    assert run_data.time_stamps.equals(expected.time_stamps)
+    assert list(run_data.dp_labels) == list(expected.dp_labels)
+    np.testing.assert_array_equal(run_data.dp, expected.dp)
+    assert run_data.conc.dtype == np.float64
+    np.testing.assert_array_equal(run_data.conc, expected.conc)
+    assert run_data.scan_meta == expected.scan_meta
+
+
+def read_meta(filename: str) -> dict:
+    with open(os.path.join(run_cache.get_sidecar_dir(filename), run_cache.FILENAME_META)) as f:
+        return json.load(f)
+
+
+def touch(filename: str):
+    """
+    Move the mtime of a file on, without changing it
+    """
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + MTIME_STEP_NS))
+
+
+def test_loads_what_was_parsed(run_file):
+    parsed = read_run_file(run_file)
+    assert run_cache.load_run_cache(run_file) is None
+
+    assert_same_run_data(run_cache.read_run_file_cached(run_file), parsed)
+    assert os.path.isdir(run_cache.get_sidecar_dir(run_file))
+
+    loaded = run_cache.load_run_cache(run_file)
+    assert isinstance(loaded.conc, np.memmap) and not loaded.conc.flags.writeable
+    assert_same_run_data(loaded, parsed)
+    assert_same_run_data(run_cache.read_run_file_cached(run_file), parsed)
+
+    loaded = run_cache.load_run_cache(run_file, use_mmap=False)
+    assert not isinstance(loaded.conc, np.memmap)
+    assert_same_run_data(loaded, parsed)
+
+
+def test_touched_file_is_reused(run_file):
+    parsed = read_run_file(run_file)
+    run_cache.write_run_cache(parsed, run_file)
+    touch(run_file)
+
+    loaded = run_cache.load_run_cache(run_file)
+    assert loaded is not None
+    assert_same_run_data(loaded, parsed)
+    # ...and the new mtime is recorded, so the file is not hashed again next time
+    assert read_meta(run_file)["source_mtime_ns"] == os.stat(run_file).st_mtime_ns
+
+
+def test_changed_file_is_rejected(run_file):
+    run_cache.write_run_cache(read_run_file(run_file), run_file)
+    with open(run_file, "rb") as f:
+        contents = bytearray(f.read())
+
+    # Same size, different contents
+    i = contents.rindex(b"0")
+    contents[i:i + 1] = b"1"
+    with open(run_file, "wb") as f:
+        f.write(contents)
+    touch(run_file)
+    assert run_cache.load_run_cache(run_file) is None
+
+    # Different size
+    with open(run_file, "ab") as f:
+        f.write(b"\n")
+    assert run_cache.load_run_cache(run_file) is None
+
+
+def test_changed_file_is_parsed_again(run_file):
+    run_cache.write_run_cache(read_run_file(run_file), run_file)
+    with open(run_file, "ab") as f:
+        f.write(b"\n")
+    parsed = read_run_file(run_file)
+
+    assert_same_run_data(run_cache.read_run_file_cached(run_file), parsed)
+    assert read_meta(run_file)["source_size"] == os.stat(run_file).st_size
+    assert run_cache.load_run_cache(run_file) is not None
+
+
+def test_other_format_version_is_ignored(run_file):
+    run_cache.write_run_cache(read_run_file(run_file), run_file)
+    meta = read_meta(run_file)
+    meta["format_version"] = run_cache.SIDECAR_FORMAT_VERSION - 1
+    run_cache._write_meta(run_cache.get_sidecar_dir(run_file), meta)
+    assert run_cache.load_run_cache(run_file) is None
+
+    # Reading the file writes a current sidecar
+    run_cache.read_run_file_cached(run_file)
+    assert read_meta(run_file)["format_version"] == run_cache.SIDECAR_FORMAT_VERSION
+    assert run_cache.load_run_cache(run_file) is not None
+
+
+def test_broken_sidecar_is_ignored(run_file):
+    run_cache.write_run_cache(read_run_file(run_file), run_file)
+    sidecar_dir = run_cache.get_sidecar_dir(run_file)
+
+    np.save(os.path.join(sidecar_dir, run_cache.FILENAME_CONC), np.zeros((1, 1)))
+    assert run_cache.load_run_cache(run_file) is None
+
+    os.remove(os.path.join(sidecar_dir, run_cache.FILENAME_CONC))
+    assert run_cache.load_run_cache(run_file) is None
+
+    with open(os.path.join(sidecar_dir, run_cache.FILENAME_META), "w") as f:
+        f.write("{")
+    assert run_cache.load_run_cache(run_file) is None
+
+    run_cache.remove_run_cache(run_file)
+    assert not os.path.exists(sidecar_dir)
+    assert run_cache.load_run_cache(run_file) is None